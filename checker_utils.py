@@ -0,0 +1,308 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shlex
+import time
+import traceback
+import asyncssh
+from db import extend_checker_grace, is_checker_in_grace, run_checker_restart
+from ssh_utils import CONNECTION_ERRORS
+
+logger = logging.getLogger(__name__)
+
+LOCAL_HOSTS = ['localhost', '127.0.0.1']
+
+class CheckerCommandError(Exception):
+    pass
+
+class XrayCheckerControl:
+    """Долгоживущий канал управления хостом Xray Checker.
+
+    В удалённом режиме держит одно SSH-соединение с открытым SFTP-клиентом
+    и переподключается при обрыве; в локальном работает с файлами напрямую,
+    а docker вызывает асинхронным подпроцессом.
+
+    Перезапуски согласуются между воркерами через Postgres (checker_state):
+    docker restart выполняет один процесс, а окно тишины видят все.
+    """
+
+    def __init__(self):
+        self.conn = None
+        self.sftp = None
+        self._lock = asyncio.Lock()
+        self._restart_lock = asyncio.Lock()
+        self._pending_restart = None
+        self._restart_task = None
+        self._restarting = False
+        self.restart_debounce = float(os.getenv('XRAY_CHECKER_RESTART_DEBOUNCE', '3'))
+        self.restart_grace = float(os.getenv('XRAY_CHECKER_RESTART_GRACE', '90'))
+        self.restart_grace_until = 0.0
+        self.stats = {
+            "connects": 0, "reconnects": 0, "commands": 0, "restart_requests": 0, "restarts": 0,
+            "files_written": 0, "files_unchanged": 0, "files_removed": 0, "files_absent": 0, "files_failed": 0
+        }
+
+    @property
+    def host(self):
+        return os.getenv('XRAY_CHECKER_HOST')
+
+    @property
+    def json_path(self):
+        return os.getenv('XRAY_CHECKER_JSON_PATH')
+
+    @property
+    def container_name(self):
+        return os.getenv('XRAY_CHECKER_CONTAINER_NAME', 'xraychecker-xray-checker')
+
+    def is_local(self) -> bool:
+        return self.host in LOCAL_HOSTS
+
+    def _check_config(self):
+        if not self.is_local() and not os.getenv('XRAY_CHECKER_SSH_KEY'):
+            logger.error("Invalid Xray Checker config: SSH key or host not set")
+            raise ValueError("SSH key or valid host required")
+
+    def outbound_path(self, ip: str) -> str:
+        if not self.json_path:
+            logger.error("XRAY_CHECKER_JSON_PATH not set")
+            raise ValueError("XRAY_CHECKER_JSON_PATH not set")
+        return f"{self.json_path}/{ip}.json"
+
+    def _connected(self) -> bool:
+        return self.conn is not None and not self.conn.is_closed() and self.sftp is not None
+
+    async def _connect(self):
+        async with self._lock:
+            if self._connected():
+                return
+            if self.conn is not None:
+                self.stats["reconnects"] += 1
+                self._reset()
+            timeout = float(os.getenv('XRAY_CHECKER_SSH_TIMEOUT', '30'))
+            self.conn = await asyncssh.connect(
+                self.host,
+                client_keys=[os.getenv('XRAY_CHECKER_SSH_KEY')],
+                known_hosts=None,
+                connect_timeout=timeout,
+                login_timeout=timeout,
+                keepalive_interval=float(os.getenv('SSH_KEEPALIVE_INTERVAL', '30'))
+            )
+            self.sftp = await self.conn.start_sftp_client()
+            self.stats["connects"] += 1
+            logger.info(f"Xray Checker control session opened to {self.host}")
+
+    def _reset(self):
+        if self.sftp is not None:
+            self.sftp.exit()
+        if self.conn is not None:
+            self.conn.close()
+        self.sftp = None
+        self.conn = None
+
+    async def _remote(self, operation):
+        """Выполняет operation(conn, sftp); при обрыве соединения переподключается один раз."""
+        for attempt in range(2):
+            await self._connect()
+            try:
+                return await operation(self.conn, self.sftp)
+            except CONNECTION_ERRORS as e:
+                if attempt:
+                    raise
+                logger.warning(f"Xray Checker control session lost: {str(e)}, reconnecting")
+                async with self._lock:
+                    self._reset()
+
+    async def run(self, *args):
+        """Запускает команду на хосте чекера и возвращает (код, stdout, stderr)."""
+        self._check_config()
+        self.stats["commands"] += 1
+        if self.is_local():
+            process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            stdout, stderr = await process.communicate()
+            return process.returncode, stdout.decode(errors='replace'), stderr.decode(errors='replace')
+        command = ' '.join(args)
+        result = await self._remote(lambda conn, sftp: conn.run(command, check=False))
+        return result.exit_status, result.stdout, result.stderr
+
+    def _local_hash(self, path):
+        try:
+            with open(path, 'rb') as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except FileNotFoundError:
+            return None
+
+    def _sync_local(self, plan):
+        results = {}
+        for ip, (path, content, digest) in plan.items():
+            current = self._local_hash(path)
+            if content is None:
+                if current is None:
+                    results[ip] = ("absent", None)
+                else:
+                    os.remove(path)
+                    results[ip] = ("removed", None)
+            elif current == digest:
+                results[ip] = ("unchanged", None)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, 'w') as f:
+                    f.write(content)
+                os.replace(tmp_path, path)
+                results[ip] = ("written", None)
+        return results
+
+    async def _remote_hashes(self, conn, paths):
+        """Хэши существующих файлов одним вызовом sha256sum; отсутствующих в ответе нет."""
+        if not paths:
+            return {}
+        result = await conn.run(f"sha256sum -- {' '.join(shlex.quote(path) for path in paths)}", check=False)
+        hashes = {}
+        for line in result.stdout.splitlines():
+            parts = line.split(None, 1)
+            if len(parts) == 2:
+                hashes[parts[1].lstrip('*')] = parts[0]
+        return hashes
+
+    async def _sync_remote(self, conn, sftp, plan):
+        hashes = await self._remote_hashes(conn, [path for path, _, _ in plan.values()])
+        directories = {os.path.dirname(path) for path, content, _ in plan.values() if content is not None}
+        for directory in directories:
+            if not await sftp.exists(directory):
+                await sftp.makedirs(directory)
+                logger.info(f"Created directory {directory}")
+
+        async def apply(ip, path, content, digest):
+            current = hashes.get(path)
+            try:
+                if content is None:
+                    if current is None:
+                        return ip, "absent", None
+                    await sftp.remove(path)
+                    return ip, "removed", None
+                if current == digest:
+                    return ip, "unchanged", None
+                # Чекер не должен увидеть недописанный файл: пишем во временный и переименовываем
+                tmp_path = f"{path}.tmp"
+                async with sftp.open(tmp_path, 'w') as f:
+                    await f.write(content)
+                await sftp.posix_rename(tmp_path, path)
+                return ip, "written", None
+            except asyncssh.SFTPNoSuchFile:
+                return ip, "absent", None
+            except asyncssh.SFTPError as e:
+                return ip, "failed", str(e)
+
+        # Все операции идут конвейером через один SFTP-клиент
+        outcomes = await asyncio.gather(*(apply(ip, *entry) for ip, entry in plan.items()))
+        return {ip: (action, error) for ip, action, error in outcomes}
+
+    async def sync_outbounds(self, changes: dict) -> list:
+        """Приводит outbound-файлы чекера к changes {ip: json или None для удаления}.
+
+        Файлы с совпадающим хэшем не перезаписываются. Возвращает результат по каждому IP:
+        written, unchanged, removed, absent или failed.
+        """
+        self._check_config()
+        plan = {}
+        for ip, json_data in changes.items():
+            content = json.dumps(json_data, indent=2) if json_data is not None else None
+            digest = hashlib.sha256(content.encode('utf-8')).hexdigest() if content is not None else None
+            plan[ip] = (self.outbound_path(ip), content, digest)
+        if not plan:
+            return []
+        if self.is_local():
+            outcomes = await asyncio.to_thread(self._sync_local, plan)
+        else:
+            outcomes = await self._remote(lambda conn, sftp: self._sync_remote(conn, sftp, plan))
+        results = []
+        for ip, (action, error) in outcomes.items():
+            self.stats["files_" + action] += 1
+            results.append({"ip": ip, "action": action, "success": action != "failed", "error": error})
+        logger.info(f"Synced {len(results)} outbound files: {[result['action'] for result in results].count('written')} written")
+        return results
+
+    async def restart_container(self) -> bool:
+        """Перезапускает контейнер чекера; отсутствующий контейнер, как и раньше, не считается ошибкой."""
+        exit_status, stdout, stderr = await self.run('docker', 'ps', '-a', '-q', '-f', f'name={self.container_name}')
+        if not stdout.strip():
+            logger.warning(f"Container {self.container_name} not found, skipping restart")
+            return True
+        exit_status, stdout, stderr = await self.run('sudo', 'docker', 'restart', self.container_name)
+        if exit_status != 0:
+            logger.error(f"Docker restart failed: {stderr}")
+            raise CheckerCommandError(f"Docker restart failed: {stderr}")
+        logger.info("Xray Checker restarted successfully")
+        return True
+
+    async def request_restart(self) -> bool:
+        """Просит перезапустить чекер; запросы в окне XRAY_CHECKER_RESTART_DEBOUNCE
+        склеиваются в один docker restart, и все вызывающие получают его результат.
+        Запросы из других воркеров, пришедшие до начала перезапуска, тоже им покрываются."""
+        self.stats["restart_requests"] += 1
+        if self._pending_restart is None:
+            self._pending_restart = asyncio.get_running_loop().create_future()
+            self._restart_task = asyncio.create_task(self._run_restart(self._pending_restart))
+        return await asyncio.shield(self._pending_restart)
+
+    async def _run_restart(self, future):
+        try:
+            # Ведущий воркер не должен поднимать тревогу по unknown, пока перезапуск ждёт своей очереди
+            await extend_checker_grace(self.restart_debounce + self.restart_grace)
+        except Exception as e:
+            logger.error(f"Failed to record Xray Checker restart grace: {str(e)}\n{traceback.format_exc()}")
+        await asyncio.sleep(self.restart_debounce)
+        # Запросы после этой точки уйдут в следующий перезапуск
+        self._pending_restart = None
+
+        async def restart():
+            self.stats["restarts"] += 1
+            return await self.restart_container()
+
+        async with self._restart_lock:
+            self._restarting = True
+            try:
+                future.set_result(await run_checker_restart(restart, self.restart_grace))
+            except Exception as e:
+                future.set_exception(e)
+                # Результат забирают вызывающие; без них исключение не должно попасть в лог как потерянное
+                future.exception()
+            finally:
+                self._restarting = False
+                self.restart_grace_until = time.monotonic() + self.restart_grace
+
+    def _local_restart_grace(self) -> bool:
+        return self._pending_restart is not None or self._restarting or time.monotonic() < self.restart_grace_until
+
+    async def in_restart_grace(self) -> bool:
+        """Идёт ли перезапуск чекера в любом воркере или он был недавно — статусы unknown тогда не от серверов."""
+        if self._local_restart_grace():
+            return True
+        try:
+            return await is_checker_in_grace()
+        except Exception as e:
+            logger.error(f"Failed to read Xray Checker restart grace: {str(e)}\n{traceback.format_exc()}")
+            return False
+
+    async def close(self):
+        async with self._lock:
+            if self.conn is not None:
+                conn = self.conn
+                self._reset()
+                try:
+                    await conn.wait_closed()
+                except Exception as e:
+                    logger.debug(f"Error closing Xray Checker control session: {str(e)}\n{traceback.format_exc()}")
+                logger.info("Xray Checker control session closed")
+
+    def get_stats(self) -> dict:
+        return {
+            "mode": "local" if self.is_local() else "ssh",
+            "connected": self._connected(),
+            "restart_grace": self._local_restart_grace(),
+            **self.stats
+        }
+
+checker_control = XrayCheckerControl()
@@ -1,80 +1,267 @@
-import aiohttp
+import asyncio
 import os
 import logging
+import time
 import traceback
+import aiohttp
+from http_utils import http_clients
+from ratelimit_utils import TokenBucket
 
 logger = logging.getLogger(__name__)
 
+CLOUDFLARE_API_URL = "https://api.cloudflare.com/client/v4"
+
+class CloudflareError(Exception):
+    def __init__(self, message, status=None, errors=None):
+        super().__init__(message)
+        self.status = status
+        self.errors = errors or []
+
+class CloudflareRateLimitError(CloudflareError):
+    pass
+
+def _headers() -> dict:
+    return {
+        "Authorization": f"Bearer {os.getenv('CLOUDFLARE_API_TOKEN')}",
+        "Content-Type": "application/json"
+    }
+
+def get_base_domain(domain: str) -> str:
+    # Извлекаем базовый домен (например, unfence.nl из n.unfence.nl)
+    return '.'.join(domain.split('.')[-2:])
+
+class CloudflareClient:
+    """Клиент Cloudflare API: токен-бакет под лимит аккаунта, повтор по 429/5xx с учётом Retry-After
+    и объединение одинаковых параллельных GET-запросов."""
+
+    def __init__(self):
+        # Лимит Cloudflare — 1200 запросов за 5 минут на пользователя, т.е. 4 в секунду
+        self.bucket = TokenBucket(
+            rate=float(os.getenv('CLOUDFLARE_RATE_LIMIT', '4')),
+            capacity=float(os.getenv('CLOUDFLARE_BURST', '20'))
+        )
+        self.max_retries = int(os.getenv('CLOUDFLARE_MAX_RETRIES', '5'))
+        self._inflight = {}
+        self.stats = {"requests": 0, "retries": 0, "rate_limited": 0, "transport_errors": 0, "coalesced": 0}
+
+    def _retry_delay(self, response, attempt: int) -> float:
+        retry_after = response.headers.get('Retry-After')
+        if retry_after:
+            try:
+                return max(1.0, float(retry_after))
+            except ValueError:
+                pass
+        return min(60.0, 2 ** attempt)
+
+    async def request(self, method: str, path: str, params: dict = None, json: dict = None) -> dict:
+        url = f"{CLOUDFLARE_API_URL}{path}"
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            self.stats["requests"] += 1
+            try:
+                async with http_clients.request('cloudflare', method, url, headers=_headers(), params=params, json=json) as resp:
+                    if resp.status == 429 or resp.status >= 500:
+                        delay = self._retry_delay(resp, attempt)
+                        if resp.status == 429:
+                            self.stats["rate_limited"] += 1
+                            self.bucket.pause(delay)
+                        if attempt == self.max_retries:
+                            error_class = CloudflareRateLimitError if resp.status == 429 else CloudflareError
+                            raise error_class(f"Cloudflare API {method} {path} failed with HTTP {resp.status}", status=resp.status)
+                        self.stats["retries"] += 1
+                        logger.warning(f"Cloudflare API {method} {path} returned {resp.status}, retrying in {delay}s")
+                    else:
+                        # Ответы 5xx (в том числе HTML-страницы края Cloudflare) повторяются выше, не доходя до разбора
+                        try:
+                            result = await resp.json(content_type=None)
+                        except ValueError as e:
+                            raise CloudflareError(f"Cloudflare API {method} {path} returned a non-JSON body with HTTP {resp.status}", status=resp.status) from e
+                        if not isinstance(result, dict):
+                            raise CloudflareError(f"Cloudflare API {method} {path} returned an unexpected body with HTTP {resp.status}", status=resp.status)
+                        if not result.get('success'):
+                            raise CloudflareError(f"Cloudflare API error: {result.get('errors', [])}", status=resp.status, errors=result.get('errors', []))
+                        return result
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # Сетевые сбои повторяем с той же паузой; лишние записи от повторённого POST уберёт сверка
+                self.stats["transport_errors"] += 1
+                error = str(e) or type(e).__name__
+                if attempt == self.max_retries:
+                    raise CloudflareError(f"Cloudflare API {method} {path} failed: {error}") from e
+                delay = min(60.0, 2 ** attempt)
+                self.stats["retries"] += 1
+                logger.warning(f"Cloudflare API {method} {path} failed: {error}, retrying in {delay}s")
+            await asyncio.sleep(delay)
+
+    async def get(self, path: str, params: dict = None) -> dict:
+        """GET с объединением: одинаковые запросы в полёте получают один ответ."""
+        key = (path, tuple(sorted((params or {}).items())))
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.request('GET', path, params=params))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.stats["coalesced"] += 1
+        return await asyncio.shield(task)
+
+    async def list_all(self, path: str, params: dict, per_page: int) -> list:
+        """Выгружает все страницы списка Cloudflare."""
+        items = []
+        page = 1
+        while True:
+            result = await self.get(path, {**params, "page": page, "per_page": per_page})
+            items.extend(result.get('result', []))
+            total_pages = (result.get('result_info') or {}).get('total_pages', 1)
+            if page >= total_pages:
+                return items
+            page += 1
+
+    async def batch(self, zone_id: str, posts: list = None, deletes: list = None) -> dict:
+        """Применяет пачку изменений записей зоны одним атомарным запросом."""
+        payload = {}
+        if posts:
+            payload["posts"] = posts
+        if deletes:
+            payload["deletes"] = [{"id": record_id} for record_id in deletes]
+        result = await self.request('POST', f"/zones/{zone_id}/dns_records/batch", json=payload)
+        return result.get('result') or {}
+
+    def get_stats(self) -> dict:
+        return {"inflight": len(self._inflight), **self.stats}
+
+cloudflare_client = CloudflareClient()
+
+class CloudflareCache:
+    """Кэш zone_id по домену и индекс A-записей каждой зоны по IP и имени."""
+
+    def __init__(self):
+        self.zones = {}
+        self.zones_loaded_at = None
+        self.records = {}
+        self._zones_lock = asyncio.Lock()
+        self._record_locks = {}
+
+    def _zone_ttl(self) -> float:
+        return float(os.getenv('CLOUDFLARE_ZONE_CACHE_TTL', '3600'))
+
+    def _records_ttl(self) -> float:
+        return float(os.getenv('CLOUDFLARE_RECORD_CACHE_TTL', '300'))
+
+    async def _load_zones(self):
+        zones = await cloudflare_client.list_all("/zones", {}, per_page=50)
+        self.zones = {zone['name']: zone['id'] for zone in zones}
+        self.zones_loaded_at = time.monotonic()
+        logger.info(f"Loaded {len(self.zones)} Cloudflare zones")
+
+    async def get_zone_id(self, domain: str) -> str:
+        base_domain = get_base_domain(domain)
+        expired = self.zones_loaded_at is None or time.monotonic() - self.zones_loaded_at > self._zone_ttl()
+        if not expired and base_domain in self.zones:
+            return self.zones[base_domain]
+        loaded_before = self.zones_loaded_at
+        async with self._zones_lock:
+            # Зоны могли обновиться, пока ждали блокировку
+            if self.zones_loaded_at == loaded_before:
+                await self._load_zones()
+        if base_domain not in self.zones:
+            logger.error(f"No zone found for domain {base_domain}")
+            raise CloudflareError(f"No zone found for domain {base_domain}")
+        logger.debug(f"Found zone_id {self.zones[base_domain]} for domain {base_domain}")
+        return self.zones[base_domain]
+
+    def _index(self, records: list) -> dict:
+        index = {"by_ip": {}, "by_name": {}, "by_id": {}, "loaded_at": time.monotonic()}
+        for record in records:
+            self._add_to_index(index, record)
+        return index
+
+    def _add_to_index(self, index: dict, record: dict):
+        index["by_id"][record['id']] = record
+        index["by_ip"].setdefault(record['content'], []).append(record)
+        index["by_name"].setdefault(record['name'], []).append(record)
+
+    async def get_zone_records(self, zone_id: str, force: bool = False) -> dict:
+        index = self.records.get(zone_id)
+        if not force and index and time.monotonic() - index["loaded_at"] < self._records_ttl():
+            return index
+        loaded_before = index["loaded_at"] if index else None
+        lock = self._record_locks.setdefault(zone_id, asyncio.Lock())
+        async with lock:
+            current = self.records.get(zone_id)
+            if current and current["loaded_at"] != loaded_before:
+                return current
+            records = await cloudflare_client.list_all(f"/zones/{zone_id}/dns_records", {"type": "A"}, per_page=1000)
+            self.records[zone_id] = self._index(records)
+            logger.debug(f"Indexed {len(records)} A records for zone {zone_id}")
+            return self.records[zone_id]
+
+    def record_created(self, zone_id: str, record: dict):
+        index = self.records.get(zone_id)
+        if index and record.get('type') == 'A':
+            self._add_to_index(index, record)
+
+    def record_deleted(self, zone_id: str, record_id: str):
+        index = self.records.get(zone_id)
+        if not index:
+            return
+        record = index["by_id"].pop(record_id, None)
+        if not record:
+            return
+        for key, field in (("by_ip", 'content'), ("by_name", 'name')):
+            remaining = [r for r in index[key].get(record[field], []) if r['id'] != record_id]
+            if remaining:
+                index[key][record[field]] = remaining
+            else:
+                index[key].pop(record[field], None)
+
+cloudflare_cache = CloudflareCache()
+
 async def get_zone_id(domain: str) -> str:
-    """Получает zone_id для домена через Cloudflare API."""
+    """Получает zone_id для домена из кэша зон Cloudflare."""
     try:
-        # Извлекаем базовый домен (например, unfence.nl из n.unfence.nl)
-        base_domain = '.'.join(domain.split('.')[-2:])
-        url = "https://api.cloudflare.com/client/v4/zones"
-        headers = {
-            "Authorization": f"Bearer {os.getenv('CLOUDFLARE_API_TOKEN')}",
-            "Content-Type": "application/json"
-        }
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
-            async with session.get(url, headers=headers) as resp:
-                result = await resp.json()
-                if not result.get('success'):
-                    logger.error(f"Failed to fetch zones: {result.get('errors', [])}")
-                    raise Exception(f"Cloudflare API error: {result.get('errors', [])}")
-                for zone in result.get('result', []):
-                    if zone['name'] == base_domain:
-                        logger.debug(f"Found zone_id {zone['id']} for domain {base_domain}")
-                        return zone['id']
-                logger.error(f"No zone found for domain {base_domain}")
-                raise Exception(f"No zone found for domain {base_domain}")
+        return await cloudflare_cache.get_zone_id(domain)
     except Exception as e:
         logger.error(f"Failed to get zone_id for {domain}: {str(e)}\n{traceback.format_exc()}")
         raise
 
+def _record_payload(ip: str, inbound_letter: str, ttl: int) -> dict:
+    return {
+        "type": "A",
+        "name": f"d{inbound_letter}",
+        "content": ip,
+        "ttl": ttl,
+        "proxied": False
+    }
+
 async def create_dns_record(ip: str, inbound_letter: str, ttl: int, domain: str) -> dict:
     """Создаёт DNS-запись d<inbound_letter> для IP в зоне домена."""
     logger.debug(f"Creating DNS record: inbound_letter={inbound_letter}, domain={domain}, ip={ip}, ttl={ttl}")
     try:
         zone_id = await get_zone_id(domain)
-        url = f"https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records"
-        headers = {
-            "Authorization": f"Bearer {os.getenv('CLOUDFLARE_API_TOKEN')}",
-            "Content-Type": "application/json"
-        }
-        payload = {
-            "type": "A",
-            "name": f"d{inbound_letter}",
-            "content": ip,
-            "ttl": ttl,
-            "proxied": False
-        }
+        payload = _record_payload(ip, inbound_letter, ttl)
         logger.debug(f"DNS record payload: {payload}")
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
-            async with session.post(url, headers=headers, json=payload) as resp:
-                result = await resp.json()
-                if not result.get('success'):
-                    logger.error(f"Failed to create DNS record for {ip}: {result.get('errors', [])}")
-                    raise Exception(f"Cloudflare API error: {result.get('errors', [])}")
-                logger.info(f"Created DNS record d{inbound_letter}.{domain} for {ip}")
-                return result
+        result = await cloudflare_client.request('POST', f"/zones/{zone_id}/dns_records", json=payload)
+        cloudflare_cache.record_created(zone_id, result['result'])
+        logger.info(f"Created DNS record d{inbound_letter}.{domain} for {ip}")
+        return result
     except Exception as e:
         logger.error(f"Failed to create DNS record for {ip}: {str(e)}\n{traceback.format_exc()}")
         raise
 
 async def find_dns_record(ip: str, domain: str) -> dict:
-    """Ищет DNS-запись для IP в зоне домена."""
+    """Ищет DNS-запись для IP в зоне домена, при промахе перечитывая зону."""
     try:
         zone_id = await get_zone_id(domain)
-        url = f"https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records?type=A&content={ip}"
-        headers = {"Authorization": f"Bearer {os.getenv('CLOUDFLARE_API_TOKEN')}"}
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
-            async with session.get(url, headers=headers) as resp:
-                result = await resp.json()
-                if result.get('success') and result.get('result'):
-                    logger.debug(f"Found DNS record for {ip}: {result['result'][0]}")
-                    return result['result'][0]
-                logger.debug(f"No DNS record found for {ip} in domain {domain}")
-                return None
+        index = await cloudflare_cache.get_zone_records(zone_id)
+        records = index["by_ip"].get(ip)
+        if not records:
+            index = await cloudflare_cache.get_zone_records(zone_id, force=True)
+            records = index["by_ip"].get(ip)
+        if records:
+            logger.debug(f"Found DNS record for {ip}: {records[0]}")
+            return records[0]
+        logger.debug(f"No DNS record found for {ip} in domain {domain}")
+        return None
     except Exception as e:
         logger.error(f"Failed to find DNS record for {ip} in domain {domain}: {str(e)}\n{traceback.format_exc()}")
         raise
@@ -83,16 +270,108 @@ async def delete_dns_record(record_id: str, domain: str) -> bool:
     """Удаляет DNS-запись по ID в зоне домена."""
     try:
         zone_id = await get_zone_id(domain)
-        url = f"https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records/{record_id}"
-        headers = {"Authorization": f"Bearer {os.getenv('CLOUDFLARE_API_TOKEN')}"}
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
-            async with session.delete(url, headers=headers) as resp:
-                result = await resp.json()
-                if not result.get('success'):
-                    logger.error(f"Failed to delete DNS record {record_id}: {result.get('errors', [])}")
-                    raise Exception(f"Cloudflare API error: {result.get('errors', [])}")
-                logger.info(f"Deleted DNS record {record_id}")
-                return True
+        await cloudflare_client.request('DELETE', f"/zones/{zone_id}/dns_records/{record_id}")
+        cloudflare_cache.record_deleted(zone_id, record_id)
+        logger.info(f"Deleted DNS record {record_id}")
+        return True
     except Exception as e:
         logger.error(f"Failed to delete DNS record {record_id} in domain {domain}: {str(e)}\n{traceback.format_exc()}")
-        raise
\ No newline at end of file
+        raise
+
+async def reconcile_dns_records(desired: dict, ttl: int) -> dict:
+    """Приводит A-записи d<letter> к желаемому набору {(domain, inbound_letter): {ip, ...}}.
+
+    Каждая зона читается один раз, применяются только недостающие создания
+    и удаления лишних записей под управляемыми именами — пачками через batch API.
+    """
+    summary = {"created": [], "deleted": [], "unchanged": 0, "failed": []}
+    plan_creates = {}
+    plan_deletes = {}
+    zones = {}
+    for (domain, inbound_letter), ips in desired.items():
+        if not ips:
+            continue
+        try:
+            zone_id = await get_zone_id(domain)
+        except Exception as e:
+            summary["failed"].append({"domain": domain, "inbound_letter": inbound_letter, "error": str(e)})
+            continue
+        # Домены одной зоны с общим базовым доменом и буквой дают одно имя записи:
+        # желаемые IP таких доменов объединяем, иначе они удаляли бы записи друг друга
+        name = f"d{inbound_letter}.{get_base_domain(domain)}"
+        targets = zones.setdefault(zone_id, {}).setdefault(name, {})
+        for ip in ips:
+            targets.setdefault(ip, (inbound_letter, domain))
+    for zone_id, names in zones.items():
+        try:
+            index = await cloudflare_cache.get_zone_records(zone_id, force=True)
+        except Exception as e:
+            summary["failed"].append({"zone_id": zone_id, "error": str(e)})
+            continue
+        for name, targets in names.items():
+            domain = next(iter(targets.values()))[1]
+            seen = set()
+            for record in index["by_name"].get(name, []):
+                if record['content'] in targets and record['content'] not in seen:
+                    seen.add(record['content'])
+                    summary["unchanged"] += 1
+                else:
+                    plan_deletes.setdefault(zone_id, []).append((record, domain))
+            plan_creates.setdefault(zone_id, []).extend((ip, *target) for ip, target in targets.items() if ip not in seen)
+
+    semaphore = asyncio.Semaphore(int(os.getenv('DNS_RECONCILE_CONCURRENCY', '5')))
+    batch_size = int(os.getenv('CLOUDFLARE_BATCH_SIZE', '200'))
+
+    async def apply_create(ip, inbound_letter, domain):
+        async with semaphore:
+            try:
+                await create_dns_record(ip, inbound_letter, ttl, domain)
+                summary["created"].append({"ip": ip, "inbound_letter": inbound_letter, "domain": domain})
+            except Exception as e:
+                summary["failed"].append({"ip": ip, "action": "create", "error": str(e)})
+
+    async def apply_delete(record, domain):
+        async with semaphore:
+            try:
+                await delete_dns_record(record['id'], domain)
+                summary["deleted"].append({"ip": record['content'], "name": record['name']})
+            except Exception as e:
+                summary["failed"].append({"ip": record['content'], "action": "delete", "error": str(e)})
+
+    async def apply_batch(zone_id, creates, deletes):
+        async with semaphore:
+            try:
+                result = await cloudflare_client.batch(
+                    zone_id,
+                    posts=[_record_payload(ip, inbound_letter, ttl) for ip, inbound_letter, _ in creates],
+                    deletes=[record['id'] for record, _ in deletes]
+                )
+            except CloudflareError as e:
+                logger.warning(f"Batch DNS update for zone {zone_id} failed, falling back to single requests: {str(e)}")
+                return False
+        for record in result.get('posts') or []:
+            cloudflare_cache.record_created(zone_id, record)
+        for record, _ in deletes:
+            cloudflare_cache.record_deleted(zone_id, record['id'])
+            summary["deleted"].append({"ip": record['content'], "name": record['name']})
+        summary["created"].extend({"ip": ip, "inbound_letter": inbound_letter, "domain": domain} for ip, inbound_letter, domain in creates)
+        return True
+
+    async def apply_zone(zone_id, creates, deletes):
+        # Пачка атомарна: при ошибке повторяем её изменения поштучно
+        for start in range(0, max(len(creates), len(deletes)), batch_size):
+            chunk_creates = creates[start:start + batch_size]
+            chunk_deletes = deletes[start:start + batch_size]
+            if await apply_batch(zone_id, chunk_creates, chunk_deletes):
+                continue
+            await asyncio.gather(
+                *(apply_create(*create) for create in chunk_creates),
+                *(apply_delete(*delete) for delete in chunk_deletes)
+            )
+
+    await asyncio.gather(*(
+        apply_zone(zone_id, plan_creates.get(zone_id, []), plan_deletes.get(zone_id, []))
+        for zone_id in set(plan_creates) | set(plan_deletes)
+    ))
+    logger.info(f"DNS reconcile: created={len(summary['created'])}, deleted={len(summary['deleted'])}, unchanged={summary['unchanged']}, failed={len(summary['failed'])}")
+    return summary
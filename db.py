@@ -1,9 +1,12 @@
+import asyncio
 import asyncpg
+import json
 import logging
 import os
+import time
 import traceback
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
 
 load_dotenv()
 logger = logging.getLogger(__name__)
@@ -14,83 +17,581 @@ DB_PASSWORD = os.getenv('LOCAL_DB_PASSWORD')
 DB_HOST = os.getenv('LOCAL_DB_HOST', 'localhost')
 DB_PORT = os.getenv('LOCAL_DB_PORT', '5432')
 
+# Горячие запросы держим в константах: asyncpg кэширует подготовленные
+# выражения по тексту запроса на каждом соединении пула
+SELECT_VLESS_KEYS = "SELECT inbound_tag, serverName, vless_key, domain FROM vless_keys"
+SELECT_VLESS_KEY = "SELECT inbound_tag, serverName, vless_key, domain FROM vless_keys WHERE inbound_tag = $1"
+UPSERT_VLESS_KEY = """
+    INSERT INTO vless_keys (inbound_tag, serverName, vless_key, domain)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (inbound_tag)
+    DO UPDATE SET serverName = $2, vless_key = $3, domain = $4
+"""
+SYNC_VLESS_KEYS = """
+    INSERT INTO vless_keys (inbound_tag, serverName, vless_key, domain)
+    SELECT * FROM unnest($1::text[], $2::text[], $3::text[], $4::text[])
+    ON CONFLICT (inbound_tag) DO UPDATE
+    SET serverName = EXCLUDED.serverName, vless_key = EXCLUDED.vless_key, domain = EXCLUDED.domain
+    WHERE (vless_keys.serverName, vless_keys.vless_key, vless_keys.domain)
+        IS DISTINCT FROM (EXCLUDED.serverName, EXCLUDED.vless_key, EXCLUDED.domain)
+    RETURNING (xmax = 0) AS inserted
+"""
+DELETE_STALE_VLESS_KEYS = "DELETE FROM vless_keys WHERE NOT (inbound_tag = ANY($1::text[]))"
+UPSERT_SERVER = """
+    INSERT INTO servers (ip, inbound_tag, install_date)
+    VALUES ($1, $2, CURRENT_TIMESTAMP)
+    ON CONFLICT (ip) DO UPDATE
+    SET inbound_tag = $2, install_date = CURRENT_TIMESTAMP
+"""
+SELECT_SERVERS = "SELECT ip, inbound_tag, install_date FROM servers"
+DELETE_SERVER = "DELETE FROM servers WHERE ip = $1"
+# Изменения servers рассылаются всем процессам через NOTIFY, на них держится реестр в памяти
+SERVERS_CHANNEL = 'servers_changed'
+NOTIFY_SERVERS_FUNCTION = """
+    CREATE OR REPLACE FUNCTION notify_servers_changed() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'TRUNCATE' THEN
+            PERFORM pg_notify('servers_changed', json_build_object('op', 'reload')::text);
+            RETURN NULL;
+        END IF;
+        IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND OLD.ip IS DISTINCT FROM NEW.ip) THEN
+            PERFORM pg_notify('servers_changed', json_build_object('op', 'delete', 'ip', OLD.ip)::text);
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            PERFORM pg_notify('servers_changed', json_build_object(
+                'op', 'upsert', 'ip', NEW.ip, 'inbound_tag', NEW.inbound_tag, 'install_date', NEW.install_date
+            )::text);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+INSERT_SERVER_EVENT = """
+    INSERT INTO server_events (server_ip, event_type, event_time, duration_seconds)
+    VALUES ($1, $2, $3, $4)
+"""
+SERVER_EVENT_COLUMNS = ['server_ip', 'event_type', 'event_time', 'duration_seconds']
+# event_type хранится в server_events как SMALLINT
+EVENT_TYPE_CODES = {'online': 1, 'offline_start': 2, 'offline_end': 3}
+EVENT_TYPE_NAMES = {code: name for name, code in EVENT_TYPE_CODES.items()}
+SELECT_SERVER_EVENTS = '''
+    SELECT id, server_ip, event_type, event_time, duration_seconds
+    FROM server_events
+    WHERE event_time >= NOW() - INTERVAL '1 hour' * $1
+    ORDER BY event_time DESC LIMIT $2
+'''
+SELECT_SERVER_EVENTS_BY_IP = '''
+    SELECT id, server_ip, event_type, event_time, duration_seconds
+    FROM server_events
+    WHERE event_time >= NOW() - INTERVAL '1 hour' * $1
+    AND server_ip = CAST($2 AS TEXT)
+    ORDER BY event_time DESC LIMIT $3
+'''
+UPSERT_UPTIME_BUCKETS = """
+    INSERT INTO {table} AS r (server_ip, bucket_start, offline_seconds, events)
+    SELECT * FROM unnest($1::text[], $2::timestamp[], $3::int[], $4::int[])
+    ON CONFLICT (server_ip, bucket_start) DO UPDATE
+    SET offline_seconds = r.offline_seconds + EXCLUDED.offline_seconds,
+        events = r.events + EXCLUDED.events
+"""
+# Пачка содержала конец простоя: состояние сервера перезаписывается
+UPSERT_UPTIME_STATE_RESET = """
+    INSERT INTO server_uptime_state AS st (server_ip, offline_since, last_event_time)
+    SELECT * FROM unnest($1::text[], $2::timestamp[], $3::timestamp[])
+    ON CONFLICT (server_ip) DO UPDATE
+    SET offline_since = EXCLUDED.offline_since, last_event_time = EXCLUDED.last_event_time
+"""
+# Только начала простоя: сохраняем более раннее offline_since
+UPSERT_UPTIME_STATE_KEEP = """
+    INSERT INTO server_uptime_state AS st (server_ip, offline_since, last_event_time)
+    SELECT * FROM unnest($1::text[], $2::timestamp[], $3::timestamp[])
+    ON CONFLICT (server_ip) DO UPDATE
+    SET offline_since = COALESCE(st.offline_since, EXCLUDED.offline_since), last_event_time = EXCLUDED.last_event_time
+"""
+SELECT_UPTIME_SUMMARY = """
+    SELECT s.ip, COALESCE(r.offline_seconds, 0) AS offline_seconds, COALESCE(r.events, 0) AS events,
+           st.offline_since, st.last_event_time
+    FROM servers s
+    LEFT JOIN (
+        SELECT server_ip, SUM(offline_seconds) AS offline_seconds, SUM(events) AS events
+        FROM {table}
+        WHERE bucket_start >= $1
+        GROUP BY server_ip
+    ) r ON r.server_ip = s.ip
+    LEFT JOIN server_uptime_state st ON st.server_ip = s.ip
+"""
+UPTIME_ROLLUPS = {
+    'server_uptime_hourly': timedelta(hours=1),
+    'server_uptime_daily': timedelta(days=1)
+}
+
+# Очередь заданий: задачи забираются воркерами через SKIP LOCKED,
+# выполняющиеся задачи держат аренду (locked_at), которую продлевает владелец
+# Задание может раскатываться волнами: воркеры берут только задачи текущей волны,
+# а переход к следующей выполняет процесс, захвативший завершённую волну.
+# Последняя волна проверяется так же и переводит current_wave в waves
+INSERT_JOB = "INSERT INTO jobs (kind, params, waves) VALUES ($1, $2::jsonb, $3) RETURNING id"
+INSERT_JOB_TASKS = """
+    INSERT INTO job_tasks (job_id, ip, max_attempts, wave)
+    SELECT $1, ip, $3, (ord - 1) / $4 FROM unnest($2::text[]) WITH ORDINALITY AS u(ip, ord)
+"""
+LOCK_JOB = "SELECT id FROM jobs WHERE id = $1 FOR UPDATE"
+CLAIM_JOB_TASK = """
+    UPDATE job_tasks t
+    SET status = 'running', attempts = t.attempts + 1, locked_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+    FROM jobs j
+    WHERE t.id = (
+        SELECT jt.id FROM job_tasks jt
+        JOIN jobs jj ON jj.id = jt.job_id
+        WHERE jt.status IN ('queued', 'retrying') AND jt.run_after <= CURRENT_TIMESTAMP AND jj.kind = ANY($1::text[])
+          AND jt.wave <= jj.current_wave
+        ORDER BY jt.run_after, jt.id
+        LIMIT 1
+        FOR UPDATE OF jt SKIP LOCKED
+    ) AND j.id = t.job_id
+    RETURNING t.id, t.job_id, t.ip, t.attempts, t.max_attempts, j.kind, j.params, j.waves
+"""
+FINISH_JOB_TASK = """
+    UPDATE job_tasks
+    SET status = $2, message = $3, locked_at = NULL, updated_at = CURRENT_TIMESTAMP,
+        run_after = CURRENT_TIMESTAMP + make_interval(secs => $4)
+    WHERE id = $1
+"""
+REFRESH_JOB_STATUS = """
+    WITH counts AS (
+        SELECT count(*) AS total,
+               count(*) FILTER (WHERE status IN ('queued', 'retrying', 'running')) AS pending,
+               count(*) FILTER (WHERE status IN ('failed', 'unhealthy')) AS failed,
+               count(*) FILTER (WHERE status = 'cancelled') AS cancelled
+        FROM job_tasks WHERE job_id = $1
+    ), next AS (
+        SELECT CASE
+            WHEN counts.pending > 0 THEN 'running'
+            WHEN counts.cancelled > 0 THEN 'aborted'
+            -- Раскатка завершается только после проверки последней волны
+            WHEN j.params ? 'rollout' AND j.current_wave < j.waves THEN 'running'
+            WHEN counts.failed = 0 THEN 'succeeded'
+            WHEN counts.failed = counts.total THEN 'failed'
+            ELSE 'partial'
+        END AS status
+        FROM counts, jobs j
+        WHERE j.id = $1
+    )
+    UPDATE jobs SET
+        status = next.status,
+        updated_at = CURRENT_TIMESTAMP,
+        finished_at = CASE WHEN next.status = 'running' THEN NULL ELSE CURRENT_TIMESTAMP END
+    FROM next
+    WHERE jobs.id = $1
+    RETURNING jobs.status
+"""
+RENEW_JOB_TASK_LEASES = "UPDATE job_tasks SET locked_at = CURRENT_TIMESTAMP WHERE id = ANY($1::bigint[]) AND status = 'running'"
+RECOVER_JOB_TASKS = """
+    UPDATE job_tasks
+    SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'retrying' END,
+        message = 'Worker lost while running task', locked_at = NULL, updated_at = CURRENT_TIMESTAMP
+    WHERE status = 'running' AND locked_at < CURRENT_TIMESTAMP - make_interval(secs => $1)
+    RETURNING job_id
+"""
+CLAIM_JOB_WAVE = """
+    UPDATE jobs SET locked_at = CURRENT_TIMESTAMP
+    WHERE id = (
+        SELECT j.id FROM jobs j
+        WHERE j.status IN ('queued', 'running') AND j.params ? 'rollout' AND j.current_wave < j.waves
+          AND (j.locked_at IS NULL OR j.locked_at < CURRENT_TIMESTAMP - make_interval(secs => $1))
+          AND NOT EXISTS (
+              SELECT 1 FROM job_tasks t
+              WHERE t.job_id = j.id AND t.wave = j.current_wave AND t.status IN ('queued', 'retrying', 'running')
+          )
+        ORDER BY j.id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, kind, params, current_wave, waves
+"""
+RENEW_JOB_WAVE_LEASES = "UPDATE jobs SET locked_at = CURRENT_TIMESTAMP WHERE id = ANY($1::bigint[])"
+SELECT_JOB_WAVE_TASKS = """
+    SELECT ip, status, wave, EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - updated_at)::float8 AS finished_ago
+    FROM job_tasks WHERE job_id = $1 AND wave <= $2 ORDER BY id
+"""
+MARK_JOB_TASKS_UNHEALTHY = """
+    UPDATE job_tasks SET status = 'unhealthy', message = $3, updated_at = CURRENT_TIMESTAMP
+    WHERE job_id = $1 AND ip = ANY($2::text[]) AND status = 'succeeded'
+"""
+ADVANCE_JOB_WAVE = """
+    UPDATE jobs SET current_wave = current_wave + 1, locked_at = NULL, updated_at = CURRENT_TIMESTAMP
+    WHERE id = $1 AND current_wave = $2
+"""
+CANCEL_JOB_TASKS = """
+    UPDATE job_tasks SET status = 'cancelled', message = $2, updated_at = CURRENT_TIMESTAMP
+    WHERE job_id = $1 AND status IN ('queued', 'retrying')
+"""
+SELECT_JOB = """
+    SELECT id, kind, params, status, current_wave, waves, created_at, updated_at, finished_at
+    FROM jobs WHERE id = $1
+"""
+SELECT_JOB_TASKS = """
+    SELECT ip, status, wave, attempts, max_attempts, message, updated_at
+    FROM job_tasks WHERE job_id = $1 ORDER BY id
+"""
+PRUNE_JOBS = "DELETE FROM jobs WHERE finished_at < CURRENT_TIMESTAMP - make_interval(days => $1)"
+# Живые события заданий (старт, вывод, итог) пересылаются между процессами
+# через NOTIFY: SSE-клиент может быть подключён не к тому воркеру, что выполняет задачу
+JOB_EVENTS_CHANNEL = 'job_events'
+NOTIFY_JOB_EVENT = "SELECT pg_notify($1, $2)"
+
+INIT_DB_LOCK_ID = int(os.getenv('INIT_DB_LOCK_ID', '342000'))
+# Перезапуск Xray Checker общий для всех воркеров: его время и окно тишины хранятся в одной строке
+CHECKER_RESTART_LOCK_ID = int(os.getenv('CHECKER_RESTART_LOCK_ID', '342002'))
+EXTEND_CHECKER_GRACE = """
+    UPDATE checker_state
+    SET grace_until = GREATEST(COALESCE(grace_until, '-infinity'), clock_timestamp()::timestamp + make_interval(secs => $1))
+    WHERE id = 1
+"""
+SELECT_CHECKER_GRACE = "SELECT grace_until > clock_timestamp()::timestamp FROM checker_state WHERE id = 1"
+SELECT_CHECKER_RESTART = "SELECT restart_started_at, restart_result FROM checker_state WHERE id = 1"
+START_CHECKER_RESTART = "UPDATE checker_state SET restart_started_at = clock_timestamp()::timestamp, restart_result = NULL WHERE id = 1"
+FINISH_CHECKER_RESTART = "UPDATE checker_state SET restart_result = $1 WHERE id = 1"
+SELECT_UPTIME_STATES = "SELECT server_ip, offline_since, last_event_time FROM server_uptime_state"
+
+_pool = None
+
+async def create_pool():
+    """Создаёт пул соединений; размеры, кэш выражений и таймауты берутся из .env."""
+    return await asyncpg.create_pool(
+        database=DB_DBNAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        host=DB_HOST,
+        port=int(DB_PORT),
+        min_size=int(os.getenv('DB_POOL_MIN_SIZE', '1')),
+        max_size=int(os.getenv('DB_POOL_MAX_SIZE', '10')),
+        statement_cache_size=int(os.getenv('DB_STATEMENT_CACHE_SIZE', '100')),
+        command_timeout=float(os.getenv('DB_COMMAND_TIMEOUT', '30')),
+        max_inactive_connection_lifetime=float(os.getenv('DB_POOL_MAX_IDLE', '300'))
+    )
+
+async def create_connection():
+    """Отдельное соединение вне пула — для LISTEN, который держит соединение всё время работы."""
+    return await asyncpg.connect(
+        database=DB_DBNAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        host=DB_HOST,
+        port=int(DB_PORT),
+        command_timeout=float(os.getenv('DB_COMMAND_TIMEOUT', '30'))
+    )
+
+def set_pool(pool):
+    global _pool
+    _pool = pool
+
+def get_pool():
+    if _pool is None:
+        raise RuntimeError("Database pool is not initialized")
+    return _pool
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
 async def init_db():
     try:
-        conn = await asyncpg.connect(
-            database=DB_DBNAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
-        table_exists = await conn.fetchval(
-            "SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = 'servers')"
-        )
-        if not table_exists:
-            await conn.execute('''
-                CREATE TABLE servers (
-                    ip TEXT PRIMARY KEY,
-                    inbound_tag TEXT NOT NULL,
-                    install_date TIMESTAMP
+        async with get_pool().acquire() as conn:
+            # Воркеры стартуют одновременно: схему создаёт один из них, остальные ждут
+            await conn.execute('SELECT pg_advisory_lock($1)', INIT_DB_LOCK_ID)
+            try:
+                table_exists = await conn.fetchval(
+                    "SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = 'servers')"
                 )
-            ''')
-            logger.info("Created servers table")
-        
-        table_exists = await conn.fetchval(
-            "SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = 'server_events')"
-        )
-        if not table_exists:
-            await conn.execute('''
-                CREATE TABLE server_events (
-                    id SERIAL PRIMARY KEY,
-                    server_ip TEXT REFERENCES servers(ip) ON DELETE CASCADE,
-                    event_type TEXT NOT NULL,
-                    event_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    duration_seconds INTEGER,
-                    CHECK (event_type IN ('online', 'offline_start', 'offline_end'))
+                if not table_exists:
+                    await conn.execute('''
+                        CREATE TABLE servers (
+                            ip TEXT PRIMARY KEY,
+                            inbound_tag TEXT NOT NULL,
+                            install_date TIMESTAMP
+                        )
+                    ''')
+                    logger.info("Created servers table")
+
+                table_exists = await conn.fetchval(
+                    "SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = 'server_events')"
                 )
-            ''')
-            logger.info("Created server_events table")
-        
-        table_exists = await conn.fetchval(
-            "SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = 'vless_keys')"
-        )
-        if not table_exists:
-            await conn.execute('''
-                CREATE TABLE vless_keys (
-                    inbound_tag TEXT PRIMARY KEY,
-                    serverName TEXT NOT NULL,
-                    vless_key TEXT NOT NULL,
-                    domain TEXT NOT NULL
+                is_partitioned = await conn.fetchval(
+                    "SELECT EXISTS (SELECT FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = 'server_events')"
                 )
-            ''')
-            logger.info("Created vless_keys table")
-        else:
-            column_exists = await conn.fetchval(
-                "SELECT EXISTS (SELECT FROM information_schema.columns WHERE table_name = 'vless_keys' AND column_name = 'domain')"
-            )
-            if not column_exists:
-                await conn.execute('ALTER TABLE vless_keys ADD COLUMN domain TEXT NOT NULL DEFAULT \'\'')
-                logger.info("Added domain column to vless_keys")
-        
-        await conn.execute('DROP TABLE IF EXISTS inbounds')
+                if not table_exists:
+                    async with conn.transaction():
+                        await create_server_events_table(conn)
+                    logger.info("Created server_events table")
+                elif not is_partitioned:
+                    await migrate_server_events(conn)
+                await ensure_event_partitions(conn)
+
+                table_exists = await conn.fetchval(
+                    "SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = 'server_events_summary')"
+                )
+                if not table_exists:
+                    await conn.execute('''
+                        CREATE TABLE server_events_summary (
+                            server_ip TEXT REFERENCES servers(ip) ON DELETE CASCADE,
+                            day DATE NOT NULL,
+                            event_type SMALLINT NOT NULL,
+                            events INTEGER NOT NULL,
+                            duration_seconds BIGINT NOT NULL DEFAULT 0,
+                            PRIMARY KEY (server_ip, day, event_type)
+                        )
+                    ''')
+                    logger.info("Created server_events_summary table")
+
+                table_exists = await conn.fetchval(
+                    "SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = 'vless_keys')"
+                )
+                if not table_exists:
+                    await conn.execute('''
+                        CREATE TABLE vless_keys (
+                            inbound_tag TEXT PRIMARY KEY,
+                            serverName TEXT NOT NULL,
+                            vless_key TEXT NOT NULL,
+                            domain TEXT NOT NULL
+                        )
+                    ''')
+                    logger.info("Created vless_keys table")
+                else:
+                    column_exists = await conn.fetchval(
+                        "SELECT EXISTS (SELECT FROM information_schema.columns WHERE table_name = 'vless_keys' AND column_name = 'domain')"
+                    )
+                    if not column_exists:
+                        await conn.execute('ALTER TABLE vless_keys ADD COLUMN domain TEXT NOT NULL DEFAULT \'\'')
+                        logger.info("Added domain column to vless_keys")
+
+                table_exists = await conn.fetchval(
+                    "SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = 'server_uptime_state')"
+                )
+                if not table_exists:
+                    for table in UPTIME_ROLLUPS:
+                        await conn.execute(f'''
+                            CREATE TABLE {table} (
+                                server_ip TEXT REFERENCES servers(ip) ON DELETE CASCADE,
+                                bucket_start TIMESTAMP NOT NULL,
+                                offline_seconds INTEGER NOT NULL DEFAULT 0,
+                                events INTEGER NOT NULL DEFAULT 0,
+                                PRIMARY KEY (server_ip, bucket_start)
+                            )
+                        ''')
+                        await conn.execute(f'CREATE INDEX {table}_bucket_idx ON {table} (bucket_start)')
+                    await conn.execute('''
+                        CREATE TABLE server_uptime_state (
+                            server_ip TEXT PRIMARY KEY REFERENCES servers(ip) ON DELETE CASCADE,
+                            offline_since TIMESTAMP,
+                            last_event_time TIMESTAMP
+                        )
+                    ''')
+                    logger.info("Created uptime rollup tables")
+                    await backfill_uptime_rollups(conn)
+
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS jobs (
+                        id BIGSERIAL PRIMARY KEY,
+                        kind TEXT NOT NULL,
+                        params JSONB NOT NULL DEFAULT '{}',
+                        status TEXT NOT NULL DEFAULT 'queued',
+                        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                        finished_at TIMESTAMP,
+                        current_wave INT NOT NULL DEFAULT 0,
+                        waves INT NOT NULL DEFAULT 1,
+                        locked_at TIMESTAMP
+                    )
+                ''')
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS job_tasks (
+                        id BIGSERIAL PRIMARY KEY,
+                        job_id BIGINT NOT NULL REFERENCES jobs(id) ON DELETE CASCADE,
+                        ip TEXT NOT NULL,
+                        status TEXT NOT NULL DEFAULT 'queued',
+                        attempts SMALLINT NOT NULL DEFAULT 0,
+                        max_attempts SMALLINT NOT NULL DEFAULT 1,
+                        run_after TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                        locked_at TIMESTAMP,
+                        message TEXT,
+                        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                        wave INT NOT NULL DEFAULT 0
+                    )
+                ''')
+                column_exists = await conn.fetchval(
+                    "SELECT EXISTS (SELECT FROM information_schema.columns WHERE table_name = 'job_tasks' AND column_name = 'wave')"
+                )
+                if not column_exists:
+                    await conn.execute('ALTER TABLE jobs ADD COLUMN current_wave INT NOT NULL DEFAULT 0, ADD COLUMN waves INT NOT NULL DEFAULT 1, ADD COLUMN locked_at TIMESTAMP')
+                    await conn.execute('ALTER TABLE job_tasks ADD COLUMN wave INT NOT NULL DEFAULT 0')
+                    logger.info("Added rollout wave columns to jobs")
+                await conn.execute('CREATE INDEX IF NOT EXISTS idx_job_tasks_job ON job_tasks (job_id)')
+                await conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_job_tasks_ready ON job_tasks (run_after) WHERE status IN ('queued', 'retrying')"
+                )
+
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS checker_state (
+                        id INT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+                        restart_started_at TIMESTAMP,
+                        restart_result BOOLEAN,
+                        grace_until TIMESTAMP
+                    )
+                ''')
+                await conn.execute('INSERT INTO checker_state (id) VALUES (1) ON CONFLICT DO NOTHING')
+
+                await conn.execute(NOTIFY_SERVERS_FUNCTION)
+                trigger_exists = await conn.fetchval(
+                    "SELECT EXISTS (SELECT FROM pg_trigger WHERE tgname = 'servers_notify')"
+                )
+                if not trigger_exists:
+                    await conn.execute('''
+                        CREATE TRIGGER servers_notify AFTER INSERT OR UPDATE OR DELETE ON servers
+                        FOR EACH ROW EXECUTE PROCEDURE notify_servers_changed()
+                    ''')
+                    await conn.execute('''
+                        CREATE TRIGGER servers_notify_truncate AFTER TRUNCATE ON servers
+                        FOR EACH STATEMENT EXECUTE PROCEDURE notify_servers_changed()
+                    ''')
+                    logger.info("Created servers change notification triggers")
+
+                await conn.execute('DROP TABLE IF EXISTS inbounds')
+            finally:
+                await conn.execute('SELECT pg_advisory_unlock($1)', INIT_DB_LOCK_ID)
         logger.info("Database initialized successfully")
-        await conn.close()
     except Exception as e:
         logger.error(f"Failed to initialize database: {str(e)}\n{traceback.format_exc()}")
         raise
 
+def _add_months(moment, months):
+    month_index = moment.year * 12 + moment.month - 1 + months
+    return datetime(month_index // 12, month_index % 12 + 1, 1)
+
+def _partition_name(month_start):
+    return f"server_events_{month_start.year}_{month_start.month:02d}"
+
+async def create_server_events_table(conn):
+    await conn.execute('''
+        CREATE TABLE server_events (
+            id BIGSERIAL,
+            server_ip TEXT REFERENCES servers(ip) ON DELETE CASCADE,
+            event_type SMALLINT NOT NULL,
+            event_time TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            duration_seconds INTEGER,
+            PRIMARY KEY (id, event_time),
+            CHECK (event_type IN (1, 2, 3))
+        ) PARTITION BY RANGE (event_time)
+    ''')
+    await conn.execute('CREATE INDEX server_events_ip_time_idx ON server_events (server_ip, event_time DESC)')
+    await conn.execute('CREATE INDEX server_events_time_brin_idx ON server_events USING BRIN (event_time)')
+
+async def ensure_event_partitions(conn, since=None):
+    """Создаёт месячные партиции server_events от since (или текущего месяца) с запасом вперёд.
+
+    Партиция по умолчанию принимает события, для месяца которых партиции ещё нет
+    (например, если обслуживание долго не запускалось); при создании месячной
+    партиции её строки переносятся из партиции по умолчанию.
+    """
+    await conn.execute('CREATE TABLE IF NOT EXISTS server_events_default PARTITION OF server_events DEFAULT')
+    months_ahead = int(os.getenv('EVENT_PARTITIONS_AHEAD', '2'))
+    month_start = _add_months(since or datetime.utcnow(), 0)
+    last_month = _add_months(datetime.utcnow(), months_ahead)
+    while month_start <= last_month:
+        next_month = _add_months(month_start, 1)
+        name = _partition_name(month_start)
+        if not await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", name):
+            async with conn.transaction():
+                await conn.execute(f'''
+                    CREATE TEMP TABLE {name}_moved ON COMMIT DROP AS
+                    WITH moved AS (
+                        DELETE FROM server_events_default
+                        WHERE event_time >= '{month_start.isoformat()}' AND event_time < '{next_month.isoformat()}'
+                        RETURNING *
+                    )
+                    SELECT * FROM moved
+                ''')
+                await conn.execute(
+                    f"CREATE TABLE {name} PARTITION OF server_events "
+                    f"FOR VALUES FROM ('{month_start.isoformat()}') TO ('{next_month.isoformat()}')"
+                )
+                moved = await conn.execute(f"INSERT INTO server_events SELECT * FROM {name}_moved")
+            logger.info(f"Created partition {name}, moved from default: {moved}")
+        month_start = next_month
+
+async def migrate_server_events(conn):
+    """Переносит старую непартиционированную server_events с текстовым event_type в новую схему."""
+    async with conn.transaction():
+        await conn.execute('ALTER TABLE server_events RENAME TO server_events_legacy')
+        await conn.execute('ALTER INDEX IF EXISTS server_events_pkey RENAME TO server_events_legacy_pkey')
+        await conn.execute('ALTER SEQUENCE IF EXISTS server_events_id_seq RENAME TO server_events_legacy_id_seq')
+        await create_server_events_table(conn)
+        oldest = await conn.fetchval('SELECT MIN(event_time) FROM server_events_legacy')
+        await ensure_event_partitions(conn, since=oldest)
+        result = await conn.execute('''
+            INSERT INTO server_events (server_ip, event_type, event_time, duration_seconds)
+            SELECT server_ip,
+                   CASE event_type WHEN 'online' THEN 1 WHEN 'offline_start' THEN 2 ELSE 3 END,
+                   event_time, duration_seconds
+            FROM server_events_legacy
+            WHERE event_time IS NOT NULL
+        ''')
+        await conn.execute('DROP TABLE server_events_legacy')
+    logger.info(f"Migrated server_events to monthly partitions: {result}")
+
+async def run_event_retention():
+    """Сворачивает устаревшие партиции server_events в server_events_summary и удаляет их."""
+    retention_months = int(os.getenv('EVENT_RETENTION_MONTHS', '6'))
+    hourly_retention_days = int(os.getenv('UPTIME_HOURLY_RETENTION_DAYS', '35'))
+    daily_retention_days = int(os.getenv('UPTIME_DAILY_RETENTION_DAYS', '400'))
+    cutoff = _add_months(datetime.utcnow(), -retention_months)
+    try:
+        async with get_pool().acquire() as conn:
+            await ensure_event_partitions(conn)
+            partitions = await conn.fetch('''
+                SELECT c.relname FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                JOIN pg_class p ON p.oid = i.inhparent
+                WHERE p.relname = 'server_events'
+            ''')
+            for row in sorted(partitions, key=lambda r: r['relname']):
+                name = row['relname']
+                try:
+                    year, month = (int(part) for part in name.rsplit('_', 2)[1:])
+                except ValueError:
+                    continue
+                if _add_months(datetime(year, month, 1), 1) > cutoff:
+                    continue
+                async with conn.transaction():
+                    summarized = await conn.execute(f'''
+                        INSERT INTO server_events_summary AS s (server_ip, day, event_type, events, duration_seconds)
+                        SELECT server_ip, event_time::date, event_type, COUNT(*), COALESCE(SUM(duration_seconds), 0)
+                        FROM {name}
+                        WHERE server_ip IS NOT NULL
+                        GROUP BY server_ip, event_time::date, event_type
+                        ON CONFLICT (server_ip, day, event_type) DO UPDATE
+                        SET events = s.events + EXCLUDED.events, duration_seconds = s.duration_seconds + EXCLUDED.duration_seconds
+                    ''')
+                    await conn.execute(f'DROP TABLE {name}')
+                logger.info(f"Downsampled and dropped partition {name}: {summarized}")
+            pruned = await conn.execute(
+                "DELETE FROM server_uptime_hourly WHERE bucket_start < $1",
+                datetime.utcnow() - timedelta(days=hourly_retention_days)
+            )
+            pruned_daily = await conn.execute(
+                "DELETE FROM server_uptime_daily WHERE bucket_start < $1",
+                datetime.utcnow() - timedelta(days=daily_retention_days)
+            )
+            logger.info(f"Event retention finished, pruned hourly rollups: {pruned}, daily rollups: {pruned_daily}")
+    except Exception as e:
+        logger.error(f"Event retention failed: {str(e)}\n{traceback.format_exc()}")
+
 async def get_vless_keys():
     try:
-        conn = await asyncpg.connect(
-            database=DB_DBNAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
-        rows = await conn.fetch("SELECT inbound_tag, serverName, vless_key, domain FROM vless_keys")
-        await conn.close()
+        async with get_pool().acquire() as conn:
+            rows = await conn.fetch(SELECT_VLESS_KEYS)
         return [{"inbound_tag": row['inbound_tag'], "serverName": row['servername'], "vless_key": row['vless_key'], "domain": row['domain']} for row in rows]
     except Exception as e:
         logger.error(f"Failed to fetch vless keys: {str(e)}\n{traceback.format_exc()}")
@@ -98,15 +599,8 @@ async def get_vless_keys():
 
 async def get_vless_key(inbound_tag):
     try:
-        conn = await asyncpg.connect(
-            database=DB_DBNAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
-        row = await conn.fetchrow("SELECT inbound_tag, serverName, vless_key, domain FROM vless_keys WHERE inbound_tag = $1", inbound_tag)
-        await conn.close()
+        async with get_pool().acquire() as conn:
+            row = await conn.fetchrow(SELECT_VLESS_KEY, inbound_tag)
         if row:
             return {"inbound_tag": row['inbound_tag'], "serverName": row['servername'], "vless_key": row['vless_key'], "domain": row['domain']}
         return None
@@ -116,46 +610,52 @@ async def get_vless_key(inbound_tag):
 
 async def update_vless_key(inbound_tag, serverName, vless_key, domain):
     try:
-        conn = await asyncpg.connect(
-            database=DB_DBNAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
-        await conn.execute(
-            """
-            INSERT INTO vless_keys (inbound_tag, serverName, vless_key, domain)
-            VALUES ($1, $2, $3, $4)
-            ON CONFLICT (inbound_tag)
-            DO UPDATE SET serverName = $2, vless_key = $3, domain = $4
-            """,
-            inbound_tag, serverName, vless_key, domain
-        )
-        await conn.close()
+        async with get_pool().acquire() as conn:
+            await conn.execute(UPSERT_VLESS_KEY, inbound_tag, serverName, vless_key, domain)
     except Exception as e:
         logger.error(f"Failed to update vless key {inbound_tag}: {str(e)}\n{traceback.format_exc()}")
         raise
 
+async def sync_vless_keys(keys):
+    """Синхронизирует таблицу vless_keys с подпиской одной транзакцией.
+
+    Возвращает число добавленных, изменённых, удалённых и неизменных ключей.
+    """
+    # Последний ключ с тем же inbound_tag побеждает, как и при поштучном upsert
+    by_tag = {key['inbound_tag']: key for key in keys}
+    tags = list(by_tag)
+    try:
+        async with get_pool().acquire() as conn:
+            async with conn.transaction():
+                rows = await conn.fetch(
+                    SYNC_VLESS_KEYS,
+                    tags,
+                    [by_tag[tag]['serverName'] for tag in tags],
+                    [by_tag[tag]['vless_key'] for tag in tags],
+                    [by_tag[tag]['domain'] for tag in tags]
+                )
+                # Пустая подписка скорее сбой источника, чем удаление всех локаций
+                removed = 0
+                if tags:
+                    result = await conn.execute(DELETE_STALE_VLESS_KEYS, tags)
+                    removed = int(result.split()[-1])
+        inserted = sum(1 for row in rows if row['inserted'])
+        summary = {
+            "inserted": inserted,
+            "updated": len(rows) - inserted,
+            "removed": removed,
+            "unchanged": len(tags) - len(rows)
+        }
+        logger.info(f"VLESS keys synced: {summary}")
+        return summary
+    except Exception as e:
+        logger.error(f"Failed to sync vless keys: {str(e)}\n{traceback.format_exc()}")
+        raise
+
 async def add_server(ip, inbound_tag):
     try:
-        conn = await asyncpg.connect(
-            database=DB_DBNAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
-        result = await conn.execute(
-            """
-            INSERT INTO servers (ip, inbound_tag, install_date)
-            VALUES ($1, $2, CURRENT_TIMESTAMP)
-            ON CONFLICT (ip) DO UPDATE
-            SET inbound_tag = $2, install_date = CURRENT_TIMESTAMP
-            """,
-            ip, inbound_tag
-        )
-        await conn.close()
+        async with get_pool().acquire() as conn:
+            result = await conn.execute(UPSERT_SERVER, ip, inbound_tag)
         logger.debug(f"Add server {ip} result: {result}")
         return result.startswith('INSERT') or result.startswith('UPDATE')
     except Exception as e:
@@ -164,15 +664,8 @@ async def add_server(ip, inbound_tag):
 
 async def get_servers():
     try:
-        conn = await asyncpg.connect(
-            database=DB_DBNAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
-        rows = await conn.fetch("SELECT ip, inbound_tag, install_date FROM servers")
-        await conn.close()
+        async with get_pool().acquire() as conn:
+            rows = await conn.fetch(SELECT_SERVERS)
         return [(row['ip'], row['inbound_tag'], row['install_date']) for row in rows]
     except Exception as e:
         logger.error(f"Failed to fetch servers: {str(e)}\n{traceback.format_exc()}")
@@ -180,73 +673,420 @@ async def get_servers():
 
 async def delete_server(ip):
     try:
-        conn = await asyncpg.connect(
-            database=DB_DBNAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
-        result = await conn.execute("DELETE FROM servers WHERE ip = $1", ip)
-        await conn.close()
+        async with get_pool().acquire() as conn:
+            result = await conn.execute(DELETE_SERVER, ip)
         logger.debug(f"Delete server {ip} result: {result}")
         return result != 'DELETE 0'
     except Exception as e:
         logger.error(f"Failed to delete server {ip}: {str(e)}\n{traceback.format_exc()}")
         return False
 
-async def log_server_event(server_ip, event_type, duration_seconds=None):
-    try:
-        conn = await asyncpg.connect(
-            database=DB_DBNAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
+async def create_job(kind, params, ips, max_attempts=1, wave_size=None):
+    """Создаёт задание с задачей на каждый IP одной транзакцией и возвращает его id.
+
+    С wave_size задачи делятся на волны по wave_size адресов в порядке ips.
+    """
+    ips = list(dict.fromkeys(ips))
+    wave_size = wave_size or max(len(ips), 1)
+    waves = max(1, -(-len(ips) // wave_size))
+    async with get_pool().acquire() as conn:
+        async with conn.transaction():
+            job_id = await conn.fetchval(INSERT_JOB, kind, json.dumps(params), waves)
+            await conn.execute(INSERT_JOB_TASKS, job_id, ips, max_attempts, wave_size)
+    logger.info(f"Created job {job_id} ({kind}) for {len(ips)} IPs")
+    return job_id
+
+async def claim_job_task(kinds):
+    async with get_pool().acquire() as conn:
+        row = await conn.fetchrow(CLAIM_JOB_TASK, list(kinds))
+    if row is None:
+        return None
+    return {
+        "id": row['id'],
+        "job_id": row['job_id'],
+        "ip": row['ip'],
+        "attempts": row['attempts'],
+        "max_attempts": row['max_attempts'],
+        "kind": row['kind'],
+        "params": json.loads(row['params']),
+        "waves": row['waves']
+    }
+
+async def finish_job_task(task_id, job_id, status, message, retry_delay=0):
+    """Переводит задачу в итоговое состояние (или retrying) и пересчитывает статус задания."""
+    async with get_pool().acquire() as conn:
+        async with conn.transaction():
+            # Завершения задач одного задания идут по очереди, иначе пересчёт статуса видит устаревшие счётчики
+            await conn.fetchval(LOCK_JOB, job_id)
+            await conn.execute(FINISH_JOB_TASK, task_id, status, message, float(retry_delay))
+            return await conn.fetchval(REFRESH_JOB_STATUS, job_id)
+
+async def renew_job_task_leases(task_ids):
+    if task_ids:
+        async with get_pool().acquire() as conn:
+            await conn.execute(RENEW_JOB_TASK_LEASES, list(task_ids))
+
+async def recover_job_tasks(lease_seconds):
+    """Возвращает в очередь задачи, чья аренда истекла: процесс-владелец умер или завис."""
+    async with get_pool().acquire() as conn:
+        async with conn.transaction():
+            rows = await conn.fetch(RECOVER_JOB_TASKS, float(lease_seconds))
+            for job_id in {row['job_id'] for row in rows}:
+                await conn.fetchval(LOCK_JOB, job_id)
+                await conn.fetchval(REFRESH_JOB_STATUS, job_id)
+    if rows:
+        logger.warning(f"Recovered {len(rows)} job tasks with expired leases")
+    return len(rows)
+
+async def get_job(job_id):
+    async with get_pool().acquire() as conn:
+        job = await conn.fetchrow(SELECT_JOB, job_id)
+        if job is None:
+            return None
+        tasks = await conn.fetch(SELECT_JOB_TASKS, job_id)
+    return {
+        "id": job['id'],
+        "kind": job['kind'],
+        "params": json.loads(job['params']),
+        "status": job['status'],
+        "current_wave": job['current_wave'],
+        "waves": job['waves'],
+        "created_at": job['created_at'].isoformat(),
+        "updated_at": job['updated_at'].isoformat(),
+        "finished_at": job['finished_at'].isoformat() if job['finished_at'] else None,
+        "tasks": [
+            {
+                "ip": task['ip'],
+                "status": task['status'],
+                "wave": task['wave'],
+                "attempts": task['attempts'],
+                "max_attempts": task['max_attempts'],
+                "message": task['message'],
+                "updated_at": task['updated_at'].isoformat()
+            } for task in tasks
+        ]
+    }
+
+async def claim_job_wave(lease_seconds):
+    """Захватывает раскатку, у которой завершилась текущая волна и ещё не проверена."""
+    async with get_pool().acquire() as conn:
+        row = await conn.fetchrow(CLAIM_JOB_WAVE, float(lease_seconds))
+    if row is None:
+        return None
+    return {
+        "id": row['id'],
+        "kind": row['kind'],
+        "params": json.loads(row['params']),
+        "current_wave": row['current_wave'],
+        "waves": row['waves']
+    }
+
+async def renew_job_wave_leases(job_ids):
+    if job_ids:
+        async with get_pool().acquire() as conn:
+            await conn.execute(RENEW_JOB_WAVE_LEASES, list(job_ids))
+
+async def get_job_wave_tasks(job_id, wave):
+    """Задачи волн с первой по wave включительно; finished_ago — секунд с последнего изменения задачи."""
+    async with get_pool().acquire() as conn:
+        rows = await conn.fetch(SELECT_JOB_WAVE_TASKS, job_id, wave)
+    return [{"ip": row['ip'], "status": row['status'], "wave": row['wave'], "finished_ago": row['finished_ago']} for row in rows]
+
+async def mark_job_tasks_unhealthy(job_id, ips, message):
+    async with get_pool().acquire() as conn:
+        await conn.execute(MARK_JOB_TASKS_UNHEALTHY, job_id, list(ips), message)
+
+async def advance_job_wave(job_id, wave):
+    """Переходит от проверенной волны к следующей и возвращает статус задания.
+
+    После последней волны статус становится итоговым; None — волну уже продвинул другой процесс.
+    """
+    async with get_pool().acquire() as conn:
+        async with conn.transaction():
+            await conn.fetchval(LOCK_JOB, job_id)
+            result = await conn.execute(ADVANCE_JOB_WAVE, job_id, wave)
+            if result.split()[-1] != '1':
+                return None
+            return await conn.fetchval(REFRESH_JOB_STATUS, job_id)
+
+async def abort_job(job_id, message):
+    """Отменяет ещё не начатые задачи задания и возвращает его итоговый статус."""
+    async with get_pool().acquire() as conn:
+        async with conn.transaction():
+            await conn.fetchval(LOCK_JOB, job_id)
+            await conn.execute(CANCEL_JOB_TASKS, job_id, message)
+            return await conn.fetchval(REFRESH_JOB_STATUS, job_id)
+
+async def extend_checker_grace(seconds):
+    """Продлевает окно, в котором статусы unknown списываются на перезапуск чекера."""
+    async with get_pool().acquire() as conn:
+        await conn.execute(EXTEND_CHECKER_GRACE, float(seconds))
+
+async def is_checker_in_grace():
+    async with get_pool().acquire() as conn:
+        return bool(await conn.fetchval(SELECT_CHECKER_GRACE))
+
+async def run_checker_restart(restart, grace_seconds, lock_timeout=300):
+    """Вызывает restart() под общей для всех процессов блокировкой и возвращает его результат.
+
+    Если другой процесс начал перезапуск уже после этого запроса, он подхватил
+    и наши файлы: повторно не перезапускаем, а отдаём его результат.
+    """
+    async with get_pool().acquire() as conn:
+        requested_at = await conn.fetchval('SELECT clock_timestamp()::timestamp')
+        # Сессионная блокировка без транзакции: отметки о перезапуске сразу видны остальным воркерам
+        # Ждём, пока перезапуск в другом процессе закончится
+        await conn.execute('SELECT pg_advisory_lock($1)', CHECKER_RESTART_LOCK_ID, timeout=lock_timeout)
+        try:
+            row = await conn.fetchrow(SELECT_CHECKER_RESTART)
+            if row['restart_started_at'] is not None and row['restart_started_at'] >= requested_at and row['restart_result'] is not None:
+                logger.info("Xray Checker was already restarted by another worker, skipping")
+                return row['restart_result']
+            await conn.execute(START_CHECKER_RESTART)
+            await conn.execute(EXTEND_CHECKER_GRACE, float(grace_seconds))
+            result = await restart()
+            await conn.execute(FINISH_CHECKER_RESTART, result)
+            await conn.execute(EXTEND_CHECKER_GRACE, float(grace_seconds))
+            return result
+        finally:
+            await conn.execute('SELECT pg_advisory_unlock($1)', CHECKER_RESTART_LOCK_ID)
+
+async def notify_job_events(payloads):
+    """Рассылает пачку событий заданий одним обращением к пулу."""
+    async with get_pool().acquire() as conn:
+        await conn.executemany(NOTIFY_JOB_EVENT, [(JOB_EVENTS_CHANNEL, payload) for payload in payloads])
+
+async def prune_jobs(retention_days):
+    async with get_pool().acquire() as conn:
+        result = await conn.execute(PRUNE_JOBS, int(retention_days))
+    return int(result.split()[-1])
+
+def _bucket_start(moment, step):
+    if step == timedelta(days=1):
+        return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+def compute_uptime_deltas(events):
+    """Раскладывает события по часовым и суточным корзинам: {таблица: {(ip, корзина): [офлайн сек, событий]}}."""
+    deltas = {table: {} for table in UPTIME_ROLLUPS}
+    for server_ip, event_type, event_time, duration_seconds in events:
+        for table, step in UPTIME_ROLLUPS.items():
+            buckets = deltas[table]
+            buckets.setdefault((server_ip, _bucket_start(event_time, step)), [0, 0])[1] += 1
+            if event_type != 'offline_end' or not duration_seconds:
+                continue
+            cursor = event_time - timedelta(seconds=duration_seconds)
+            while cursor < event_time:
+                bucket = _bucket_start(cursor, step)
+                end = min(bucket + step, event_time)
+                buckets.setdefault((server_ip, bucket), [0, 0])[0] += round((end - cursor).total_seconds())
+                cursor = end
+    return deltas
+
+def compute_uptime_states(events):
+    """Итоговое состояние простоя по каждому серверу: (offline_since, last_event_time, был ли конец простоя)."""
+    states = {}
+    for server_ip, event_type, event_time, duration_seconds in events:
+        offline_since, _, reset = states.get(server_ip, (None, None, False))
+        if event_type == 'offline_start':
+            offline_since = offline_since or event_time
+        else:
+            offline_since, reset = None, True
+        states[server_ip] = (offline_since, event_time, reset)
+    return states
+
+async def apply_uptime_rollups(conn, events):
+    for table, buckets in compute_uptime_deltas(events).items():
+        if not buckets:
+            continue
+        keys = list(buckets)
         await conn.execute(
-            """
-            INSERT INTO server_events (server_ip, event_type, duration_seconds)
-            VALUES ($1, $2, $3)
-            """,
-            server_ip, event_type, duration_seconds
+            UPSERT_UPTIME_BUCKETS.format(table=table),
+            [key[0] for key in keys], [key[1] for key in keys],
+            [buckets[key][0] for key in keys], [buckets[key][1] for key in keys]
         )
-        await conn.close()
-        logger.info(f"Logged event for {server_ip}: {event_type}")
+    states = compute_uptime_states(events)
+    for query, reset in ((UPSERT_UPTIME_STATE_RESET, True), (UPSERT_UPTIME_STATE_KEEP, False)):
+        ips = [ip for ip, state in states.items() if state[2] == reset]
+        if ips:
+            await conn.execute(query, ips, [states[ip][0] for ip in ips], [states[ip][1] for ip in ips])
+
+async def backfill_uptime_rollups(conn, chunk_size=5000):
+    """Однократно строит агрегаты из уже накопленных server_events."""
+    total = 0
+    async with conn.transaction():
+        chunk = []
+        async for row in conn.cursor(
+            "SELECT server_ip, event_type, event_time, duration_seconds FROM server_events "
+            "WHERE server_ip IS NOT NULL ORDER BY event_time, id"
+        ):
+            chunk.append((row['server_ip'], EVENT_TYPE_NAMES.get(row['event_type']), row['event_time'], row['duration_seconds']))
+            if len(chunk) >= chunk_size:
+                await apply_uptime_rollups(conn, chunk)
+                total += len(chunk)
+                chunk = []
+        if chunk:
+            await apply_uptime_rollups(conn, chunk)
+            total += len(chunk)
+    logger.info(f"Backfilled uptime rollups from {total} server events")
+
+async def get_uptime_states():
+    """Текущее состояние серверов по журналу событий: {ip: (offline_since, last_event_time)}."""
+    async with get_pool().acquire() as conn:
+        rows = await conn.fetch(SELECT_UPTIME_STATES)
+    return {row['server_ip']: (row['offline_since'], row['last_event_time']) for row in rows}
+
+async def get_uptime_rollups(period_hours):
+    """Офлайн-секунды и число событий за период по каждому серверу из агрегатов."""
+    try:
+        now = datetime.utcnow()
+        table = 'server_uptime_hourly' if period_hours <= 48 else 'server_uptime_daily'
+        step = UPTIME_ROLLUPS[table]
+        window_start = _bucket_start(now, step) - step * (max(1, round(timedelta(hours=period_hours) / step)) - 1)
+        async with get_pool().acquire() as conn:
+            rows = await conn.fetch(SELECT_UPTIME_SUMMARY.format(table=table), window_start)
+        return [{
+            'server_ip': row['ip'],
+            'offline_seconds': row['offline_seconds'],
+            'events': row['events'],
+            'offline_since': row['offline_since'],
+            'last_event_time': row['last_event_time']
+        } for row in rows]
     except Exception as e:
-        logger.error(f"Error logging event for {server_ip}: {str(e)}\n{traceback.format_exc()}")
+        logger.error(f"Error fetching uptime rollups: {str(e)}\n{traceback.format_exc()}")
+        raise
+
+class ServerEventWriter:
+    """Буферизует события серверов в памяти и пишет их пачками через COPY."""
+
+    def __init__(self):
+        self.buffer = []
+        self.batch_size = int(os.getenv('EVENT_BATCH_SIZE', '500'))
+        self.flush_interval = float(os.getenv('EVENT_FLUSH_INTERVAL', '2'))
+        self.buffer_limit = int(os.getenv('EVENT_BUFFER_LIMIT', '100000'))
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._stopping = False
+        self.stats = {
+            "written": 0,
+            "dropped": 0,
+            "flushes": 0,
+            "failed_flushes": 0,
+            "last_batch_size": 0,
+            "last_flush_ms": None,
+            "max_flush_ms": 0.0
+        }
+
+    def add(self, server_ip, event_type, duration_seconds=None, event_time=None):
+        if len(self.buffer) >= self.buffer_limit:
+            self.stats["dropped"] += 1
+            logger.error(f"Event buffer is full ({self.buffer_limit}), dropping {event_type} for {server_ip}")
+            return
+        self.buffer.append((server_ip, event_type, event_time or datetime.utcnow(), duration_seconds))
+        if len(self.buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Server event writer started: batch_size={self.batch_size}, flush_interval={self.flush_interval}s")
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def _write(self, conn, batch):
+        records = [(ip, EVENT_TYPE_CODES[event_type], event_time, duration) for ip, event_type, event_time, duration in batch]
+        async with conn.transaction():
+            await conn.copy_records_to_table('server_events', records=records, columns=SERVER_EVENT_COLUMNS)
+            await apply_uptime_rollups(conn, batch)
+
+    async def _write_rows(self, conn, batch):
+        # Пачка отклонена целиком (например, сервер удалён до сброса) — пишем по одной строке
+        written = 0
+        for index, row in enumerate(batch):
+            try:
+                async with conn.transaction():
+                    await conn.execute(INSERT_SERVER_EVENT, row[0], EVENT_TYPE_CODES[row[1]], row[2], row[3])
+                    await apply_uptime_rollups(conn, [row])
+                written += 1
+            except asyncpg.IntegrityConstraintViolationError as e:
+                self.stats["dropped"] += 1
+                logger.warning(f"Dropping event {row[1]} for {row[0]}: {str(e)}")
+            except Exception as e:
+                logger.error(f"Failed to write event {row[1]} for {row[0]}: {str(e)}")
+                return written, batch[index:]
+        return written, []
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self.buffer:
+                batch = self.buffer[:self.batch_size]
+                del self.buffer[:self.batch_size]
+                started = time.monotonic()
+                written, remaining = 0, batch
+                try:
+                    async with get_pool().acquire() as conn:
+                        try:
+                            await self._write(conn, batch)
+                            written, remaining = len(batch), []
+                        except asyncpg.PostgresError as e:
+                            logger.warning(f"Batch insert of {len(batch)} events failed, retrying row by row: {str(e)}")
+                            written, remaining = await self._write_rows(conn, batch)
+                except Exception as e:
+                    logger.error(f"Failed to flush {len(batch)} server events: {str(e)}\n{traceback.format_exc()}")
+                flush_ms = (time.monotonic() - started) * 1000
+                self.stats["written"] += written
+                self.stats["last_flush_ms"] = round(flush_ms, 1)
+                self.stats["max_flush_ms"] = round(max(self.stats["max_flush_ms"], flush_ms), 1)
+                if remaining:
+                    # Возвращаем несохранённое в начало буфера и ждём следующего сброса
+                    self.buffer[:0] = remaining
+                    self.stats["failed_flushes"] += 1
+                    logger.error(f"Server event flush failed, {len(self.buffer)} events buffered")
+                    return
+                self.stats["flushes"] += 1
+                self.stats["last_batch_size"] = len(batch)
+                logger.debug(f"Flushed {written} server events in {flush_ms:.1f} ms")
+
+    async def stop(self):
+        # Не отменяем задачу посреди записи: даём ей завершить текущий сброс
+        self._stopping = True
+        self._wakeup.set()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        if self.buffer:
+            logger.error(f"Server event writer stopped with {len(self.buffer)} unsaved events")
+        logger.info("Server event writer stopped")
+
+    def get_stats(self) -> dict:
+        return {"queue_depth": len(self.buffer), "buffer_limit": self.buffer_limit, **self.stats}
+
+event_writer = ServerEventWriter()
+
+async def log_server_event(server_ip, event_type, duration_seconds=None):
+    event_writer.add(server_ip, event_type, duration_seconds)
+    logger.info(f"Queued event for {server_ip}: {event_type}")
 
 async def get_server_events(period_hours, server_ip=None, limit=50):
     try:
-        conn = await asyncpg.connect(
-            database=DB_DBNAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
-        if server_ip is None:
-            query = '''
-                SELECT id, server_ip, event_type, event_time, duration_seconds
-                FROM server_events
-                WHERE event_time >= NOW() - INTERVAL '1 hour' * $1
-                ORDER BY event_time DESC LIMIT $2
-            '''
-            rows = await conn.fetch(query, period_hours, limit)
-        else:
-            query = '''
-                SELECT id, server_ip, event_type, event_time, duration_seconds
-                FROM server_events
-                WHERE event_time >= NOW() - INTERVAL '1 hour' * $1
-                AND server_ip = CAST($2 AS TEXT)
-                ORDER BY event_time DESC LIMIT $3
-            '''
-            rows = await conn.fetch(query, period_hours, server_ip, limit)
-        await conn.close()
+        async with get_pool().acquire() as conn:
+            if server_ip is None:
+                rows = await conn.fetch(SELECT_SERVER_EVENTS, period_hours, limit)
+            else:
+                rows = await conn.fetch(SELECT_SERVER_EVENTS_BY_IP, period_hours, server_ip, limit)
         return [{
             'id': row['id'],
             'server_ip': row['server_ip'],
-            'event_type': row['event_type'],
+            'event_type': EVENT_TYPE_NAMES.get(row['event_type']),
             'event_time': row['event_time'].isoformat(),
             'duration_seconds': row['duration_seconds']
         } for row in rows]
@@ -0,0 +1,101 @@
+import logging
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Лимит соединений и общий таймаут по умолчанию для каждого внешнего сервиса;
+# переопределяются через HTTP_<NAME>_LIMIT и HTTP_<NAME>_TIMEOUT
+UPSTREAMS = {
+    "cloudflare": {"limit": 20, "timeout": 10},
+    "subscription": {"limit": 4, "timeout": 30},
+    "webhook": {"limit": 20, "timeout": 10},
+    "xray_checker": {"limit": 4, "timeout": 30}
+}
+LATENCY_WINDOW = 500
+
+class HttpClientRegistry:
+    """Общие aiohttp-сессии по внешним сервисам с keep-alive и статистикой задержек."""
+
+    def __init__(self):
+        self.sessions = {}
+        self.stats = {}
+
+    def _settings(self, name):
+        defaults = UPSTREAMS.get(name, {"limit": 10, "timeout": 30})
+        return {
+            "limit": int(os.getenv(f'HTTP_{name.upper()}_LIMIT', defaults["limit"])),
+            "timeout": float(os.getenv(f'HTTP_{name.upper()}_TIMEOUT', defaults["timeout"]))
+        }
+
+    def _create_session(self, name):
+        settings = self._settings(name)
+        connector = aiohttp.TCPConnector(
+            limit=settings["limit"],
+            ttl_dns_cache=300,
+            keepalive_timeout=float(os.getenv('HTTP_KEEPALIVE_TIMEOUT', '30'))
+        )
+        session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=settings["timeout"]))
+        logger.debug(f"Created HTTP session for {name}: {settings}")
+        return session
+
+    async def start(self):
+        for name in UPSTREAMS:
+            self.session(name)
+        logger.info(f"HTTP clients started for: {list(self.sessions)}")
+
+    def session(self, name) -> aiohttp.ClientSession:
+        session = self.sessions.get(name)
+        if session is None or session.closed:
+            session = self._create_session(name)
+            self.sessions[name] = session
+        return session
+
+    def _record(self, name, elapsed_ms, failed):
+        stats = self.stats.setdefault(name, {"requests": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0, "recent": deque(maxlen=LATENCY_WINDOW)})
+        stats["requests"] += 1
+        stats["errors"] += int(failed)
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        stats["recent"].append(elapsed_ms)
+
+    @asynccontextmanager
+    async def request(self, name, method, url, **kwargs):
+        """Запрос через сессию сервиса name; время учитывается до выхода из контекста."""
+        started = time.monotonic()
+        failed = False
+        try:
+            async with self.session(name).request(method, url, **kwargs) as response:
+                failed = response.status >= 500
+                yield response
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._record(name, (time.monotonic() - started) * 1000, failed)
+
+    async def close(self):
+        for name, session in self.sessions.items():
+            if not session.closed:
+                await session.close()
+        self.sessions = {}
+        logger.info("HTTP clients closed")
+
+    def get_stats(self) -> dict:
+        result = {}
+        for name, stats in self.stats.items():
+            recent = sorted(stats["recent"])
+            result[name] = {
+                "requests": stats["requests"],
+                "errors": stats["errors"],
+                "avg_ms": round(stats["total_ms"] / stats["requests"], 1),
+                "max_ms": round(stats["max_ms"], 1),
+                "p50_ms": round(recent[len(recent) // 2], 1),
+                "p95_ms": round(recent[min(len(recent) - 1, int(len(recent) * 0.95))], 1)
+            }
+        return result
+
+http_clients = HttpClientRegistry()
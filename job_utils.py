@@ -0,0 +1,408 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import traceback
+import uuid
+from db import (
+    create_job, claim_job_task, finish_job_task, renew_job_task_leases, recover_job_tasks, prune_jobs,
+    claim_job_wave, renew_job_wave_leases, get_job_wave_tasks, mark_job_tasks_unhealthy, advance_job_wave, abort_job,
+    create_connection, notify_job_events, JOB_EVENTS_CHANNEL
+)
+
+logger = logging.getLogger(__name__)
+
+# NOTIFY принимает до 8000 байт; длинные строки вывода обрезаются
+JOB_EVENT_PAYLOAD_LIMIT = 7900
+
+class JobKind:
+    """Обработчик задач одного вида и его политика: параллельность, попытки, пауза между ними.
+
+    health_check(ips, params, finished_at) проверяет волну раскатки и возвращает адреса,
+    которые не поднялись; finished_at — {ip: время завершения задачи по loop.time()}.
+    """
+
+    def __init__(self, name, handler, concurrency, max_attempts, retry_delay, health_check=None):
+        self.name = name
+        self.handler = handler
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.health_check = health_check
+        self.active = 0
+
+class JobQueue:
+    """Очередь заданий в Postgres с пулом воркеров.
+
+    Задание — набор задач по IP. Состояния задачи: queued → running →
+    succeeded | failed, при неудаче с оставшимися попытками — retrying.
+    Ход выполнения (старт, строки вывода, итог) публикуется подписчикам
+    задания в этом процессе, а при нескольких воркерах (APP_WORKERS > 1 или
+    JOB_EVENTS_RELAY=1) ещё и через NOTIFY job_events. Строки вывода уходят
+    в NOTIFY, только если задание смотрит клиент другого воркера: воркеры
+    периодически объявляют задания, на которые у них есть подписчики.
+
+    Задание с params["rollout"] раскатывается волнами: после волны выдерживается
+    wave_delay, затем health_check вида, и если доля неудач превысила
+    max_failure_ratio, оставшиеся задачи отменяются. Последняя волна тоже
+    проверяется, и итоговый статус задания учитывает не поднявшиеся хосты.
+    """
+
+    def __init__(self):
+        self.kinds = {}
+        self.workers = int(os.getenv('JOB_WORKERS', '20'))
+        self.poll_interval = float(os.getenv('JOB_POLL_INTERVAL', '2'))
+        self.lease = float(os.getenv('JOB_TASK_LEASE', '300'))
+        self.retention_days = int(os.getenv('JOB_RETENTION_DAYS', '30'))
+        self.subscribers = {}
+        self.running = {}
+        self.sequences = {}
+        self.gating = {}
+        self._wave_ready = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        self._claim_lock = asyncio.Lock()
+        self._tasks = []
+        self._stopping = False
+        # Метка процесса в пересылаемых событиях, чтобы не доставлять свои события дважды
+        self.instance_id = uuid.uuid4().hex
+        self.relay_enabled = os.getenv('JOB_EVENTS_RELAY', '1' if int(os.getenv('APP_WORKERS', '1')) > 1 else '0') == '1'
+        self.relay_check_interval = float(os.getenv('JOB_EVENTS_CHECK_INTERVAL', '30'))
+        # Задания, которые смотрят клиенты других воркеров: {job_id: до какого времени}
+        self.remote_watchers = {}
+        self._outbox = asyncio.Queue(maxsize=int(os.getenv('JOB_EVENTS_OUTBOX_SIZE', '10000')))
+        self._relaying = False
+        self._listen_conn = None
+        self.stats = {
+            "claimed": 0, "succeeded": 0, "failed": 0, "retried": 0, "waves_advanced": 0, "jobs_aborted": 0,
+            "events_relayed": 0, "events_received": 0, "events_dropped": 0
+        }
+
+    def register(self, name, handler, concurrency=10, max_attempts=1, retry_delay=30, health_check=None):
+        """handler(ip, params, on_output) возвращает {"success": bool, "message": str}."""
+        prefix = f'JOB_{name.upper()}'
+        self.kinds[name] = JobKind(
+            name,
+            handler,
+            concurrency=int(os.getenv(f'{prefix}_CONCURRENCY', concurrency)),
+            max_attempts=int(os.getenv(f'{prefix}_ATTEMPTS', max_attempts)),
+            retry_delay=float(os.getenv(f'{prefix}_RETRY_DELAY', retry_delay)),
+            health_check=health_check
+        )
+
+    async def submit(self, kind, params, ips):
+        rollout = params.get("rollout")
+        job_id = await create_job(kind, params, ips, self.kinds[kind].max_attempts, rollout["wave_size"] if rollout else None)
+        self._wakeup.set()
+        return job_id
+
+    def start(self):
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._maintain()))
+        self._tasks.append(asyncio.create_task(self._gate_waves()))
+        if self.relay_enabled:
+            self._tasks.append(asyncio.create_task(self._relay_out()))
+            self._tasks.append(asyncio.create_task(self._relay_in()))
+            self._relaying = True
+        logger.info(f"Job queue started: {self.workers} workers, kinds {list(self.kinds)}")
+
+    async def stop(self):
+        self._stopping = True
+        self._relaying = False
+        self._wakeup.set()
+        # Незавершённые задачи и волны после остановки подберёт восстановление по истечении аренды
+        tasks = self._tasks + list(self.gating.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+        self.gating = {}
+        logger.info("Job queue stopped")
+
+    def _available_kinds(self):
+        return [kind.name for kind in self.kinds.values() if kind.active < kind.concurrency]
+
+    async def _worker(self):
+        while not self._stopping:
+            task = None
+            # Забираем по одной задаче за раз, чтобы не превысить параллельность вида
+            async with self._claim_lock:
+                kinds = self._available_kinds()
+                if kinds:
+                    try:
+                        task = await claim_job_task(kinds)
+                    except Exception as e:
+                        logger.error(f"Failed to claim job task: {str(e)}\n{traceback.format_exc()}")
+                if task is not None:
+                    self.kinds[task["kind"]].active += 1
+            if task is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(task)
+
+    async def _run(self, task):
+        kind = self.kinds[task["kind"]]
+        self.running[task["id"]] = task
+        self.stats["claimed"] += 1
+        ip = task["ip"]
+        job_id = task["job_id"]
+
+        async def on_output(stream, line):
+            self.publish(job_id, "output", ip, {"stream": stream, "line": line})
+
+        self.publish(job_id, "started", ip, {"attempt": task["attempts"], "max_attempts": task["max_attempts"]})
+        try:
+            result = await kind.handler(ip, task["params"], on_output)
+        except Exception as e:
+            logger.error(f"Job {job_id} task for {ip} failed: {str(e)}\n{traceback.format_exc()}")
+            result = {"success": False, "message": str(e)}
+        finally:
+            kind.active -= 1
+            self.running.pop(task["id"], None)
+        # Свободный слот вида может пригодиться другим воркерам
+        self._wakeup.set()
+        await self._finish(task, kind, result)
+
+    async def _finish(self, task, kind, result):
+        ip = task["ip"]
+        job_id = task["job_id"]
+        message = result.get("message")
+        if result.get("success"):
+            status, delay = "succeeded", 0
+            self.stats["succeeded"] += 1
+        elif task["attempts"] < task["max_attempts"] and result.get("retryable", True):
+            status, delay = "retrying", kind.retry_delay * task["attempts"]
+            self.stats["retried"] += 1
+        else:
+            status, delay = "failed", 0
+            self.stats["failed"] += 1
+        try:
+            job_status = await finish_job_task(task["id"], job_id, status, message, delay)
+        except Exception as e:
+            logger.error(f"Failed to record job {job_id} task for {ip}: {str(e)}\n{traceback.format_exc()}")
+            return
+        if status == "retrying":
+            self.publish(job_id, "retry", ip, {"message": message, "retry_in": delay})
+        else:
+            self.publish(job_id, "result", ip, {"success": status == "succeeded", "message": message})
+        if job_status == "running" and "rollout" in task["params"]:
+            self._wave_ready.set()
+        if job_status != "running":
+            logger.info(f"Job {job_id} finished: {job_status}")
+            self._publish_done(job_id, job_status)
+
+    def _publish_done(self, job_id, status):
+        self.publish(job_id, "done", None, {"status": status})
+        self.sequences = {key: value for key, value in self.sequences.items() if key[0] != job_id}
+
+    async def _maintain(self):
+        """Продлевает аренду своих задач, возвращает в очередь чужие просроченные и чистит старые задания."""
+        cycles = 0
+        interval = max(5.0, self.lease / 5)
+        while not self._stopping:
+            try:
+                await renew_job_task_leases(list(self.running))
+                await renew_job_wave_leases(list(self.gating))
+                if await recover_job_tasks(self.lease):
+                    self._wakeup.set()
+                if cycles % int(max(1, 3600 // interval)) == 0:
+                    pruned = await prune_jobs(self.retention_days)
+                    if pruned:
+                        logger.info(f"Pruned {pruned} finished jobs")
+            except Exception as e:
+                logger.error(f"Job queue maintenance failed: {str(e)}\n{traceback.format_exc()}")
+            cycles += 1
+            await asyncio.sleep(interval)
+
+    async def _gate_waves(self):
+        """Забирает задания с завершённой волной и запускает для каждого проверку перед следующей."""
+        while not self._stopping:
+            self._wave_ready.clear()
+            try:
+                while (job := await claim_job_wave(self.lease)) is not None:
+                    gate = asyncio.create_task(self._gate_wave(job))
+                    self.gating[job["id"]] = gate
+                    gate.add_done_callback(lambda _, job_id=job["id"]: self.gating.pop(job_id, None))
+            except Exception as e:
+                logger.error(f"Failed to claim rollout wave: {str(e)}\n{traceback.format_exc()}")
+            try:
+                await asyncio.wait_for(self._wave_ready.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _gate_wave(self, job):
+        job_id = job["id"]
+        wave = job["current_wave"]
+        rollout = job["params"]["rollout"]
+        kind = self.kinds[job["kind"]]
+        try:
+            tasks = await get_job_wave_tasks(job_id, wave)
+            now = asyncio.get_running_loop().time()
+            finished_at = {task["ip"]: now - task["finished_ago"] for task in tasks if task["wave"] == wave and task["status"] == "succeeded"}
+            succeeded = list(finished_at)
+            self.publish(job_id, "wave", None, {"wave": wave + 1, "waves": job["waves"], "status": "completed"})
+            await asyncio.sleep(rollout["wave_delay"])
+            unhealthy = []
+            if kind.health_check and succeeded:
+                self.publish(job_id, "wave", None, {"wave": wave + 1, "waves": job["waves"], "status": "health_check"})
+                unhealthy = await kind.health_check(succeeded, job["params"], finished_at)
+                if unhealthy:
+                    await mark_job_tasks_unhealthy(job_id, unhealthy, "Not back online after rollout wave")
+                    logger.warning(f"Job {job_id} wave {wave + 1}: {len(unhealthy)} hosts not back online: {unhealthy}")
+            # Доля неудач считается по всем уже пройденным волнам
+            failed = sum(1 for task in tasks if task["status"] in ("failed", "unhealthy")) + len(unhealthy)
+            ratio = failed / len(tasks) if tasks else 0
+            last = wave == job["waves"] - 1
+            if not last and ratio > rollout["max_failure_ratio"]:
+                message = f"Rollout stopped after wave {wave + 1}: failure ratio {ratio:.0%} exceeds {rollout['max_failure_ratio']:.0%}"
+                job_status = await abort_job(job_id, message)
+                self.stats["jobs_aborted"] += 1
+                logger.warning(f"Job {job_id}: {message}")
+                self.publish(job_id, "wave", None, {"wave": wave + 1, "waves": job["waves"], "status": "aborted", "unhealthy": unhealthy, "message": message})
+                self._publish_done(job_id, job_status)
+                return
+            job_status = await advance_job_wave(job_id, wave)
+            if job_status is None:
+                return
+            if last:
+                # Отменять уже нечего: не поднявшиеся хосты попадают в итоговый статус
+                self.publish(job_id, "wave", None, {"wave": wave + 1, "waves": job["waves"], "status": "checked", "unhealthy": unhealthy})
+                logger.info(f"Job {job_id} finished: {job_status}")
+                self._publish_done(job_id, job_status)
+                return
+            self.stats["waves_advanced"] += 1
+            logger.info(f"Job {job_id}: starting wave {wave + 2}/{job['waves']}")
+            self.publish(job_id, "wave", None, {"wave": wave + 2, "waves": job["waves"], "status": "started", "unhealthy": unhealthy})
+            self._wakeup.set()
+        except Exception as e:
+            # Волну после истечения аренды заберёт этот или другой процесс
+            logger.error(f"Rollout gate failed for job {job_id} wave {wave + 1}: {str(e)}\n{traceback.format_exc()}")
+
+    async def _relay_out(self):
+        """Отправляет накопившиеся события пачками через NOTIFY."""
+        while True:
+            batch = [await self._outbox.get()]
+            while not self._outbox.empty() and len(batch) < 100:
+                batch.append(self._outbox.get_nowait())
+            try:
+                await notify_job_events(batch)
+                self.stats["events_relayed"] += len(batch)
+            except Exception as e:
+                self.stats["events_dropped"] += len(batch)
+                logger.error(f"Failed to relay {len(batch)} job events: {str(e)}\n{traceback.format_exc()}")
+
+    async def _relay_in(self):
+        """Держит соединение LISTEN job_events и переподключается при его потере."""
+        try:
+            while not self._stopping:
+                try:
+                    if self._listen_conn is None or self._listen_conn.is_closed():
+                        self._listen_conn = await create_connection()
+                        await self._listen_conn.add_listener(JOB_EVENTS_CHANNEL, self._on_event)
+                    else:
+                        await self._listen_conn.execute('SELECT 1')
+                except Exception as e:
+                    logger.error(f"Job events listener check failed: {str(e)}\n{traceback.format_exc()}")
+                    await self._close_listener()
+                if self.subscribers:
+                    self._announce(list(self.subscribers))
+                now = time.monotonic()
+                self.remote_watchers = {job_id: until for job_id, until in self.remote_watchers.items() if until > now}
+                await asyncio.sleep(self.relay_check_interval)
+        finally:
+            await self._close_listener()
+
+    async def _close_listener(self):
+        if self._listen_conn is not None and not self._listen_conn.is_closed():
+            try:
+                await self._listen_conn.close()
+            except Exception as e:
+                logger.debug(f"Error closing job events connection: {str(e)}")
+        self._listen_conn = None
+
+    def _on_event(self, connection, pid, channel, payload):
+        try:
+            message = json.loads(payload)
+        except Exception as e:
+            logger.error(f"Invalid job event notification: {str(e)}")
+            return
+        if message["origin"] == self.instance_id:
+            return
+        if message["event"] == "watch":
+            until = time.monotonic() + 3 * self.relay_check_interval
+            for job_id in message["data"]["job_ids"]:
+                self.remote_watchers[job_id] = until
+            return
+        self.stats["events_received"] += 1
+        self._deliver(message["job_id"], message["event"], message["data"])
+
+    def _encode_event(self, job_id, event, payload):
+        message = {"origin": self.instance_id, "job_id": job_id, "event": event, "data": payload}
+        encoded = json.dumps(message)
+        for field in ("line", "message"):
+            while len(encoded.encode('utf-8')) > JOB_EVENT_PAYLOAD_LIMIT and payload.get(field):
+                payload = {**payload, field: payload[field][:len(payload[field]) // 2]}
+                message["data"] = payload
+                encoded = json.dumps(message)
+        return encoded if len(encoded.encode('utf-8')) <= JOB_EVENT_PAYLOAD_LIMIT else None
+
+    def _announce(self, job_ids):
+        """Сообщает другим воркерам, что здесь смотрят эти задания, и им нужен вывод."""
+        self._enqueue(json.dumps({"origin": self.instance_id, "job_id": None, "event": "watch", "data": {"job_ids": job_ids}}))
+
+    def _enqueue(self, encoded):
+        if encoded is None or self._outbox.full():
+            self.stats["events_dropped"] += 1
+            return
+        self._outbox.put_nowait(encoded)
+
+    def subscribe(self, job_id):
+        queue = asyncio.Queue(maxsize=int(os.getenv('STREAM_QUEUE_SIZE', '1000')))
+        if self._relaying and job_id not in self.subscribers:
+            self._announce([job_id])
+        self.subscribers.setdefault(job_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, job_id, queue):
+        subscribers = self.subscribers.get(job_id)
+        if subscribers is not None:
+            subscribers.discard(queue)
+            if not subscribers:
+                del self.subscribers[job_id]
+
+    def publish(self, job_id, event, ip, data):
+        key = (job_id, ip)
+        self.sequences[key] = self.sequences.get(key, 0) + 1
+        payload = {**data, "ip": ip, "seq": self.sequences[key]}
+        self._deliver(job_id, event, payload)
+        if not self._relaying:
+            return
+        if event == "output" and self.remote_watchers.get(job_id, 0) < time.monotonic():
+            return
+        self._enqueue(self._encode_event(job_id, event, payload))
+
+    def _deliver(self, job_id, event, payload):
+        for queue in self.subscribers.get(job_id, ()):
+            try:
+                queue.put_nowait((event, payload))
+            except asyncio.QueueFull:
+                # Медленный клиент теряет строки вывода, но не итоги — их отдаст /api/jobs/{id}
+                pass
+
+    def get_stats(self) -> dict:
+        return {
+            "running": len(self.running),
+            "gating": len(self.gating),
+            "active_by_kind": {kind.name: kind.active for kind in self.kinds.values()},
+            "subscribers": sum(len(queues) for queues in self.subscribers.values()),
+            "outbox": self._outbox.qsize(),
+            "listening": self._listen_conn is not None and not self._listen_conn.is_closed(),
+            **self.stats
+        }
+
+job_queue = JobQueue()
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import os
+import traceback
+from db import create_connection
+
+logger = logging.getLogger(__name__)
+
+class LeaderElection:
+    """Выбор ведущего процесса среди воркеров через advisory-блокировку Postgres.
+
+    Блокировка сессионная и держится на отдельном соединении: если ведущий
+    процесс или его соединение умирают, Postgres снимает её сам, и ведущим
+    становится воркер, первым взявший её при очередной попытке.
+    """
+
+    def __init__(self, name, lock_id):
+        self.name = name
+        self.lock_id = lock_id
+        self.check_interval = float(os.getenv('LEADER_CHECK_INTERVAL', '5'))
+        self.is_leader = False
+        self._conn = None
+        self._task = None
+        self._on_elected = None
+        self._on_demoted = None
+        self.stats = {"elections": 0, "demotions": 0, "errors": 0}
+
+    async def start(self, on_elected, on_demoted):
+        self._on_elected = on_elected
+        self._on_demoted = on_demoted
+        # Первая попытка сразу: единственный воркер не ждёт интервал проверки
+        await self._step()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.is_leader:
+            await self._demote("shutting down")
+            try:
+                await self._conn.fetchval('SELECT pg_advisory_unlock($1)', self.lock_id)
+            except Exception as e:
+                logger.debug(f"Failed to release leader lock {self.name}: {str(e)}")
+        await self._close()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            await self._step()
+
+    async def _step(self):
+        try:
+            if self._conn is None or self._conn.is_closed():
+                if self.is_leader:
+                    await self._demote("lock connection lost")
+                self._conn = await create_connection()
+            if self.is_leader:
+                # Ведущий проверяет, что соединение с блокировкой живо
+                await self._conn.execute('SELECT 1')
+            elif await self._conn.fetchval('SELECT pg_try_advisory_lock($1)', self.lock_id):
+                self.is_leader = True
+                self.stats["elections"] += 1
+                logger.info(f"This worker (pid {os.getpid()}) is now the {self.name} leader")
+                await self._on_elected()
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Leader election {self.name} failed: {str(e)}\n{traceback.format_exc()}")
+            if self.is_leader:
+                await self._demote(str(e))
+            await self._close()
+
+    async def _demote(self, reason):
+        self.is_leader = False
+        self.stats["demotions"] += 1
+        logger.warning(f"This worker (pid {os.getpid()}) is no longer the {self.name} leader: {reason}")
+        try:
+            await self._on_demoted()
+        except Exception as e:
+            logger.error(f"Error stopping {self.name} leader duties: {str(e)}\n{traceback.format_exc()}")
+
+    async def _close(self):
+        if self._conn is not None and not self._conn.is_closed():
+            try:
+                await self._conn.close()
+            except Exception as e:
+                logger.debug(f"Error closing leader lock connection: {str(e)}")
+        self._conn = None
+
+    def get_stats(self) -> dict:
+        return {"name": self.name, "leader": self.is_leader, "pid": os.getpid(), **self.stats}
+
+monitoring_leader = LeaderElection('monitoring', int(os.getenv('LEADER_LOCK_ID', '342001')))
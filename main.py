@@ -4,32 +4,37 @@ import logging
 import os
 import re
 import traceback
-import asyncpg
 import socket
 from contextlib import asynccontextmanager
-from typing import List
+from typing import List, Optional
 from fastapi import FastAPI, Form, HTTPException, Query
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from db import init_db, get_vless_keys, get_vless_key, update_vless_key, add_server, get_servers, delete_server, log_server_event, get_server_events
-from ssh_utils import deploy_script, check_server_availability
+from db import create_pool, set_pool, close_pool, event_writer, init_db, get_vless_keys, get_vless_key, sync_vless_keys, add_server, delete_server, get_job, log_server_event, get_server_events, get_uptime_states, get_uptime_rollups, run_event_retention
+from ssh_utils import deploy_script, check_server_availability, get_host_uptime, ssh_pool, script_index
+from checker_utils import checker_control
+from probe_utils import probe_many, probe_tcp
+from job_utils import job_queue
+from registry_utils import server_registry
+from leader_utils import monitoring_leader
 from config import Config
 import aiohttp
 import aio_pika
 from aio_pika.exceptions import AMQPError
 from dotenv import load_dotenv
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from subscription_utils import fetch_subscription_keys, create_outbound_json, parse_vless_key
+from subscription_utils import fetch_subscription, subscription_cache, outbound_catalog, create_outbound_json
 import json
-import shutil
-import asyncssh
-import subprocess
 from datetime import datetime, timedelta
 from retrying import retry
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.middleware.cors import CORSMiddleware
-from cloudflare_utils import create_dns_record, find_dns_record, delete_dns_record
+from cloudflare_utils import create_dns_record, find_dns_record, delete_dns_record, reconcile_dns_records, cloudflare_client
+from metrics_utils import get_metrics_snapshot, get_snapshot_status
+from notification_utils import NotificationPipeline
+from telegram_utils import telegram_notifier
+from http_utils import http_clients
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -42,6 +47,9 @@ last_status_change_time = {}
 rabbitmq_connection = None
 db_pool = None
 new_servers = set()
+# Первая синхронизация после старта выполняется всегда, дальше — только при изменении подписки
+subscription_synced = False
+notification_pipeline = NotificationPipeline()
 
 class NoCacheMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request, call_next):
@@ -54,12 +62,20 @@ class ServerForm(BaseModel):
     ip: str
     inbound_tag: str
 
+class RolloutOptions(BaseModel):
+    wave_size: int
+    wave_delay: Optional[float] = None
+    health_timeout: Optional[float] = None
+    max_failure_ratio: Optional[float] = None
+
 class RebootRequest(BaseModel):
     ips: List[str]
+    rollout: Optional[RolloutOptions] = None
 
 class RunScriptsRequest(BaseModel):
     ips: List[str]
     script_name: str
+    rollout: Optional[RolloutOptions] = None
 
 class AddServerRequest(BaseModel):
     ips: List[str]
@@ -70,6 +86,11 @@ class EditServerRequest(BaseModel):
     new_ip: str
     new_inbound_tag: str
 
+class ProbeRequest(BaseModel):
+    ips: List[str]
+    port: int = 22
+    timeout: Optional[float] = None
+
 def get_script_name(inbound_tag: str) -> str:
     safe_tag = re.sub(r'[\U0001F1E6-\U0001F1FF]+', '', inbound_tag).strip()
     script_name = safe_tag.lower().replace(" ", "_") + ".sh"
@@ -83,45 +104,6 @@ def is_valid_ip(ip: str) -> bool:
     except ValueError:
         return False
 
-def get_minute_accusative_form(minutes: int) -> str:
-    if minutes % 10 == 1 and minutes % 100 != 11:
-        return "минуту"
-    elif minutes % 10 in [2, 3, 4] and minutes % 100 not in [12, 13, 14]:
-        return "минуты"
-    else:
-        return "минут"
-
-async def send_telegram_alert(ip: str, status: str, duration_minutes: int):
-    bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
-    chat_id = os.getenv('TELEGRAM_CHAT_ID')
-    if not bot_token or not chat_id:
-        logger.error("Missing TELEGRAM_BOT_TOKEN or TELEGRAM_CHAT_ID in .env")
-        return
-    # HTML с <code> для копирования IP
-    minute_form = get_minute_accusative_form(duration_minutes)
-    if status == "offline":
-        message = f'<b>[<code>{ip}</code>: 🔴 Офлайн]</b> - была доступна {duration_minutes} {minute_form}'
-    else:
-        message = f'<b>[<code>{ip}</code>: ✅ Онлайн]</b> - была недоступна {duration_minutes} {minute_form}'
-    url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-    payload = {
-        "chat_id": chat_id,
-        "text": message,
-        "parse_mode": "HTML"
-    }
-    logger.debug(f"Sending Telegram alert for {ip}: message={message}, url={url}, payload={payload}")
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload) as resp:
-                response_text = await resp.text()
-                logger.debug(f"Telegram response for {ip}: status={resp.status}, response={response_text}")
-                if resp.status != 200:
-                    logger.error(f"Failed to send Telegram alert for {ip}: status={resp.status}, response={response_text}")
-                else:
-                    logger.info(f"Telegram alert sent for {ip}: {message}")
-    except Exception as e:
-        logger.error(f"Error sending Telegram alert for {ip}: {str(e)}\n{traceback.format_exc()}")
-
 async def init_rabbit():
     global rabbitmq_connection
     try:
@@ -180,16 +162,15 @@ async def publish_webhook(ip, payload):
 async def send_webhook(ip, payload):
     webhook_url = f"http://{os.getenv('NODEMONITORING_HOST')}:{os.getenv('NODEMONITORING_PORT')}/api/kuma/alert"
     try:
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
-            logger.debug(f"Sending webhook to {webhook_url} for {ip}: {json.dumps(payload, indent=2)}")
-            async with session.post(webhook_url, json=payload) as resp:
-                response_text = await resp.text()
-                logger.debug(f"Webhook response for {ip}: status={resp.status}, response={response_text}")
-                if resp.status != 200:
-                    logger.error(f"Webhook failed for {ip}: status={resp.status}, response={response_text}")
-                    return False
-                logger.info(f"Webhook sent for {ip}: {payload}")
-                return True
+        logger.debug(f"Sending webhook to {webhook_url} for {ip}: {json.dumps(payload, indent=2)}")
+        async with http_clients.request('webhook', 'POST', webhook_url, json=payload) as resp:
+            response_text = await resp.text()
+            logger.debug(f"Webhook response for {ip}: status={resp.status}, response={response_text}")
+            if resp.status != 200:
+                logger.error(f"Webhook failed for {ip}: status={resp.status}, response={response_text}")
+                return False
+            logger.info(f"Webhook sent for {ip}: {payload}")
+            return True
     except Exception as e:
         logger.error(f"Webhook error for {ip}: {str(e)}\n{traceback.format_exc()}")
         raise
@@ -219,176 +200,88 @@ async def start_webhook_consumer():
     asyncio.create_task(webhook_consumer())
     logger.info("Started RabbitMQ webhook consumer")
 
-async def remove_existing_json(ip):
-    remote_path = f"{os.getenv('XRAY_CHECKER_JSON_PATH')}/{ip}.json"
-    try:
-        logger.debug(f"Attempting to remove JSON at {remote_path}")
-        if os.getenv('XRAY_CHECKER_SSH_KEY') and os.getenv('XRAY_CHECKER_HOST') not in ['localhost', '127.0.0.1']:
-            logger.info(f"Removing JSON via SFTP at {remote_path}")
-            async with asyncssh.connect(
-                os.getenv('XRAY_CHECKER_HOST'),
-                client_keys=[os.getenv('XRAY_CHECKER_SSH_KEY')],
-                known_hosts=None,
-                connect_timeout=30,
-                login_timeout=30
-            ) as conn:
-                async with conn.start_sftp_client() as sftp:
-                    try:
-                        await sftp.stat(remote_path)
-                        await sftp.remove(remote_path)
-                        logger.info(f"Removed JSON at {remote_path}")
-                    except asyncssh.SFTPError:
-                        logger.debug(f"No JSON found at {remote_path}")
-        elif os.getenv('XRAY_CHECKER_HOST') in ['localhost', '127.0.0.1']:
-            logger.info(f"Removing local JSON at {remote_path}")
-            if os.path.exists(remote_path):
-                os.remove(remote_path)
-                logger.info(f"Removed JSON at {remote_path}")
-            else:
-                logger.debug(f"No JSON found at {remote_path}")
-        else:
-            logger.error("Invalid Xray Checker config: SSH key or host not set")
-            raise ValueError("SSH key or valid host required")
-        return True
-    except Exception as e:
-        logger.error(f"Failed to remove JSON for {ip}: {str(e)}\n{traceback.format_exc()}")
-        return False
+def notify_status(ip, status, duration_minutes, event_type=None, duration_seconds=None, inbound_tag=None):
+    """Ставит переход статуса в очередь доставки, не дожидаясь БД, RabbitMQ и Telegram."""
+    notification_pipeline.submit({
+        "ip": ip,
+        "inbound_tag": inbound_tag,
+        "status": status,
+        "duration_minutes": duration_minutes,
+        "event_type": event_type,
+        "duration_seconds": duration_seconds,
+        "payload": {
+            "heartbeat": {"msg": "ok" if status == "online" else "fail"},
+            "monitor": {"description": ip}
+        }
+    })
+
+async def log_event_stage(event):
+    if event["event_type"]:
+        await log_server_event(event["ip"], event["event_type"], duration_seconds=event["duration_seconds"])
+
+async def webhook_stage(event):
+    await publish_webhook(event["ip"], event["payload"])
+
+async def telegram_stage(event):
+    telegram_notifier.enqueue(event["ip"], event["status"], event["duration_minutes"], event["inbound_tag"])
+
+notify_workers = int(os.getenv('NOTIFY_WORKERS', '4'))
+# События в БД пишем одним воркером, чтобы сохранить порядок offline_start/offline_end
+notification_pipeline.add_stage("events", log_event_stage, workers=1)
+notification_pipeline.add_stage("webhooks", webhook_stage, workers=notify_workers)
+notification_pipeline.add_stage("telegram", telegram_stage, workers=1)
 
 async def restart_xray_checker():
     try:
-        container_name = os.getenv('XRAY_CHECKER_CONTAINER_NAME', 'xraychecker-xray-checker')
-        logger.info(f"Restarting Xray Checker container: {container_name}")
-        if os.getenv('XRAY_CHECKER_SSH_KEY') and os.getenv('XRAY_CHECKER_HOST') not in ['localhost', '127.0.0.1']:
-            async with asyncssh.connect(
-                os.getenv('XRAY_CHECKER_HOST'),
-                client_keys=[os.getenv('XRAY_CHECKER_SSH_KEY')],
-                known_hosts=None,
-                connect_timeout=30,
-                login_timeout=30
-            ) as conn:
-                result = await conn.run(f'docker ps -a -q -f name={container_name}')
-                if not result.stdout.strip():
-                    logger.warning(f"Container {container_name} not found, skipping restart")
-                    return True
-                result = await conn.run(f'sudo docker restart {container_name}')
-                if result.exit_status != 0:
-                    logger.error(f"Docker restart failed: {result.stderr}")
-                    raise Exception(f"Docker restart failed: {result.stderr}")
-                logger.info("Xray Checker restarted successfully")
-        elif os.getenv('XRAY_CHECKER_HOST') in ['localhost', '127.0.0.1']:
-            result = subprocess.run(['docker', 'ps', '-a', '-q', '-f', f'name={container_name}'], capture_output=True, text=True)
-            if not result.stdout.strip():
-                logger.warning(f"Container {container_name} not found locally, skipping restart")
-                return True
-            result = subprocess.run(['sudo', 'docker', 'restart', container_name], capture_output=True, text=True)
-            if result.returncode != 0:
-                logger.error(f"Docker restart failed: {result.stderr}")
-                raise Exception(f"Docker restart failed: {result.stderr}")
-            logger.info("Xray Checker restarted successfully")
-        else:
-            logger.error("Invalid Xray Checker config: SSH key or host not set")
-            raise ValueError("SSH key or valid host required")
+        logger.info(f"Requesting Xray Checker restart: {checker_control.container_name}")
+        await checker_control.request_restart()
         return True
     except Exception as e:
         logger.error(f"Delayed restart Xray Checker: {str(e)}\n{traceback.format_exc()}")
         return False
 
-async def copy_json_to_xray_checker(ip, json_data):
-    local_path = f"/config/outbounds/{ip}.json"
-    remote_path = f"{os.getenv('XRAY_CHECKER_JSON_PATH')}/{ip}.json"
-    try:
-        logger.debug(f"Creating JSON at {local_path}")
-        os.makedirs(os.path.dirname(local_path), exist_ok=True)
-        with open(local_path, "w") as f:
-            json.dump(json_data, f, indent=2)
-        logger.info(f"JSON created at {local_path}")
-
-        if not os.getenv('XRAY_CHECKER_JSON_PATH'):
-            logger.error("XRAY_CHECKER_JSON_PATH not set")
-            raise ValueError("XRAY_CHECKER_JSON_PATH not set")
-
-        if os.getenv('XRAY_CHECKER_SSH_KEY') and os.getenv('XRAY_CHECKER_HOST') not in ['localhost', '127.0.0.1']:
-            logger.info(f"Copying JSON to {remote_path} via SFTP")
-            async with asyncssh.connect(
-                os.getenv('XRAY_CHECKER_HOST'),
-                client_keys=[os.getenv('XRAY_CHECKER_SSH_KEY')],
-                known_hosts=None,
-                connect_timeout=30,
-                login_timeout=30
-            ) as conn:
-                async with conn.start_sftp_client() as sftp:
-                    try:
-                        await sftp.stat(os.path.dirname(remote_path))
-                    except asyncssh.SFTPError:
-                        await sftp.makedirs(os.path.dirname(remote_path))
-                        logger.info(f"Created directory {os.path.dirname(remote_path)}")
-                    await sftp.put(local_path, remote_path)
-                    logger.info(f"JSON copied to {remote_path}")
-        elif os.getenv('XRAY_CHECKER_HOST') in ['localhost', '127.0.0.1']:
-            logger.info(f"Copying JSON to local {remote_path}")
-            os.makedirs(os.path.dirname(remote_path), exist_ok=True)
-            shutil.copy2(local_path, remote_path)
-            logger.info(f"JSON copied to {remote_path}")
-        else:
-            logger.error("Invalid Xray Checker config: SSH key or host not set")
-            raise ValueError("SSH key or valid host required")
-        return True
-    except Exception as e:
-        logger.error(f"Failed to copy JSON for {ip}: {str(e)}\n{traceback.format_exc()}")
-        return False
-    finally:
-        if os.path.exists(local_path):
-            logger.info(f"Removing temp JSON at {local_path}")
-            os.remove(local_path)
+async def sync_xray_checker_outbounds(changes):
+    """Синхронизирует пачку outbound-файлов {ip: json или None} и один раз перезапускает чекер.
 
-async def update_xray_checker_json(ip, inbound_tag, vless_key):
+    Возвращает результаты по IP.
+    """
     try:
-        logger.debug(f"Updating Xray Checker JSON for {ip} with tag {inbound_tag}")
-        if not await remove_existing_json(ip):
-            logger.warning(f"Failed to remove existing JSON for {ip}, proceeding with update")
-        json_data = create_outbound_json(ip, inbound_tag, vless_key)
-        if not json_data:
-            logger.error(f"create_outbound_json returned None for {ip}")
-            raise ValueError("Failed to create outbound JSON")
-        if not await copy_json_to_xray_checker(ip, json_data):
-            logger.error(f"Failed to copy JSON for {ip}")
-            raise ValueError(f"Failed to copy JSON for {ip}")
-        if not await restart_xray_checker():
-            logger.warning(f"Failed to restart Xray Checker for {ip}, but JSON copied")
-        logger.info(f"JSON updated for {ip} with inbound_tag {inbound_tag}")
-        return True
+        results = await checker_control.sync_outbounds(changes)
     except Exception as e:
-        logger.error(f"Failed to update JSON for {ip}: {str(e)}\n{traceback.format_exc()}")
-        return False
+        logger.error(f"Failed to sync outbounds for {list(changes)}: {str(e)}\n{traceback.format_exc()}")
+        return {ip: {"ip": ip, "action": "failed", "success": False, "error": str(e)} for ip in changes}
+    for result in results:
+        if not result["success"]:
+            logger.error(f"Failed to sync JSON for {result['ip']}: {result['error']}")
+    if any(result["action"] in ("written", "removed") for result in results):
+        if not await restart_xray_checker():
+            logger.warning("Failed to restart Xray Checker, but outbounds synced")
+    else:
+        logger.info("Outbounds already up to date, Xray Checker restart skipped")
+    return {result["ip"]: result for result in results}
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def sse_response(events):
+    # X-Accel-Buffering отключает буферизацию ответа в nginx
+    return StreamingResponse(events, media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+async def get_location_key(inbound_tag):
+    """Ключ локации и его разобранные поля из каталога шаблонов — один раз на запрос."""
+    key = await get_vless_key(inbound_tag)
+    if not key:
+        return None, None
+    return key, outbound_catalog.get(inbound_tag, key['vless_key'])['key_data']
 
-async def check_ip_in_xray_checker(ip):
-    host = 'localhost' if os.getenv('XRAY_CHECKER_HOST') in ['localhost', '127.0.0.1'] else os.getenv('XRAY_CHECKER_HOST')
-    url = f"http://{host}:{os.getenv('XRAY_CHECKER_PORT')}/metrics"
+async def check_ip_in_xray_checker(ip, snapshot=None):
     try:
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
-            async with session.get(url) as response:
-                if response.status != 200:
-                    logger.error(f"Xray Checker status for {ip}: {response.status}")
-                    last_check_time[ip] = datetime.utcnow()
-                    return "unknown"
-                metrics = await response.text()
-                logger.debug(f"Metrics for {ip}: {metrics[:1000]}")
-                status_pattern = r'xray_proxy_status{{[^}}]*address="{}:\d+"[^}}]*}} ([0-1])'.format(re.escape(ip))
-                latency_pattern = r'xray_proxy_latency_ms{{[^}}]*address="{}:\d+"[^}}]*}} (\d+)'.format(re.escape(ip))
-                status_match = re.search(status_pattern, metrics, re.MULTILINE)
-                latency_match = re.search(latency_pattern, metrics, re.MULTILINE)
-                if not status_match and not latency_match:
-                    logger.debug(f"IP {ip} not found in XrayChecker metrics")
-                    last_check_time[ip] = datetime.utcnow()
-                    return "unknown"
-                status = "unknown"
-                if status_match:
-                    status = "online" if status_match.group(1) == "1" else "offline"
-                elif latency_match:
-                    status = "online" if int(latency_match.group(1)) > 0 else "offline"
-                logger.debug(f"IP {ip} in XrayChecker: status={status}")
-                last_check_time[ip] = datetime.utcnow()
-                return status
+        if snapshot is None:
+            snapshot = await get_metrics_snapshot()
+        status = get_snapshot_status(snapshot, ip)
+        logger.debug(f"IP {ip} in XrayChecker: status={status}")
+        last_check_time[ip] = snapshot["scraped_at"] or datetime.utcnow()
+        return status
     except Exception as e:
         logger.error(f"Error checking IP {ip}: {str(e)}\n{traceback.format_exc()}")
         last_check_time[ip] = datetime.utcnow()
@@ -397,13 +290,8 @@ async def check_ip_in_xray_checker(ip):
 async def send_initial_webhook(ip, inbound_tag, status):
     current_time = datetime.utcnow()
     duration_minutes = 0
-    webhook_payload = {
-        "heartbeat": {"msg": "ok" if status == "online" else "fail"},
-        "monitor": {"description": ip}
-    }
-    logger.debug(f"Sending initial webhook for {ip}: status={status}, payload={webhook_payload}")
-    await publish_webhook(ip, webhook_payload)
-    await send_telegram_alert(ip, status, duration_minutes)
+    logger.debug(f"Sending initial webhook for {ip}: status={status}")
+    notify_status(ip, status, duration_minutes, inbound_tag=inbound_tag)
     last_status_change_time[ip] = current_time
     if status == "offline" or status == "unknown":
         last_offline_webhook[ip] = current_time
@@ -432,41 +320,38 @@ async def delayed_webhook_check(ip, inbound_tag, domain, inbound_letter):
     except Exception as e:
         logger.error(f"Failed delayed webhook check for {ip}: {str(e)}\n{traceback.format_exc()}")
 
-async def update_vless_keys_from_subscription():
+async def update_vless_keys_from_subscription(force: bool = False):
+    global subscription_synced
     try:
-        keys = await fetch_subscription_keys(os.getenv('SUBSCRIPTION_URL'))
-        async with db_pool.acquire() as conn:
-            async with conn.transaction():
-                for key in keys:
-                    existing = await get_vless_key(key['inbound_tag'])
-                    if existing:
-                        await update_vless_key(
-                            key['inbound_tag'],
-                            key['serverName'],
-                            key['vless_key'],
-                            key['domain']
-                        )
-                    else:
-                        await update_vless_key(
-                            key['inbound_tag'],
-                            key['serverName'],
-                            key['vless_key'],
-                            key['domain']
-                        )
+        keys, changed = await fetch_subscription(os.getenv('SUBSCRIPTION_URL'), force=force)
+        if not keys:
+            logger.warning("No VLESS keys available from subscription or cache, skipping sync")
+            return {"changed": False, "keys": None, "dns": None}
+        if not changed and subscription_synced and not force:
+            logger.info("Subscription unchanged, skipping key sync and DNS reconcile")
+            return {"changed": False, "keys": None, "dns": None}
+        keys_summary = await sync_vless_keys(keys)
+        outbound_catalog.sync(keys)
+        ips_by_tag = server_registry.ips_by_tag()
+        desired = {}
         for key in keys:
             if key.get('inbound_letter') and key.get('domain'):
-                servers = await get_servers()
-                for server in servers:
-                    ip = server[0]
-                    if server[1] == key['inbound_tag']:
-                        try:
-                            ttl = int(os.getenv('DNS_TTL', '120'))
-                            await create_dns_record(ip, key['inbound_letter'], ttl, key['domain'])
-                            logger.info(f"Created DNS record for {ip} with inbound_letter {key['inbound_letter']} and domain {key['domain']}")
-                            asyncio.create_task(delayed_webhook_check(ip, key['inbound_tag'], key['domain'], key['inbound_letter']))
-                        except Exception as e:
-                            logger.error(f"Failed to create DNS record for {ip}: {str(e)}\n{traceback.format_exc()}")
+                ips = ips_by_tag.get(key['inbound_tag'])
+                if ips:
+                    desired.setdefault((key['domain'], key['inbound_letter']), set()).update(ips)
+        ttl = int(os.getenv('DNS_TTL', '120'))
+        dns_summary = await reconcile_dns_records(desired, ttl)
+        for created in dns_summary['created']:
+            server = server_registry.get(created['ip'])
+            asyncio.create_task(delayed_webhook_check(created['ip'], server[1] if server else None, created['domain'], created['inbound_letter']))
+        if dns_summary['failed']:
+            # Снимок не фиксируем: следующее обновление повторит синхронизацию
+            logger.warning(f"DNS reconcile had {len(dns_summary['failed'])} failures, subscription will be synced again")
+        else:
+            await subscription_cache.commit(keys)
+        subscription_synced = True
         logger.info("VLESS keys updated successfully")
+        return {"changed": changed, "keys": keys_summary, "dns": dns_summary}
     except Exception as e:
         logger.error(f"Failed to update VLESS keys: {str(e)}\n{traceback.format_exc()}")
 
@@ -476,19 +361,29 @@ async def check_server_statuses():
         logger.debug("Checking server statuses")
         current_statuses = {}
         
-        servers = await get_servers()
+        servers = server_registry.all()
         valid_ips = {server[0] for server in servers if is_valid_ip(server[0])}
         logger.info(f"Valid server IPs from database: {valid_ips}")
 
+        snapshot = await get_metrics_snapshot(force=True)
+        in_restart_grace = await checker_control.in_restart_grace()
+        deferred = set()
         for server in servers:
             ip = server[0]
             if is_valid_ip(ip):
-                status = await check_ip_in_xray_checker(ip)
+                status = await check_ip_in_xray_checker(ip, snapshot)
+                if status == "unknown" and in_restart_grace:
+                    # unknown во время перезапуска чекера вызван рестартом, а не сервером
+                    deferred.add(ip)
+                    continue
                 current_statuses[ip] = status
                 logger.debug(f"IP {ip} status: {status}")
 
+        if deferred:
+            logger.info(f"Xray Checker restart in progress, deferring {len(deferred)} unknown statuses")
         if not current_statuses:
-            logger.error("No server statuses available")
+            if not deferred:
+                logger.error("No server statuses available")
             return
 
         logger.debug(f"Current statuses: {current_statuses}")
@@ -503,7 +398,7 @@ async def check_server_statuses():
             prev_status = previous_statuses.get(ip, None)
             logger.info(f"Processing IP {ip}: current={status}, previous={prev_status}, is_new={ip in new_servers}")
 
-            server = next((s for s in servers if s[0] == ip), None)
+            server = server_registry.get(ip)
             inbound_tag = server[1] if server else None
 
             if status != prev_status or prev_status is None or ip in new_servers:
@@ -518,38 +413,21 @@ async def check_server_statuses():
                         logger.debug(f"No previous status change for {ip}, duration set to 0")
 
                     if status in ["offline", "unknown"] and prev_status not in ["offline", "unknown"]:
-                        await log_server_event(ip, "offline_start", duration_seconds=0)
-                        logger.info(f"Logged offline_start for {ip}")
-                        webhook_payload = {
-                            "heartbeat": {"msg": "fail"},
-                            "monitor": {"description": ip}
-                        }
-                        await publish_webhook(ip, webhook_payload)
-                        await send_telegram_alert(ip, "offline", duration_minutes)
+                        notify_status(ip, "offline", duration_minutes, event_type="offline_start", duration_seconds=0, inbound_tag=inbound_tag)
+                        logger.info(f"Queued offline_start for {ip}")
                         last_offline_webhook[ip] = current_time
                         last_status_change_time[ip] = current_time
                     elif status == "online" and (prev_status in ["offline", "unknown", None] or ip in new_servers):
                         duration = int((current_time - last_status_change_time.get(ip, current_time)).total_seconds())
-                        await log_server_event(ip, "offline_end" if prev_status else "online", duration_seconds=duration)
-                        logger.info(f"Logged {'offline_end' if prev_status else 'online'} for {ip}, duration={duration}s")
-                        webhook_payload = {
-                            "heartbeat": {"msg": "ok"},
-                            "monitor": {"description": ip}
-                        }
-                        await publish_webhook(ip, webhook_payload)
-                        await send_telegram_alert(ip, "online", duration_minutes)
+                        event_type = "offline_end" if prev_status else "online"
+                        notify_status(ip, "online", duration_minutes, event_type=event_type, duration_seconds=duration, inbound_tag=inbound_tag)
+                        logger.info(f"Queued {event_type} for {ip}, duration={duration}s")
                         if ip in last_offline_webhook:
                             del last_offline_webhook[ip]
                         last_status_change_time[ip] = current_time
                     elif status in ["offline", "unknown"] and prev_status is None:
-                        await log_server_event(ip, "offline_start", duration_seconds=0)
-                        logger.info(f"Logged initial offline_start for {ip}")
-                        webhook_payload = {
-                            "heartbeat": {"msg": "fail"},
-                            "monitor": {"description": ip}
-                        }
-                        await publish_webhook(ip, webhook_payload)
-                        await send_telegram_alert(ip, "offline", duration_minutes)
+                        notify_status(ip, "offline", duration_minutes, event_type="offline_start", duration_seconds=0, inbound_tag=inbound_tag)
+                        logger.info(f"Queued initial offline_start for {ip}")
                         last_offline_webhook[ip] = current_time
                         last_status_change_time[ip] = current_time
                 except Exception as e:
@@ -559,62 +437,110 @@ async def check_server_statuses():
                 if (current_time - last_offline_webhook[ip]).total_seconds() >= 300:
                     logger.info(f"Publishing repeat offline webhook for {ip}")
                     duration_minutes = int((current_time - last_status_change_time.get(ip, current_time)).total_seconds() // 60)
-                    webhook_payload = {
-                        "heartbeat": {"msg": "fail"},
-                        "monitor": {"description": ip}
-                    }
-                    await publish_webhook(ip, webhook_payload)
-                    await send_telegram_alert(ip, "offline", duration_minutes)
+                    notify_status(ip, "offline", duration_minutes, inbound_tag=inbound_tag)
                     last_offline_webhook[ip] = current_time
 
         for ip, (payload, last_attempt) in list(pending_retries.items()):
             if current_time - last_attempt >= timedelta(minutes=5):
                 logger.info(f"Retrying webhook for {ip}")
                 duration_minutes = int((current_time - last_status_change_time.get(ip, current_time)).total_seconds() // 60)
-                await publish_webhook(ip, payload)
-                await send_telegram_alert(ip, "offline" if payload["heartbeat"]["msg"] == "fail" else "online", duration_minutes)
+                notify_status(ip, "offline" if payload["heartbeat"]["msg"] == "fail" else "online", duration_minutes)
                 del pending_retries[ip]
 
         if new_servers:
-            logger.debug(f"Clearing new_servers: {new_servers}")
-            new_servers.clear()
+            logger.debug(f"Clearing new_servers: {new_servers - deferred}")
+            # Отложенные новые серверы обработаем после перезапуска чекера
+            new_servers.intersection_update(deferred)
 
         previous_statuses.update(current_statuses)
         logger.debug(f"Updated previous statuses: {current_statuses}")
     except Exception as e:
         logger.error(f"Error in status check: {str(e)}\n{traceback.format_exc()}")
 
+def track_installed_server(ip, old, new):
+    """Установка или правка сервера в любом воркере обновляет install_date — ведущий заново отправит его статус."""
+    if monitoring_leader.is_leader and new is not None and (old is None or old[2] != new[2]):
+        new_servers.add(ip)
+
+server_registry.add_change_callback(track_installed_server)
+
+def reset_status_state():
+    for state in (previous_statuses, pending_retries, last_offline_webhook, last_status_change_time):
+        state.clear()
+    new_servers.clear()
+
+async def restore_status_state():
+    """Восстанавливает статусы из журнала событий, чтобы новый ведущий не рассылал уведомления повторно."""
+    now = datetime.utcnow()
+    for ip, (offline_since, last_event_time) in (await get_uptime_states()).items():
+        if offline_since is not None:
+            previous_statuses[ip] = "offline"
+            last_status_change_time[ip] = offline_since
+            last_offline_webhook[ip] = now
+        elif last_event_time is not None:
+            previous_statuses[ip] = "online"
+            last_status_change_time[ip] = last_event_time
+    logger.info(f"Restored status state for {len(previous_statuses)} servers")
+
+async def start_leader_duties():
+    reset_status_state()
+    try:
+        await restore_status_state()
+    except Exception as e:
+        logger.error(f"Failed to restore status state, starting from scratch: {str(e)}\n{traceback.format_exc()}")
+    scheduler.resume()
+    logger.info("Monitoring and subscription jobs resumed on this worker")
+
+async def stop_leader_duties():
+    scheduler.pause()
+    reset_status_state()
+    logger.info("Monitoring and subscription jobs paused on this worker")
+
+# Задачи планировщика выполняет только ведущий воркер; у остальных планировщик на паузе
 scheduler = AsyncIOScheduler()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     global db_pool
     try:
-        await init_db()
-        db_pool = await asyncpg.create_pool(
-            database=os.getenv('LOCAL_DB_DBNAME'),
-            user=os.getenv('LOCAL_DB_USER'),
-            password=os.getenv('LOCAL_DB_PASSWORD'),
-            host=os.getenv('LOCAL_DB_HOST', 'localhost'),
-            port=int(os.getenv('LOCAL_DB_PORT', '5432')),
-            min_size=1,
-            max_size=10
-        )
+        db_pool = await create_pool()
+        set_pool(db_pool)
         logger.info("Database pool initialized")
+        await init_db()
+        await server_registry.start()
+        event_writer.start()
+        await http_clients.start()
+        ssh_pool.start()
+        subscription_cache.load()
         if not await init_rabbit():
             logger.warning("Continuing without RabbitMQ; webhook functionality will be disabled")
         else:
             logger.info("RabbitMQ initialized")
+        telegram_notifier.start()
+        notification_pipeline.start()
         scheduler.add_job(update_vless_keys_from_subscription, 'interval', hours=int(os.getenv('SUBSCRIPTION_REFRESH_HOURS', 1)))
         scheduler.add_job(check_server_statuses, 'interval', minutes=1)
-        scheduler.start()
+        scheduler.add_job(run_event_retention, 'interval', hours=24)
+        scheduler.start(paused=True)
+        await monitoring_leader.start(start_leader_duties, stop_leader_duties)
+        job_queue.start()
         yield
     except Exception as e:
         logger.error(f"Failed to initialize: {str(e)}\n{traceback.format_exc()}")
         raise
     finally:
+        await job_queue.stop()
+        await monitoring_leader.stop()
+        await notification_pipeline.stop()
+        await telegram_notifier.stop()
+        await http_clients.close()
+        await checker_control.close()
+        await ssh_pool.close()
         if db_pool:
-            await db_pool.close()
+            await event_writer.stop()
+            await server_registry.stop()
+            await close_pool()
+            db_pool = None
             logger.info("Database pool closed")
         if rabbitmq_connection and not rabbitmq_connection.is_closed:
             await rabbitmq_connection.close()
@@ -721,7 +647,7 @@ async def get_inbound_tags():
 @app.get("/api/scripts")
 async def get_scripts():
     try:
-        scripts = [f for f in os.listdir(Config.SCRIPTS_PATH) if f.endswith('.sh')]
+        scripts = await script_index.names()
         if not scripts:
             logger.warning("No scripts found in scripts directory")
             return {"scripts": []}
@@ -761,155 +687,168 @@ async def update_settings(settings: dict):
 @app.post("/api/refresh_keys")
 async def refresh_keys():
     try:
-        await update_vless_keys_from_subscription()
+        summary = await update_vless_keys_from_subscription(force=True)
         logger.info("Keys refreshed successfully")
-        return {"message": "Keys refreshed"}
+        return {"message": "Keys refreshed", "summary": summary}
     except Exception as e:
         logger.error(f"Failed to refresh keys: {str(e)}\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail="Failed to refresh keys")
 
+def validate_ips(ips):
+    for ip in ips:
+        if not is_valid_ip(ip):
+            logger.error(f"Invalid IP address: {ip}")
+            raise HTTPException(status_code=400, detail=f"Invalid IP address: {ip}")
+
+async def validate_location(inbound_tag):
+    try:
+        key, _ = await get_location_key(inbound_tag)
+    except ValueError as e:
+        logger.error(f"Invalid VLESS key for {inbound_tag}: {str(e)}")
+        raise HTTPException(status_code=400, detail=str(e))
+    if not key:
+        logger.error(f"Location {inbound_tag} not found")
+        raise HTTPException(status_code=400, detail=f"Location {inbound_tag} not found")
+
+async def setup_server_host(ip, params, on_output=None):
+    """Задача установки одного сервера: outbound в чекере, скрипт локации (если задан), запись в БД и DNS."""
+    inbound_tag = params['inbound_tag']
+    script_name = params.get('script_name')
+    try:
+        key, key_data = await get_location_key(inbound_tag)
+    except ValueError as e:
+        logger.error(f"Invalid VLESS key for {inbound_tag}: {str(e)}")
+        return {"success": False, "message": str(e), "retryable": False}
+    if not key:
+        logger.error(f"Location {inbound_tag} not found")
+        return {"success": False, "message": f"Location {inbound_tag} not found", "retryable": False}
+    # Перезапуски чекера от параллельных задач склеиваются в один
+    sync_result = (await sync_xray_checker_outbounds({ip: create_outbound_json(ip, inbound_tag, key['vless_key'])}))[ip]
+    if not sync_result["success"]:
+        return {"success": False, "message": "Failed to update Xray Checker JSON"}
+    if script_name:
+        logger.info(f"Attempting to deploy script {script_name} on {ip}")
+        success, message = await deploy_script(ip, script_name, on_output)
+        logger.debug(f"deploy_script result for {ip}: success={success}, message={message}")
+        if not success:
+            logger.error(f"Failed to deploy script on {ip}: {message}")
+            return {"success": False, "message": message}
+    async with db_pool.acquire() as conn:
+        await conn.execute(
+            """
+            INSERT INTO servers (ip, inbound_tag, install_date)
+            VALUES ($1, $2, CURRENT_TIMESTAMP)
+            ON CONFLICT (ip) DO UPDATE
+            SET inbound_tag = $2, install_date = CURRENT_TIMESTAMP
+            """,
+            ip, inbound_tag
+        )
+    logger.debug(f"DB updated for {ip}")
+    await asyncio.sleep(float(os.getenv('SERVER_SETUP_DNS_DELAY', '5')))
+    if key.get('domain') and key_data.get('inbound_letter'):
+        try:
+            ttl = int(os.getenv('DNS_TTL', '120'))
+            await create_dns_record(ip, key_data['inbound_letter'], ttl, key['domain'])
+            logger.info(f"Created DNS record for {ip} with inbound_letter {key_data['inbound_letter']} and domain {key['domain']}")
+            asyncio.create_task(delayed_webhook_check(ip, inbound_tag, key['domain'], key_data['inbound_letter']))
+        except Exception as e:
+            logger.error(f"Failed to create DNS record for {ip}: {str(e)}\n{traceback.format_exc()}")
+            # После выполненного скрипта повтор переустановил бы хост
+            return {"success": False, "message": f"Failed to create DNS record: {str(e)}", "retryable": not script_name}
+    logger.info(f"Server {ip} added/updated successfully")
+    return {"success": True, "message": "Server added successfully"}
+
+async def run_script_job(ip, params, on_output=None):
+    logger.info(f"Attempting to run script {params['script_name']} on {ip}")
+    success, message = await deploy_script(ip, params['script_name'], on_output)
+    return {"success": success, "message": message}
+
+async def reboot_job(ip, params, on_output=None):
+    logger.info(f"Attempting to reboot server {ip}")
+    success, message = await deploy_script(ip, "reboot.sh", on_output)
+    return {"success": success, "message": message}
+
+def rollout_params(options: Optional[RolloutOptions]):
+    """Параметры раскатки волнами с умолчаниями из окружения; None — все хосты сразу."""
+    if options is None:
+        return None
+    if options.wave_size < 1:
+        raise HTTPException(status_code=400, detail="wave_size must be at least 1")
+    rollout = {
+        "wave_size": options.wave_size,
+        "wave_delay": options.wave_delay if options.wave_delay is not None else float(os.getenv('ROLLOUT_WAVE_DELAY', '30')),
+        "health_timeout": options.health_timeout if options.health_timeout is not None else float(os.getenv('ROLLOUT_HEALTH_TIMEOUT', '300')),
+        "max_failure_ratio": options.max_failure_ratio if options.max_failure_ratio is not None else float(os.getenv('ROLLOUT_MAX_FAILURE_RATIO', '0.2'))
+    }
+    if rollout["wave_delay"] < 0 or rollout["health_timeout"] < 0 or not 0 <= rollout["max_failure_ratio"] <= 1:
+        raise HTTPException(status_code=400, detail="Invalid rollout options")
+    return rollout
+
+async def wait_wave_online(ips, params, finished_at, rebooted=False):
+    """Ждёт, пока хосты волны вернутся после задачи; возвращает так и не поднявшиеся.
+
+    Чекер может ещё показывать online из проверки до задачи, поэтому кроме
+    статуса в метриках нужен свежий ответ хоста: TCP-проба SSH-порта, а после
+    перезагрузки — аптайм меньше времени, прошедшего с завершения задачи.
+    """
+    poll_interval = float(os.getenv('ROLLOUT_HEALTH_POLL_INTERVAL', '10'))
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + params["rollout"]["health_timeout"]
+
+    async def back_online(ip, snapshot):
+        if get_snapshot_status(snapshot, ip) != "online":
+            return False
+        if not (await probe_tcp(ip))["reachable"]:
+            return False
+        if not rebooted:
+            return True
+        uptime = await get_host_uptime(ip)
+        return uptime is not None and uptime < loop.time() - finished_at[ip]
+
+    pending = list(ips)
+    while True:
+        # Снимок с возрастом не больше интервала опроса делят все проверяемые волны
+        snapshot = await get_metrics_snapshot(max_age=poll_interval)
+        checks = await asyncio.gather(*(back_online(ip, snapshot) for ip in pending))
+        pending = [ip for ip, ok in zip(pending, checks) if not ok]
+        if not pending or loop.time() >= deadline:
+            return sorted(pending)
+        await asyncio.sleep(poll_interval)
+
+async def wait_wave_rebooted(ips, params, finished_at):
+    return await wait_wave_online(ips, params, finished_at, rebooted=True)
+
+# Повтор add_server заново запустил бы скрипт установки на хосте, поэтому его не повторяем.
+# Ручное добавление без скрипта сводится к синхронизации файла, upsert в БД и DNS — его повторять безопасно
+job_queue.register("add_server", setup_server_host, concurrency=10, max_attempts=1)
+job_queue.register("add_server_manual", setup_server_host, concurrency=20, max_attempts=3)
+job_queue.register("run_script", run_script_job, concurrency=int(os.getenv('RUN_SCRIPTS_CONCURRENCY', '5')), health_check=wait_wave_online)
+job_queue.register("reboot", reboot_job, concurrency=5, health_check=wait_wave_rebooted)
+
 @app.post("/api/add_server")
 async def add_server_api(request: AddServerRequest):
     logger.debug(f"Received /api/add_server request: {request}")
-    try:
-        for ip in request.ips:
-            if not is_valid_ip(ip):
-                logger.error(f"Invalid IP address: {ip}")
-                raise HTTPException(status_code=400, detail=f"Invalid IP address: {ip}")
-    except ValueError:
-        logger.error(f"Invalid IP address in {request.ips}\n{traceback.format_exc()}")
-        raise HTTPException(status_code=400, detail="Invalid IP address")
+    validate_ips(request.ips)
     script_name = get_script_name(request.inbound_tag)
-    script_path = os.path.join(Config.SCRIPTS_PATH, script_name)
-    if not os.path.exists(script_path):
-        logger.error(f"Script {script_path} not found for inbound_tag: {request.inbound_tag}")
+    if not await script_index.get(script_name):
+        logger.error(f"Script {script_name} not found for inbound_tag: {request.inbound_tag}")
         raise HTTPException(status_code=400, detail=f"Script {script_name} not found")
-    results = []
-    semaphore = asyncio.Semaphore(10)
-    async def deploy_and_add(ip):
-        async with semaphore:
-            logger.info(f"Attempting to deploy script {script_name} on {ip}")
-            try:
-                key = await get_vless_key(request.inbound_tag)
-                logger.debug(f"Retrieved VLESS key for {request.inbound_tag}: {key}")
-                if not key:
-                    logger.error(f"Location {request.inbound_tag} not found for {ip}")
-                    return {"ip": ip, "success": False, "message": f"Location {request.inbound_tag} not found"}
-                if await check_ip_in_xray_checker(ip) != "unknown":
-                    logger.debug(f"IP {ip} already in XrayChecker, forcing JSON update")
-                if not await update_xray_checker_json(ip, request.inbound_tag, key['vless_key']):
-                    return {"ip": ip, "success": False, "message": "Failed to update Xray Checker JSON"}
-                success, message = await deploy_script(ip, script_name)
-                logger.debug(f"deploy_script result for {ip}: success={success}, message={message}")
-                if not isinstance(success, bool):
-                    logger.error(f"Invalid success type from deploy_script: {success} for {ip}")
-                    return {"ip": ip, "success": False, "message": f"Invalid deploy_script response: {success}"}
-                if success:
-                    logger.debug(f"Acquiring DB connection for {ip}")
-                    async with db_pool.acquire() as conn:
-                        async with conn.transaction():
-                            await conn.execute(
-                                """
-                                INSERT INTO servers (ip, inbound_tag, install_date)
-                                VALUES ($1, $2, CURRENT_TIMESTAMP)
-                                ON CONFLICT (ip) DO UPDATE
-                                SET inbound_tag = $2, install_date = CURRENT_TIMESTAMP
-                                """,
-                                ip, request.inbound_tag
-                            )
-                    logger.debug(f"DB updated for {ip}")
-                    await asyncio.sleep(5)
-                    if key.get('domain'):
-                        key_data = parse_vless_key(key['vless_key'])
-                        if key_data.get('inbound_letter'):
-                            try:
-                                ttl = int(os.getenv('DNS_TTL', '120'))
-                                await create_dns_record(ip, key_data['inbound_letter'], ttl, key['domain'])
-                                logger.info(f"Created DNS record for {ip} with inbound_letter {key_data['inbound_letter']} and domain {key['domain']}")
-                                asyncio.create_task(delayed_webhook_check(ip, request.inbound_tag, key['domain'], key_data['inbound_letter']))
-                            except Exception as e:
-                                logger.error(f"Failed to create DNS record for {ip}: {str(e)}\n{traceback.format_exc()}")
-                                return {"ip": ip, "success": False, "message": f"Failed to create DNS record: {str(e)}"}
-                    new_servers.add(ip)
-                    logger.info(f"Server {ip} added/updated successfully")
-                    return {"ip": ip, "success": True, "message": "Server added successfully"}
-                logger.error(f"Failed to deploy script on {ip}: {message}")
-                return {"ip": ip, "success": False, "message": message}
-            except Exception as e:
-                logger.error(f"Error deploying script on {ip}: {str(e)}\n{traceback.format_exc()}")
-                return {"ip": ip, "success": False, "message": str(e)}
-    tasks = [deploy_and_add(ip) for ip in request.ips]
-    results = await asyncio.gather(*tasks)
-    response = {"results": results}
-    logger.info(f"Batch server setup completed: {response}")
-    return response
+    await validate_location(request.inbound_tag)
+    job_id = await job_queue.submit("add_server", {"inbound_tag": request.inbound_tag, "script_name": script_name}, request.ips)
+    return {"job_id": job_id}
 
 @app.post("/api/add_server_manual")
 async def add_server_manual_api(request: AddServerRequest):
     logger.debug(f"Received /api/add_server_manual request: {request}")
-    try:
-        for ip in request.ips:
-            if not is_valid_ip(ip):
-                logger.error(f"Invalid IP address: {ip}")
-                raise HTTPException(status_code=400, detail="Invalid IP address")
-    except ValueError:
-        logger.error(f"Invalid IP address in {request.ips}\n{traceback.format_exc()}")
-        raise HTTPException(status_code=400, detail="Invalid IP address")
-    results = []
-    for ip in request.ips:
-        logger.info(f"Attempting to add server {ip} to database")
-        try:
-            key = await get_vless_key(request.inbound_tag)
-            logger.debug(f"Retrieved VLESS key for {request.inbound_tag}: {key}")
-            if not key:
-                logger.error(f"Location {request.inbound_tag} not found for {ip}")
-                results.append({"ip": ip, "success": False, "message": f"Location {request.inbound_tag} not found"})
-                continue
-            if await check_ip_in_xray_checker(ip) != "unknown":
-                logger.debug(f"IP {ip} already in XrayChecker, forcing JSON update")
-            if not await update_xray_checker_json(ip, request.inbound_tag, key['vless_key']):
-                results.append({"ip": ip, "success": False, "message": "Failed to update Xray Checker JSON"})
-                continue
-            logger.debug(f"Acquiring DB connection for {ip}")
-            async with db_pool.acquire() as conn:
-                async with conn.transaction():
-                    await conn.execute(
-                        """
-                        INSERT INTO servers (ip, inbound_tag, install_date)
-                        VALUES ($1, $2, CURRENT_TIMESTAMP)
-                        ON CONFLICT (ip) DO UPDATE
-                        SET inbound_tag = $2, install_date = CURRENT_TIMESTAMP
-                        """,
-                        ip, request.inbound_tag
-                    )
-            logger.debug(f"DB updated for {ip}")
-            await asyncio.sleep(5)
-            if key.get('domain'):
-                key_data = parse_vless_key(key['vless_key'])
-                if key_data.get('inbound_letter'):
-                    try:
-                        ttl = int(os.getenv('DNS_TTL', '120'))
-                        await create_dns_record(ip, key_data['inbound_letter'], ttl, key['domain'])
-                        logger.info(f"Created DNS record for {ip} with inbound_letter {key_data['inbound_letter']} and domain {key['domain']}")
-                        asyncio.create_task(delayed_webhook_check(ip, request.inbound_tag, key['domain'], key_data['inbound_letter']))
-                    except Exception as e:
-                        logger.error(f"Failed to create DNS record for {ip}: {str(e)}\n{traceback.format_exc()}")
-                        results.append({"ip": ip, "success": False, "message": f"Failed to create DNS record: {str(e)}"})
-                        continue
-            new_servers.add(ip)
-            logger.info(f"Server {ip} added/updated successfully")
-            results.append({"ip": ip, "success": True, "message": "Server added successfully"})
-        except Exception as e:
-            logger.error(f"Error adding server {ip}: {str(e)}\n{traceback.format_exc()}")
-            results.append({"ip": ip, "success": False, "message": str(e)})
-    response = {"results": results}
-    logger.info(f"Manual server addition completed: {response}")
-    return response
+    validate_ips(request.ips)
+    await validate_location(request.inbound_tag)
+    job_id = await job_queue.submit("add_server_manual", {"inbound_tag": request.inbound_tag}, request.ips)
+    return {"job_id": job_id}
 
 @app.get("/api/servers")
 async def get_servers_api():
     try:
-        servers = await get_servers()
+        servers = server_registry.all()
         formatted_servers = [
             {
                 'ip': s[0],
@@ -932,19 +871,15 @@ async def delete_server_api(ip: str = Query(...)):
         logger.error(f"Invalid IP address for deletion: {ip}\n{traceback.format_exc()}")
         raise HTTPException(status_code=400, detail="Invalid IP address")
 
-    servers = await get_servers()
-    server = next((s for s in servers if s[0] == ip), None)
+    server = server_registry.get(ip)
     if not server:
         logger.error(f"Server {ip} not found in database")
         raise HTTPException(status_code=404, detail="Server not found")
     inbound_tag = server[1]
 
-    key = await get_vless_key(inbound_tag)
+    key, key_data = await get_location_key(inbound_tag)
     domain = key.get('domain') if key else None
-    inbound_letter = None
-    if key:
-        key_data = parse_vless_key(key['vless_key'])
-        inbound_letter = key_data.get('inbound_letter')
+    inbound_letter = key_data.get('inbound_letter') if key_data else None
 
     if not await delete_server(ip):
         logger.error(f"Failed to delete server {ip}: not found in database")
@@ -964,11 +899,9 @@ async def delete_server_api(ip: str = Query(...)):
         else:
             logger.warning(f"No domain or inbound_letter found for {ip} (inbound_tag: {inbound_tag})")
 
-        if not await remove_existing_json(ip):
+        if not (await sync_xray_checker_outbounds({ip: None}))[ip]["success"]:
             logger.error(f"Failed to remove JSON for {ip}")
             raise HTTPException(status_code=500, detail="Failed to remove JSON")
-        if not await restart_xray_checker():
-            logger.warning(f"Failed to restart Xray Checker for {ip}, but JSON removed")
         logger.info(f"Server {ip} deleted successfully from database, JSON removed")
         return {"message": "Server deleted successfully"}
     except Exception as e:
@@ -998,59 +931,87 @@ async def reboot_server_api(ip: str = Form(...)):
 @app.post("/api/reboot_servers")
 async def reboot_servers_api(request: RebootRequest):
     logger.info(f"Received mass reboot request for IPs: {request.ips}")
-    for ip in request.ips:
-        try:
-            ipaddress.ip_address(ip)
-        except ValueError:
-            logger.error(f"Invalid IP address: {ip}\n{traceback.format_exc()}")
-            raise HTTPException(status_code=400, detail=f"Invalid IP address: {ip}")
-    script_name = "reboot.sh"
-    results = []
-    semaphore = asyncio.Semaphore(5)
-    async def run_deploy_script(ip):
-        async with semaphore:
-            logger.info(f"Attempting to reboot server {ip} with script {script_name}")
-            try:
-                success, message = await deploy_script(ip, script_name)
-                return {"ip": ip, "success": success, "message": message}
-            except Exception as e:
-                logger.error(f"Exception in deploy_script for {ip}: {str(e)}\n{traceback.format_exc()}")
-                return {"ip": ip, "success": False, "message": str(e)}
-    tasks = [run_deploy_script(ip) for ip in request.ips]
-    results = await asyncio.gather(*tasks)
-    response = {"results": results}
-    logger.info(f"Mass reboot completed: {response}")
-    return response
+    validate_ips(request.ips)
+    params = {}
+    rollout = rollout_params(request.rollout)
+    if rollout:
+        params["rollout"] = rollout
+    job_id = await job_queue.submit("reboot", params, request.ips)
+    return {"job_id": job_id}
 
 @app.post("/api/run_scripts")
 async def run_scripts_api(request: RunScriptsRequest):
     logger.info(f"Received request to run script {request.script_name} on IPs: {request.ips}")
-    for ip in request.ips:
-        try:
-            ipaddress.ip_address(ip)
-        except ValueError:
-            logger.error(f"Invalid IP address: {ip}\n{traceback.format_exc()}")
-            raise HTTPException(status_code=400, detail=f"Invalid IP address: {ip}")
-    script_path = os.path.join(Config.SCRIPTS_PATH, request.script_name)
-    if not os.path.exists(script_path):
+    validate_ips(request.ips)
+    if not await script_index.get(request.script_name):
         logger.error(f"Script {request.script_name} not found in {Config.SCRIPTS_PATH}")
         raise HTTPException(status_code=400, detail=f"Script {request.script_name} not found")
-    results = []
-    semaphore = asyncio.Semaphore(5)
-    async def run_deploy_script(ip):
-        async with semaphore:
-            logger.info(f"Attempting to run script {request.script_name} on {ip}")
+    params = {"script_name": request.script_name}
+    rollout = rollout_params(request.rollout)
+    if rollout:
+        params["rollout"] = rollout
+    job_id = await job_queue.submit("run_script", params, request.ips)
+    return {"job_id": job_id}
+
+@app.get("/api/jobs/{job_id}")
+async def get_job_api(job_id: int):
+    job = await get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+FINISHED_TASK_STATUSES = ('succeeded', 'failed', 'unhealthy', 'cancelled')
+
+async def stream_job(job_id, job):
+    """SSE-поток задания: сначала уже завершённые задачи из БД, затем живые события.
+
+    События started, output, retry, result и итоговое done; события других
+    воркеров приходят через NOTIFY. Итоги, потерянные по дороге, досылаются
+    как result по периодическому опросу БД.
+    """
+    queue = job_queue.subscribe(job_id)
+    reported = set()
+    poll_interval = float(os.getenv('JOB_STREAM_POLL_INTERVAL', '5'))
+
+    def task_results(job):
+        for task in job["tasks"]:
+            if task["status"] in FINISHED_TASK_STATUSES and task["ip"] not in reported:
+                reported.add(task["ip"])
+                yield sse_event("result", {"ip": task["ip"], "success": task["status"] == "succeeded", "message": task["message"], "seq": 0})
+
+    try:
+        yield sse_event("job", {**{key: value for key, value in job.items() if key != "tasks"}, "total": len(job["tasks"])})
+        while True:
+            # Снимок читается после подписки, так что события между ними не теряются
+            job = await get_job(job_id)
+            if job is None:
+                return
+            for event in task_results(job):
+                yield event
+            if job["status"] not in ("queued", "running"):
+                yield sse_event("done", {"status": job["status"]})
+                return
             try:
-                success, message = await deploy_script(ip, script_name)
-                return {"ip": ip, "success": success, "message": message}
-            except Exception as e:
-                logger.error(f"Exception in deploy_script for {ip}: {str(e)}\n{traceback.format_exc()}")
-                return {"ip": ip, "success": False, "message": str(e)}
-    tasks = [run_deploy_script(ip) for ip in request.ips]
-    results = await asyncio.gather(*tasks)
-    response = {"results": results}
-    logger.info(f"Script execution completed: {response}")
-    return response
+                while True:
+                    event, data = await asyncio.wait_for(queue.get(), poll_interval)
+                    if event == "result":
+                        if data["ip"] in reported:
+                            continue
+                        reported.add(data["ip"])
+                    if event == "done":
+                        break
+                    yield sse_event(event, data)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        job_queue.unsubscribe(job_id, queue)
+
+@app.get("/api/jobs/{job_id}/stream")
+async def stream_job_api(job_id: int):
+    job = await get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return sse_response(stream_job(job_id, job))
 
 @app.post("/api/edit_server")
 async def edit_server_api(request: EditServerRequest):
@@ -1062,12 +1023,11 @@ async def edit_server_api(request: EditServerRequest):
         logger.error(f"Invalid IP: old_ip={request.old_ip}, new_ip={request.new_ip}\n{traceback.format_exc()}")
         raise HTTPException(status_code=400, detail="Invalid IP address")
     try:
-        servers = await get_servers()
-        server = next((s for s in servers if s[0] == request.old_ip), None)
+        server = server_registry.get(request.old_ip)
         if not server:
             logger.error(f"Server {request.old_ip} not found")
             raise HTTPException(status_code=404, detail="Server not found")
-        key = await get_vless_key(request.new_inbound_tag)
+        key, key_data = await get_location_key(request.new_inbound_tag)
         if not key:
             logger.error(f"Inbound tag {request.new_inbound_tag} not found")
             raise HTTPException(status_code=400, detail=f"Inbound tag {request.new_inbound_tag} not found")
@@ -1084,10 +1044,15 @@ async def edit_server_api(request: EditServerRequest):
                             logger.debug(f"No DNS record found for {request.old_ip} in domain {key['domain']}")
                     except Exception as e:
                         logger.error(f"Failed to delete DNS record for {request.old_ip}: {str(e)}")
-                    if not await remove_existing_json(request.old_ip):
-                        logger.error(f"Failed to remove JSON for {request.old_ip}")
-                        raise HTTPException(status_code=500, detail="Failed to remove old JSON")
-                if not await update_xray_checker_json(request.new_ip, request.new_inbound_tag, key['vless_key']):
+                # Удаление старого и запись нового outbound — одна синхронизация и один перезапуск
+                changes = {request.new_ip: create_outbound_json(request.new_ip, request.new_inbound_tag, key['vless_key'])}
+                if request.old_ip != request.new_ip:
+                    changes[request.old_ip] = None
+                sync_results = await sync_xray_checker_outbounds(changes)
+                if request.old_ip in changes and not sync_results[request.old_ip]["success"]:
+                    logger.error(f"Failed to remove JSON for {request.old_ip}")
+                    raise HTTPException(status_code=500, detail="Failed to remove old JSON")
+                if not sync_results[request.new_ip]["success"]:
                     logger.error(f"Failed to update JSON for {request.new_ip}")
                     raise HTTPException(status_code=500, detail="Failed to update Xray Checker JSON")
                 
@@ -1110,7 +1075,6 @@ async def edit_server_api(request: EditServerRequest):
         
         await asyncio.sleep(5)
         if key.get('domain'):
-            key_data = parse_vless_key(key['vless_key'])
             if key_data.get('inbound_letter'):
                 try:
                     ttl = int(os.getenv('DNS_TTL', '120'))
@@ -1120,7 +1084,6 @@ async def edit_server_api(request: EditServerRequest):
                 except Exception as e:
                     logger.error(f"Failed to create DNS record for {request.new_ip}: {str(e)}\n{traceback.format_exc()}")
                     raise HTTPException(status_code=500, detail=f"Failed to create DNS record: {str(e)}")
-        new_servers.add(request.new_ip)
         logger.info(f"Server updated: {request.old_ip} -> {request.new_ip}, inbound_tag: {request.new_inbound_tag}")
         return {"success": True, "message": "Server updated"}
     except Exception as e:
@@ -1137,15 +1100,33 @@ async def check_availability_api(ip: str):
     is_available, message = await check_server_availability(ip)
     return {"ip": ip, "available": is_available, "message": message}
 
+@app.post("/api/check_availability/bulk")
+async def check_availability_bulk_api(request: ProbeRequest):
+    for ip in request.ips:
+        if not is_valid_ip(ip):
+            logger.error(f"Invalid IP address: {ip}")
+            raise HTTPException(status_code=400, detail=f"Invalid IP address: {ip}")
+    if not 0 < request.port < 65536:
+        raise HTTPException(status_code=400, detail="Invalid port")
+    logger.info(f"Bulk availability check for {len(request.ips)} IPs on port {request.port}")
+
+    async def stream():
+        # NDJSON: по строке на адрес, как только проверка завершилась
+        async for result in probe_many(request.ips, request.port, request.timeout):
+            yield json.dumps(result) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
 @app.get("/api/server_status")
 async def get_server_status():
     try:
         statuses = {}
-        servers = await get_servers()
+        servers = server_registry.all()
+        snapshot = await get_metrics_snapshot()
         for server in servers:
             ip = server[0]
             if is_valid_ip(ip):
-                status = await check_ip_in_xray_checker(ip)
+                status = await check_ip_in_xray_checker(ip, snapshot)
                 statuses[ip] = status
                 logger.debug(f"IP {ip} status: {status}")
         logger.info(f"Parsed statuses: {statuses}")
@@ -1154,6 +1135,34 @@ async def get_server_status():
         logger.error(f"Error fetching server status: {str(e)}\n{traceback.format_exc()}")
         return {"statuses": {}}
 
+@app.get("/api/stats/notifications")
+async def get_notification_stats():
+    return {"stages": notification_pipeline.get_stats(), "telegram": telegram_notifier.get_stats()}
+
+@app.get("/api/stats/event_writer")
+async def get_event_writer_stats():
+    return event_writer.get_stats()
+
+@app.get("/api/stats/http")
+async def get_http_stats():
+    return {"upstreams": http_clients.get_stats(), "cloudflare": cloudflare_client.get_stats()}
+
+@app.get("/api/stats/ssh")
+async def get_ssh_stats():
+    return {"pool": ssh_pool.get_stats(), "checker": checker_control.get_stats()}
+
+@app.get("/api/stats/leader")
+async def get_leader_stats():
+    return monitoring_leader.get_stats()
+
+@app.get("/api/stats/registry")
+async def get_registry_stats():
+    return server_registry.get_stats()
+
+@app.get("/api/stats/jobs")
+async def get_job_stats():
+    return job_queue.get_stats()
+
 @app.get("/api/server_events")
 async def get_server_events_api(period: str = Query('24h'), server_ip: str = Query(None), limit: int = Query(100)):
     try:
@@ -1169,73 +1178,40 @@ async def get_server_events_api(period: str = Query('24h'), server_ip: str = Que
 async def get_uptime_summary(period: str = Query('24h')):
     try:
         period_hours = {'24h': 24, '7d': 168, '30d': 720}.get(period, 24)
-        servers = await get_servers()
-        statuses = (await get_server_status())['statuses']
-        events = await get_server_events(period_hours, limit=100)
-        logger.debug(f"Fetched {len(events)} events for uptime summary")
-        
+        period_seconds = period_hours * 3600
+        rollups = await get_uptime_rollups(period_hours)
+        snapshot = await get_metrics_snapshot()
+        current_time = datetime.utcnow()
+        window_start = current_time - timedelta(hours=period_hours)
+        logger.debug(f"Fetched uptime rollups for {len(rollups)} servers")
+
         summary = []
-        for server in servers:
-            ip = server[0]
+        for row in rollups:
+            ip = row['server_ip']
             if not is_valid_ip(ip):
                 continue
-            server_events = [e for e in events if e['server_ip'] == ip]
-            total_events = len([e for e in server_events if e['event_type'] in ['online', 'offline_start', 'offline_end']])
-            
-            logger.debug(f"Processing uptime for {ip}: status={statuses.get(ip, 'unknown')}, events={len(server_events)}")
-            
-            offline_periods = []
-            offline_start = None
-            for event in sorted(server_events, key=lambda x: x['event_time']):
-                event_time = datetime.fromisoformat(event['event_time'].replace('Z', '+00:00'))
-                logger.debug(f"Event for {ip}: type={event['event_type']}, time={event_time}")
-                if event['event_type'] == 'offline_start':
-                    offline_start = event_time
-                elif event['event_type'] == 'offline_end' and offline_start:
-                    offline_periods.append((offline_start, event_time))
-                    offline_start = None
-            
-            current_status = statuses.get(ip, 'unknown')
-            last_check = last_check_time.get(ip, datetime.utcnow())
-            logger.debug(f"Last check for {ip}: {last_check}")
-            
-            if current_status in ['offline', 'unknown']:
-                start_time = offline_start if offline_start else last_check
-                if start_time > datetime.utcnow() - timedelta(hours=period_hours):
-                    offline_periods.append((start_time, datetime.utcnow()))
-                else:
-                    offline_periods.append((datetime.utcnow() - timedelta(hours=period_hours), datetime.utcnow()))
-            
-            logger.debug(f"Offline periods for {ip}: {[(start.isoformat(), end.isoformat()) for start, end in offline_periods]}")
-            
-            total_offline_seconds = sum(
-                max(0, min((end - start).total_seconds(), period_hours * 3600))
-                for start, end in offline_periods
-                if (end - start).total_seconds() > 0
-            )
-            
-            period_seconds = period_hours * 3600
+            current_status = get_snapshot_status(snapshot, ip)
+            total_offline_seconds = row['offline_seconds']
+            # Незавершённый простой ещё не попал в агрегаты
+            if row['offline_since']:
+                total_offline_seconds += max(0, (current_time - max(row['offline_since'], window_start)).total_seconds())
+            total_offline_seconds = min(total_offline_seconds, period_seconds)
+
             uptime_seconds = max(0, period_seconds - total_offline_seconds)
             uptime_percentage = min(100.0, max(0.0, (uptime_seconds / period_seconds * 100) if period_seconds > 0 else 0.0))
-            
-            last_status_change = None
-            for event in sorted(server_events, key=lambda x: x['event_time'], reverse=True):
-                if event['event_type'] in ['online', 'offline_start', 'offline_end']:
-                    last_status_change = event['event_time']
-                    break
-            if not last_status_change or current_status in ['offline', 'unknown']:
-                last_status_change = last_check.isoformat()
-            
-            logger.debug(f"Uptime for {ip}: {uptime_percentage}%, offline_seconds={total_offline_seconds}, events={total_events}")
-            
+
+            last_status_change = row['offline_since'] or row['last_event_time'] or last_check_time.get(ip, current_time)
+
+            logger.debug(f"Uptime for {ip}: {uptime_percentage}%, offline_seconds={total_offline_seconds}, events={row['events']}")
+
             summary.append({
                 'server_ip': ip,
                 'current_status': current_status,
                 'uptime_percentage': round(uptime_percentage, 1),
-                'total_events': total_events,
-                'last_status_change': last_status_change
+                'total_events': row['events'],
+                'last_status_change': last_status_change.isoformat()
             })
-        
+
         logger.info(f"Returning uptime summary for {len(summary)} servers")
         return {"data": summary}
     except Exception as e:
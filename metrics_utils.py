@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import os
+import time
+import traceback
+from datetime import datetime
+from http_utils import http_clients
+
+logger = logging.getLogger(__name__)
+
+STATUS_METRIC = 'xray_proxy_status'
+LATENCY_METRIC = 'xray_proxy_latency_ms'
+
+_snapshot = {
+    "servers": {},
+    "scraped_at": None,
+    "monotonic": None,
+    "ok": False
+}
+_scrape_lock = asyncio.Lock()
+
+def get_metrics_max_age() -> float:
+    """Максимальный возраст снимка метрик в секундах."""
+    return float(os.getenv('XRAY_METRICS_MAX_AGE', '30'))
+
+def get_metrics_url() -> str:
+    host = 'localhost' if os.getenv('XRAY_CHECKER_HOST') in ['localhost', '127.0.0.1'] else os.getenv('XRAY_CHECKER_HOST')
+    return f"http://{host}:{os.getenv('XRAY_CHECKER_PORT')}/metrics"
+
+def _parse_address(labels: str):
+    start = labels.find('address="')
+    if start == -1:
+        return None
+    start += len('address="')
+    end = labels.find('"', start)
+    if end == -1:
+        return None
+    address = labels[start:end]
+    host = address.rsplit(':', 1)[0] if ':' in address else address
+    return host.strip('[]')
+
+def parse_metrics(text: str, scraped_at: datetime) -> dict:
+    """Разбирает текст Prometheus за один проход в словарь {адрес: состояние}."""
+    servers = {}
+    for line in text.splitlines():
+        if line.startswith(STATUS_METRIC + '{'):
+            field = 'status_value'
+        elif line.startswith(LATENCY_METRIC + '{'):
+            field = 'latency_ms'
+        else:
+            continue
+        labels_end = line.rfind('}')
+        if labels_end == -1:
+            continue
+        address = _parse_address(line[:labels_end])
+        if not address:
+            continue
+        value_parts = line[labels_end + 1:].split()
+        if not value_parts:
+            continue
+        try:
+            value = float(value_parts[0])
+        except ValueError:
+            continue
+        entry = servers.setdefault(address, {"status_value": None, "latency_ms": None})
+        # Как и раньше, учитываем первое вхождение адреса для каждой метрики
+        if entry[field] is None:
+            entry[field] = value
+    for address, entry in servers.items():
+        status_value = entry.pop("status_value")
+        if status_value is not None:
+            entry["status"] = "online" if status_value == 1 else "offline"
+        else:
+            entry["status"] = "online" if entry["latency_ms"] > 0 else "offline"
+        if entry["latency_ms"] is not None:
+            entry["latency_ms"] = int(entry["latency_ms"])
+        entry["scraped_at"] = scraped_at
+    return servers
+
+async def _scrape_metrics():
+    url = get_metrics_url()
+    scraped_at = datetime.utcnow()
+    try:
+        async with http_clients.request('xray_checker', 'GET', url) as response:
+            if response.status != 200:
+                logger.error(f"Xray Checker metrics status: {response.status}")
+                return {}, scraped_at, False
+            metrics = await response.text()
+        started = time.monotonic()
+        servers = parse_metrics(metrics, scraped_at)
+        logger.debug(f"Parsed metrics for {len(servers)} addresses ({len(metrics)} bytes) in {(time.monotonic() - started) * 1000:.1f} ms")
+        return servers, scraped_at, True
+    except Exception as e:
+        logger.error(f"Error scraping Xray Checker metrics: {str(e)}\n{traceback.format_exc()}")
+        return {}, scraped_at, False
+
+def _is_fresh(max_age: float) -> bool:
+    return _snapshot["monotonic"] is not None and time.monotonic() - _snapshot["monotonic"] < max_age
+
+async def get_metrics_snapshot(max_age: float = None, force: bool = False) -> dict:
+    """Возвращает снимок метрик, при необходимости обновляя его одним запросом к /metrics."""
+    if max_age is None:
+        max_age = get_metrics_max_age()
+    if not force and _is_fresh(max_age):
+        return _snapshot
+    scrape_started = time.monotonic()
+    async with _scrape_lock:
+        # Пока ждали блокировку, снимок мог обновить другой вызов
+        if _snapshot["monotonic"] is not None and _snapshot["monotonic"] >= scrape_started:
+            return _snapshot
+        if not force and _is_fresh(max_age):
+            return _snapshot
+        servers, scraped_at, ok = await _scrape_metrics()
+        _snapshot.update({
+            "servers": servers,
+            "scraped_at": scraped_at,
+            "monotonic": time.monotonic(),
+            "ok": ok
+        })
+        logger.info(f"Xray Checker metrics snapshot refreshed: ok={ok}, addresses={len(servers)}")
+    return _snapshot
+
+def get_snapshot_status(snapshot: dict, ip: str) -> str:
+    entry = snapshot["servers"].get(ip)
+    return entry["status"] if entry else "unknown"
+
+def invalidate_metrics_snapshot():
+    _snapshot["monotonic"] = None
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import os
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+class PipelineStage:
+    """Этап доставки уведомлений: своя ограниченная очередь и пул воркеров."""
+
+    def __init__(self, name, handler, workers=1, maxsize=1000):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.tasks = []
+        self.stats = {
+            "enqueued": 0,
+            "processed": 0,
+            "failed": 0,
+            "dropped": 0,
+            "max_depth": 0,
+            "last_latency_ms": None,
+            "max_latency_ms": 0.0
+        }
+
+    def submit(self, event) -> bool:
+        try:
+            self.queue.put_nowait((time.monotonic(), event))
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            logger.error(f"Notification stage {self.name} is full ({self.queue.maxsize}), dropping event for {event.get('ip')}")
+            return False
+        self.stats["enqueued"] += 1
+        self.stats["max_depth"] = max(self.stats["max_depth"], self.queue.qsize())
+        return True
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def _worker(self):
+        while True:
+            enqueued_at, event = await self.queue.get()
+            try:
+                await self.handler(event)
+                self.stats["processed"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.error(f"Notification stage {self.name} failed for {event.get('ip')}: {str(e)}\n{traceback.format_exc()}")
+            finally:
+                latency_ms = (time.monotonic() - enqueued_at) * 1000
+                self.stats["last_latency_ms"] = round(latency_ms, 1)
+                self.stats["max_latency_ms"] = round(max(self.stats["max_latency_ms"], latency_ms), 1)
+                self.queue.task_done()
+
+    async def stop(self, timeout):
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Notification stage {self.name} stopped with {self.queue.qsize()} undelivered events")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def get_stats(self) -> dict:
+        return {"depth": self.queue.qsize(), "capacity": self.queue.maxsize, "workers": self.workers, **self.stats}
+
+class NotificationPipeline:
+    """Принимает переходы статусов без ожидания доставки и раздаёт их по этапам."""
+
+    def __init__(self):
+        self.stages = {}
+
+    def add_stage(self, name, handler, workers=1):
+        maxsize = int(os.getenv('NOTIFY_QUEUE_SIZE', '10000'))
+        self.stages[name] = PipelineStage(name, handler, workers=workers, maxsize=maxsize)
+
+    def start(self):
+        for stage in self.stages.values():
+            stage.start()
+        logger.info(f"Notification pipeline started with stages: {list(self.stages)}")
+
+    def submit(self, event: dict):
+        for stage in self.stages.values():
+            stage.submit(event)
+
+    async def stop(self):
+        timeout = float(os.getenv('NOTIFY_DRAIN_TIMEOUT', '10'))
+        await asyncio.gather(*(stage.stop(timeout) for stage in self.stages.values()))
+        logger.info("Notification pipeline stopped")
+
+    def get_stats(self) -> dict:
+        return {name: stage.get_stats() for name, stage in self.stages.items()}
@@ -0,0 +1,54 @@
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+def get_probe_timeout() -> float:
+    return float(os.getenv('PROBE_TIMEOUT', '5'))
+
+def get_probe_concurrency() -> int:
+    return int(os.getenv('PROBE_CONCURRENCY', '500'))
+
+async def probe_tcp(ip: str, port: int = 22, timeout: float = None) -> dict:
+    """Проверяет TCP-доступность ip:port без блокировки цикла событий."""
+    if timeout is None:
+        timeout = get_probe_timeout()
+    started = time.monotonic()
+    result = {"ip": ip, "port": port, "reachable": False, "latency_ms": None, "error": None}
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+        result["reachable"] = True
+        result["latency_ms"] = round((time.monotonic() - started) * 1000, 1)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+    except asyncio.TimeoutError:
+        result["error"] = "timeout"
+    except OSError as e:
+        result["error"] = e.strerror or str(e)
+    return result
+
+async def probe_many(ips, port: int = 22, timeout: float = None, concurrency: int = None):
+    """Проверяет множество адресов параллельно, не больше concurrency одновременно.
+
+    Отдаёт результаты по мере готовности.
+    """
+    semaphore = asyncio.Semaphore(concurrency or get_probe_concurrency())
+
+    async def probe(ip):
+        async with semaphore:
+            return await probe_tcp(ip, port, timeout)
+
+    tasks = [asyncio.create_task(probe(ip)) for ip in dict.fromkeys(ips)]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        # Клиент мог отключиться посреди потока — оставшиеся проверки не нужны
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
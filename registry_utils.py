@@ -0,0 +1,172 @@
+import asyncio
+import json
+import logging
+import os
+import traceback
+from datetime import datetime
+from db import create_connection, SELECT_SERVERS, SERVERS_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+class ServerRegistry:
+    """Серверы в памяти процесса с индексами по IP и inbound_tag.
+
+    Загружается один раз при старте, дальше обновляется уведомлениями
+    триггера на servers (LISTEN servers_changed). Соединение LISTEN
+    проверяется периодически; после его потери реестр перечитывается
+    целиком, чтобы не пропустить изменения за время обрыва.
+    Серверы хранятся кортежами (ip, inbound_tag, install_date), как их отдаёт get_servers.
+    Колбэки add_change_callback получают (ip, было, стало) на каждое уведомление.
+    """
+
+    def __init__(self):
+        self.by_ip = {}
+        self.by_tag = {}
+        self.loaded = False
+        self._conn = None
+        self._task = None
+        self._stopping = False
+        # Соединение LISTEN не допускает параллельных запросов: проверка и перечитывание идут по очереди
+        self._lock = asyncio.Lock()
+        self._buffer = None
+        self.check_interval = float(os.getenv('SERVER_REGISTRY_CHECK_INTERVAL', '30'))
+        self.stats = {"reloads": 0, "notifications": 0, "reconnects": 0}
+        self.callbacks = []
+
+    async def start(self):
+        self._stopping = False
+        await self._connect()
+        self._task = asyncio.create_task(self._watch())
+        logger.info(f"Server registry loaded: {len(self.by_ip)} servers")
+
+    async def stop(self):
+        self._stopping = True
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self._close()
+
+    async def _connect(self):
+        self._conn = await create_connection()
+        await self._conn.add_listener(SERVERS_CHANNEL, self._on_notify)
+        # Читаем таблицу уже после LISTEN: изменения между ними придут уведомлением
+        await self.reload()
+
+    async def _close(self):
+        if self._conn is not None and not self._conn.is_closed():
+            try:
+                await self._conn.close()
+            except Exception as e:
+                logger.debug(f"Error closing server registry connection: {str(e)}")
+        self._conn = None
+
+    async def _watch(self):
+        while not self._stopping:
+            await asyncio.sleep(self.check_interval)
+            try:
+                if self._conn is None or self._conn.is_closed():
+                    self.stats["reconnects"] += 1
+                    logger.warning("Server registry listener lost, reconnecting")
+                    await self._close()
+                    await self._connect()
+                else:
+                    async with self._lock:
+                        await self._conn.execute('SELECT 1')
+            except Exception as e:
+                logger.error(f"Server registry listener check failed: {str(e)}\n{traceback.format_exc()}")
+                await self._close()
+
+    async def reload(self):
+        async with self._lock:
+            # Уведомления, пришедшие во время выборки, могут быть новее снимка:
+            # копим их и применяем поверх новых индексов
+            self._buffer = []
+            try:
+                rows = await self._conn.fetch(SELECT_SERVERS)
+                by_ip = {row['ip']: (row['ip'], row['inbound_tag'], row['install_date']) for row in rows}
+                by_tag = {}
+                for ip, inbound_tag, _ in by_ip.values():
+                    by_tag.setdefault(inbound_tag, set()).add(ip)
+                self.by_ip = by_ip
+                self.by_tag = by_tag
+                self.loaded = True
+                self.stats["reloads"] += 1
+            finally:
+                buffered, self._buffer = self._buffer, None
+                for change in buffered:
+                    self._apply(change)
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self.stats["notifications"] += 1
+        try:
+            change = json.loads(payload)
+        except Exception as e:
+            logger.error(f"Invalid servers change notification {payload}: {str(e)}\n{traceback.format_exc()}")
+            return
+        if self._buffer is not None:
+            self._buffer.append(change)
+        else:
+            self._apply(change)
+
+    def _apply(self, change):
+        try:
+            if change['op'] == 'reload':
+                asyncio.create_task(self.reload())
+            elif change['op'] == 'delete':
+                self._remove(change['ip'])
+            elif change['op'] == 'upsert':
+                install_date = datetime.fromisoformat(change['install_date']) if change['install_date'] else None
+                self._put(change['ip'], change['inbound_tag'], install_date)
+        except Exception as e:
+            logger.error(f"Invalid servers change notification {change}: {str(e)}\n{traceback.format_exc()}")
+
+    def add_change_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def _notify_callbacks(self, ip, old, new):
+        for callback in self.callbacks:
+            try:
+                callback(ip, old, new)
+            except Exception as e:
+                logger.error(f"Server registry callback failed for {ip}: {str(e)}\n{traceback.format_exc()}")
+
+    def _put(self, ip, inbound_tag, install_date):
+        old = self._discard(ip)
+        self.by_ip[ip] = (ip, inbound_tag, install_date)
+        self.by_tag.setdefault(inbound_tag, set()).add(ip)
+        self._notify_callbacks(ip, old, self.by_ip[ip])
+
+    def _remove(self, ip):
+        old = self._discard(ip)
+        if old is not None:
+            self._notify_callbacks(ip, old, None)
+
+    def _discard(self, ip):
+        server = self.by_ip.pop(ip, None)
+        if server is not None:
+            ips = self.by_tag.get(server[1])
+            if ips is not None:
+                ips.discard(ip)
+                if not ips:
+                    del self.by_tag[server[1]]
+        return server
+
+    def get(self, ip):
+        return self.by_ip.get(ip)
+
+    def all(self):
+        return list(self.by_ip.values())
+
+    def ips_by_tag(self):
+        return {inbound_tag: set(ips) for inbound_tag, ips in self.by_tag.items()}
+
+    def get_stats(self) -> dict:
+        return {
+            "servers": len(self.by_ip),
+            "tags": len(self.by_tag),
+            "listening": self._conn is not None and not self._conn.is_closed(),
+            **self.stats
+        }
+
+server_registry = ServerRegistry()
@@ -1,65 +1,327 @@
+import asyncio
 import asyncssh
-import socket
+import hashlib
 import os
 import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
 from config import Config
+from probe_utils import probe_tcp, get_probe_timeout
 
 logger = logging.getLogger(__name__)
 
-def check_server_availability(ip, port=22, timeout=5):
+# Ошибки, после которых соединение считаем сломанным и убираем из пула.
+# Отказ в канале (ChannelOpenError) или локальная ошибка ввода-вывода соединение не ломают
+CONNECTION_ERRORS = (asyncssh.DisconnectError, asyncssh.ConnectionLost, ConnectionError)
+
+class SSHConnectionPool:
+    """Пул SSH-соединений по хостам: одно соединение на хост, несколько каналов поверх него.
+
+    Простаивающие дольше SSH_POOL_IDLE_TTL соединения закрываются, общее число
+    ограничено SSH_POOL_MAX_CONNECTIONS, закрытые и сломанные соединения вытесняются.
+    """
+
+    def __init__(self):
+        self.idle_ttl = float(os.getenv('SSH_POOL_IDLE_TTL', '300'))
+        self.max_connections = int(os.getenv('SSH_POOL_MAX_CONNECTIONS', '100'))
+        # sshd по умолчанию разрешает 10 сессий (MaxSessions) на соединение
+        self.max_channels = int(os.getenv('SSH_POOL_MAX_CHANNELS', '8'))
+        self.connect_timeout = float(os.getenv('SSH_CONNECT_TIMEOUT', '30'))
+        self.keepalive_interval = float(os.getenv('SSH_KEEPALIVE_INTERVAL', '30'))
+        self.entries = {}
+        self._connecting = {}
+        self._changed = asyncio.Condition()
+        self._reaper = None
+        self.stats = {"connects": 0, "reuses": 0, "evictions": 0, "errors": 0}
+
+    def start(self):
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap())
+            logger.info(f"SSH pool started: idle TTL {self.idle_ttl}s, max {self.max_connections} connections")
+
+    def _healthy(self, entry) -> bool:
+        return not entry["conn"].is_closed()
+
+    async def _reap(self):
+        while True:
+            await asyncio.sleep(max(1.0, self.idle_ttl / 4))
+            now = time.monotonic()
+            for key, entry in list(self.entries.items()):
+                if entry["in_use"] == 0 and (now - entry["last_used"] > self.idle_ttl or not self._healthy(entry)):
+                    await self._evict(key, entry)
+
+    async def _evict(self, key, entry):
+        if self.entries.get(key) is entry:
+            del self.entries[key]
+            self.stats["evictions"] += 1
+            # Каналы других задач на этом соединении дорабатывают; закроет его последний освободивший
+            if entry["in_use"] == 0:
+                entry["conn"].close()
+                logger.debug(f"SSH connection to {key[0]} closed")
+            else:
+                entry["retired"] = True
+            async with self._changed:
+                self._changed.notify_all()
+
+    async def _make_room(self):
+        async with self._changed:
+            # Текущее подключение уже учтено в _connecting
+            while len(self.entries) + len(self._connecting) > self.max_connections:
+                idle = [(entry["last_used"], key) for key, entry in self.entries.items() if entry["in_use"] == 0]
+                if idle:
+                    _, key = min(idle)
+                    entry = self.entries.pop(key)
+                    self.stats["evictions"] += 1
+                    entry["conn"].close()
+                    continue
+                await self._changed.wait()
+
+    async def _connect(self, key, host, port, username, client_keys):
+        future = asyncio.get_running_loop().create_future()
+        self._connecting[key] = future
+        try:
+            await self._make_room()
+            conn = await asyncssh.connect(
+                host,
+                port=port,
+                username=username,
+                client_keys=client_keys,
+                known_hosts=None,
+                connect_timeout=self.connect_timeout,
+                login_timeout=self.connect_timeout,
+                keepalive_interval=self.keepalive_interval
+            )
+            self.stats["connects"] += 1
+            entry = {
+                "conn": conn,
+                "last_used": time.monotonic(),
+                "in_use": 0,
+                "channels": asyncio.Semaphore(self.max_channels)
+            }
+            self.entries[key] = entry
+            future.set_result(entry)
+            return entry
+        except BaseException as e:
+            future.set_exception(e)
+            # Исключение получат ожидающие того же хоста; здесь его не теряем
+            future.exception()
+            raise
+        finally:
+            del self._connecting[key]
+            async with self._changed:
+                self._changed.notify_all()
+
+    async def _get_entry(self, host, port, username, client_keys):
+        key = (host, port, username, tuple(client_keys or ()))
+        entry = self.entries.get(key)
+        if entry is not None:
+            if self._healthy(entry):
+                self.stats["reuses"] += 1
+                return key, entry
+            await self._evict(key, entry)
+        pending = self._connecting.get(key)
+        if pending is not None:
+            self.stats["reuses"] += 1
+            return key, await asyncio.shield(pending)
+        return key, await self._connect(key, host, port, username, client_keys)
+
+    @asynccontextmanager
+    async def connection(self, host: str, username: str = None, client_keys: list = None, port: int = 22):
+        """Выдаёт соединение с хостом из пула; занимает один из каналов соединения."""
+        key, entry = await self._get_entry(host, port, username, client_keys)
+        entry["in_use"] += 1
+        try:
+            async with entry["channels"]:
+                yield entry["conn"]
+        except Exception as e:
+            if isinstance(e, CONNECTION_ERRORS) or entry["conn"].is_closed():
+                self.stats["errors"] += 1
+                await self._evict(key, entry)
+            raise
+        finally:
+            entry["in_use"] -= 1
+            entry["last_used"] = time.monotonic()
+            if entry.get("retired") and entry["in_use"] == 0:
+                entry["conn"].close()
+                logger.debug(f"SSH connection to {key[0]} closed")
+            async with self._changed:
+                self._changed.notify_all()
+
+    async def close(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            await asyncio.gather(self._reaper, return_exceptions=True)
+            self._reaper = None
+        entries = list(self.entries.values())
+        self.entries = {}
+        for entry in entries:
+            entry["conn"].close()
+        await asyncio.gather(*(entry["conn"].wait_closed() for entry in entries), return_exceptions=True)
+        logger.info(f"SSH pool closed: {len(entries)} connections")
+
+    def get_stats(self) -> dict:
+        return {
+            "connections": len(self.entries),
+            "in_use": sum(1 for entry in self.entries.values() if entry["in_use"]),
+            "connecting": len(self._connecting),
+            **self.stats
+        }
+
+ssh_pool = SSHConnectionPool()
+
+REMOTE_SCRIPTS_DIR = '/tmp/nodemanager'
+# Код выхода и маркер, которыми удалённая сторона сообщает, что скрипта с таким хэшем у неё нет
+SCRIPT_CACHE_MISS_CODE = 97
+SCRIPT_CACHE_MISS_MARKER = 'nodemanager: script cache miss'
+
+class ScriptIndex:
+    """Индекс скриптов из SCRIPTS_PATH по sha256; файл перехэшируется только при смене mtime или размера.
+
+    Обход каталога идёт в отдельном потоке, а одновременные запросы
+    (например, деплой на сотню хостов) ждут один общий обход. Результат
+    обхода используется SCRIPT_INDEX_TTL секунд; неизвестное имя
+    перечитывает каталог сразу.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.ttl = float(os.getenv('SCRIPT_INDEX_TTL', '10'))
+        self._refreshed_at = None
+        self._refreshing = None
+
+    def refresh(self):
+        found = {}
+        with os.scandir(Config.SCRIPTS_PATH) as it:
+            for entry in it:
+                if not entry.name.endswith('.sh') or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                cached = self.entries.get(entry.name)
+                if cached and cached["mtime"] == stat.st_mtime_ns and cached["size"] == stat.st_size:
+                    found[entry.name] = cached
+                    continue
+                with open(entry.path, 'rb') as f:
+                    content = f.read()
+                found[entry.name] = {
+                    "name": entry.name,
+                    "hash": hashlib.sha256(content).hexdigest(),
+                    "content": content,
+                    "mtime": stat.st_mtime_ns,
+                    "size": stat.st_size
+                }
+                logger.debug(f"Indexed script {entry.name}: {found[entry.name]['hash']}")
+        self.entries = found
+        self._refreshed_at = time.monotonic()
+        return found
+
+    def _fresh(self) -> bool:
+        return self._refreshed_at is not None and time.monotonic() - self._refreshed_at < self.ttl
+
+    async def refresh_async(self):
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(asyncio.to_thread(self.refresh))
+            self._refreshing.add_done_callback(lambda _: setattr(self, '_refreshing', None))
+        return await asyncio.shield(self._refreshing)
+
+    async def get(self, name: str):
+        if self._fresh() and name in self.entries:
+            return self.entries[name]
+        return (await self.refresh_async()).get(name)
+
+    async def names(self) -> list:
+        return sorted(self.entries if self._fresh() else await self.refresh_async())
+
+script_index = ScriptIndex()
+
+def _run_cached_command(remote_path: str, digest: str) -> str:
+    # Проверка хэша и запуск за один exec; при промахе — код SCRIPT_CACHE_MISS_CODE
+    return (
+        f'if [ "$(sha256sum {remote_path} 2>/dev/null | cut -d" " -f1)" = "{digest}" ]; '
+        f'then exec bash {remote_path}; '
+        f'else echo "{SCRIPT_CACHE_MISS_MARKER}" >&2; exit {SCRIPT_CACHE_MISS_CODE}; fi'
+    )
+
+def _upload_and_run_command(remote_path: str) -> str:
+    # Скрипт приходит через stdin: запись во временный файл, переименование и запуск в том же exec
+    return (
+        f'mkdir -p {REMOTE_SCRIPTS_DIR} && cat > {remote_path}.$$ && mv {remote_path}.$$ {remote_path} '
+        f'&& exec bash {remote_path} < /dev/null'
+    )
+
+async def _run_streaming(conn, command: str, stdin: bytes = None, on_output=None):
+    """Запускает команду, отдавая stdout/stderr построчно в on_output(stream, line).
+
+    В памяти держим только последние SCRIPT_OUTPUT_TAIL_LINES строк каждого потока —
+    для сообщения об ошибке. Возвращает (код выхода, хвост stdout, хвост stderr).
+    """
+    tail_lines = int(os.getenv('SCRIPT_OUTPUT_TAIL_LINES', '50'))
+    tails = {"stdout": deque(maxlen=tail_lines), "stderr": deque(maxlen=tail_lines)}
+    async with conn.create_process(command, encoding=None) as process:
+        if stdin is not None:
+            process.stdin.write(stdin)
+        process.stdin.write_eof()
+
+        async def pump(stream, reader):
+            async for raw in reader:
+                line = raw.decode(errors='replace').rstrip('\r\n')
+                tails[stream].append(line)
+                if on_output is not None and line != SCRIPT_CACHE_MISS_MARKER:
+                    await on_output(stream, line)
+
+        await asyncio.gather(pump("stdout", process.stdout), pump("stderr", process.stderr))
+        completed = await process.wait(check=False)
+    return completed.exit_status, '\n'.join(tails["stdout"]), '\n'.join(tails["stderr"])
+
+async def check_server_availability(ip, port=22, timeout=5):
     """Проверяет доступность сервера по IP и порту."""
+    result = await probe_tcp(ip, port, timeout)
+    if result["reachable"]:
+        logger.info(f"Server {ip} is reachable on port {port}")
+        return True, "Server is reachable"
+    logger.warning(f"Server {ip} is not reachable on port {port}: {result['error']}")
+    return False, "Server is not reachable"
+
+async def get_host_uptime(ip):
+    """Аптайм хоста в секундах из /proc/uptime; None, если хост не ответил."""
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(timeout)
-        result = sock.connect_ex((ip, port))
-        sock.close()
-        if result == 0:
-            logger.info(f"Server {ip} is reachable on port {port}")
-            return True, "Server is reachable"
-        else:
-            logger.warning(f"Server {ip} is not reachable on port {port}")
-            return False, "Server is not reachable"
-    except socket.gaierror:
-        logger.error(f"Invalid IP address or hostname: {ip}")
-        return False, "Invalid IP address or hostname"
+        async with ssh_pool.connection(ip, Config.SSH_USER, [Config.SSH_KEY_PATH]) as conn:
+            result = await asyncio.wait_for(conn.run('cat /proc/uptime', check=False), get_probe_timeout() * 2)
+        if result.exit_status != 0:
+            return None
+        return float(result.stdout.split()[0])
     except Exception as e:
-        logger.error(f"Error checking server {ip}: {str(e)}")
-        return False, f"Error checking server: {str(e)}"
+        logger.debug(f"Failed to read uptime of {ip}: {str(e)}")
+        return None
+
+async def deploy_script(ip: str, script_name: str, on_output=None):
+    """Asynchronously deploy and execute a bash script on a remote server via SSH.
 
-async def deploy_script(ip: str, script_name: str):
-    """Asynchronously deploy and execute a bash script on a remote server via SSH."""
+    If on_output is given, it is awaited with (stream, line) for every output line.
+    """
     # Check server availability
-    is_available, message = check_server_availability(ip)
+    is_available, message = await check_server_availability(ip)
     if not is_available:
         logger.error(f"Failed to deploy script on {ip}: {message}")
         return False, message
 
     # Check if local script exists
-    script_path = os.path.join(Config.SCRIPTS_PATH, script_name)
-    if not os.path.exists(script_path):
+    script = await script_index.get(script_name)
+    if not script:
         logger.error(f"Script '{script_name}' not found in {Config.SCRIPTS_PATH}")
         return False, f"Script '{script_name}' not found in {Config.SCRIPTS_PATH}"
 
     try:
-        async with asyncssh.connect(
-            ip,
-            username=Config.SSH_USER,
-            client_keys=[Config.SSH_KEY_PATH],
-            known_hosts=None  # Disable host key checking
-        ) as conn:
-            # Upload script via SFTP
-            remote_path = f"/tmp/{script_name}"
-            async with conn.start_sftp_client() as sftp:
-                await sftp.put(script_path, remote_path)
-            
-            # Make script executable
-            await conn.run(f"chmod +x {remote_path}", check=True)
-            
-            # Execute script
-            result = await conn.run(f"bash {remote_path}", check=False)
-            stdout_output = result.stdout.strip()
-            stderr_output = result.stderr.strip()
-            exit_code = result.exit_status
+        async with ssh_pool.connection(ip, Config.SSH_USER, [Config.SSH_KEY_PATH]) as conn:
+            remote_path = f"{REMOTE_SCRIPTS_DIR}/{script['hash']}.sh"
+            exit_code, stdout_output, stderr_output = await _run_streaming(
+                conn, _run_cached_command(remote_path, script['hash']), on_output=on_output
+            )
+            if exit_code == SCRIPT_CACHE_MISS_CODE and stderr_output.endswith(SCRIPT_CACHE_MISS_MARKER):
+                logger.debug(f"Uploading {script_name} to {ip}:{remote_path}")
+                exit_code, stdout_output, stderr_output = await _run_streaming(
+                    conn, _upload_and_run_command(remote_path), stdin=script['content'], on_output=on_output
+                )
 
             if exit_code != 0:
                 error_message = f"Script execution failed with exit code {exit_code}\n"
@@ -76,9 +338,6 @@ async def deploy_script(ip: str, script_name: str):
     except asyncssh.ProcessError as e:
         logger.error(f"Command failed on {ip}: {e}")
         return False, f"Command failed: {str(e)}"
-    except asyncssh.SFTPError as e:
-        logger.error(f"SFTP error on {ip}: {e}")
-        return False, f"SFTP error: {str(e)}"
     except Exception as e:
         logger.error(f"Unexpected error on {ip}: {e}")
         return False, f"Unexpected error: {str(e)}"
@@ -531,12 +531,12 @@ async function confirmModalAction() {
                     if(confirmBtn) confirmBtn.disabled = false;
                     return; 
                 }
-                await executeRunScript(currentModalData.ips, scriptName);
+                await executeRunScript(currentModalData.ips, scriptName, readRolloutOptions());
                 break;
             case 'edit_server': await executeEditServer(currentModalData); break;
             case 'delete_servers': await executeDeleteServers(currentModalData); break;
             case 'reboot_single': await executeReboot([currentModalData]); break;
-            case 'reboot_bulk': await executeReboot(currentModalData); break;
+            case 'reboot_bulk': await executeReboot(currentModalData, readRolloutOptions()); break;
             default: console.warn('Unknown modal action:', currentModalAction);
         }
     } finally {
@@ -547,6 +547,105 @@ async function confirmModalAction() {
     }
 }
 
+// --- Раскатка волнами ---
+function rolloutFieldsHTML(count) {
+    if (count < 2) return '';
+    return `<div class="form-group"><label for="modalWaveSize">Волнами по N серверов (пусто — все сразу)</label><input type="number" id="modalWaveSize" class="form-input" min="1" max="${count}" placeholder="Все сразу"></div>` +
+        `<div class="form-group"><label for="modalWaveDelay">Пауза между волнами, с</label><input type="number" id="modalWaveDelay" class="form-input" min="0" placeholder="По умолчанию"></div>`;
+}
+
+function readRolloutOptions() {
+    const waveSize = parseInt(document.getElementById('modalWaveSize')?.value, 10);
+    if (!waveSize) return null;
+    const waveDelay = parseFloat(document.getElementById('modalWaveDelay')?.value);
+    return isNaN(waveDelay) ? { wave_size: waveSize } : { wave_size: waveSize, wave_delay: waveDelay };
+}
+
+// --- Потоковый вывод выполнения (SSE) ---
+const RUN_LOG_MAX_LINES = 500;
+
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const chunk = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            let event = 'message';
+            let data = '';
+            chunk.split('\n').forEach(line => {
+                if (line.startsWith('event: ')) event = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+            });
+            if (data) onEvent(event, JSON.parse(data));
+        }
+    }
+}
+
+async function submitJob(url, body) {
+    const response = await fetch(url, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(body) });
+    if (!response.ok) { const err = await response.json().catch(()=>({})); throw new Error(err.detail || `HTTP ${response.status}`); }
+    return (await response.json()).job_id;
+}
+
+async function streamJob(jobId, onEvent) {
+    // Поток можно переоткрыть: сервер сначала отдаёт уже завершённые задачи из БД
+    const response = await fetch(`/api/jobs/${jobId}/stream`);
+    if (!response.ok) throw new Error(`HTTP ${response.status}`);
+    await readEventStream(response, onEvent);
+}
+
+function openRunLog(title) {
+    let panel = document.getElementById('runLogPanel');
+    if (!panel) {
+        panel = document.createElement('div');
+        panel.id = 'runLogPanel';
+        panel.className = 'run-log';
+        panel.innerHTML = `<div class="run-log-header"><span class="run-log-title"></span><span class="run-log-progress"></span><button type="button" class="run-log-close" title="Закрыть">×</button></div><div class="run-log-body"></div>`;
+        panel.querySelector('.run-log-close').addEventListener('click', () => panel.remove());
+        document.body.appendChild(panel);
+    }
+    panel.querySelector('.run-log-title').textContent = title;
+    panel.querySelector('.run-log-progress').textContent = '';
+    panel.querySelector('.run-log-body').textContent = '';
+    return panel;
+}
+
+function appendRunLog(panel, text, kind = '') {
+    const body = panel.querySelector('.run-log-body');
+    const stickToBottom = body.scrollTop + body.clientHeight >= body.scrollHeight - 4;
+    const line = document.createElement('div');
+    line.className = `run-log-line ${kind}`;
+    line.textContent = text;
+    body.appendChild(line);
+    // В DOM держим только последние строки, весь вывод в браузере не копится
+    while (body.childElementCount > RUN_LOG_MAX_LINES) body.firstElementChild.remove();
+    if (stickToBottom) body.scrollTop = body.scrollHeight;
+}
+
+function renderWaveEvent(data) {
+    const unhealthy = data.unhealthy && data.unhealthy.length ? ` Не поднялись: ${data.unhealthy.join(', ')}` : '';
+    if (data.status === 'completed') return `— Волна ${data.wave}/${data.waves} завершена, пауза перед проверкой`;
+    if (data.status === 'health_check') return `— Волна ${data.wave}/${data.waves}: ждём online в метриках`;
+    if (data.status === 'started') return `— Волна ${data.wave}/${data.waves} запущена.${unhealthy}`;
+    if (data.status === 'checked') return `— Волна ${data.wave}/${data.waves} проверена, раскатка завершена.${unhealthy}`;
+    return `— ${data.message}.${unhealthy}`;
+}
+
+function renderRunEvent(panel, event, data, finished, total) {
+    if (event === 'started') appendRunLog(panel, `[${data.ip}] ▶ запуск`, 'info');
+    else if (event === 'output') appendRunLog(panel, `[${data.ip}] ${data.line}`, data.stream === 'stderr' ? 'stderr' : '');
+    else if (event === 'wave') appendRunLog(panel, renderWaveEvent(data), data.status === 'aborted' || (data.unhealthy && data.unhealthy.length) ? 'error' : 'info');
+    else if (event === 'retry') appendRunLog(panel, `[${data.ip}] ↻ повтор через ${data.retry_in} с: ${data.message || ''}`, 'stderr');
+    else if (event === 'result') appendRunLog(panel, `[${data.ip}] ${data.success ? '✔' : '✖'} ${data.message || ''}`, data.success ? 'success' : 'error');
+    panel.querySelector('.run-log-progress').textContent = `${finished}/${total}`;
+}
+
 // --- Action Execution Functions ---
 function bulkRunScriptFromBar() {
     if (selectedServers.size === 0) { showToast('Выберите серверы.', 'error'); return; }
@@ -555,17 +654,19 @@ function bulkRunScriptFromBar() {
     showRunScriptModal(Array.from(selectedServers), scriptSelect.value);
 }
 
-async function executeRunScript(ips, scriptName) {
+async function executeRunScript(ips, scriptName, rollout = null) {
     const btnInBar = document.getElementById('runScriptButton');
     if(btnInBar) { btnInBar.classList.add('loading'); btnInBar.disabled = true; }
     
     try {
         showToast(`Запуск "${scriptName}" на ${ips.length} сервер(ах)...`, 'info', 5000);
-        const response = await fetch('/api/run_scripts', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ ips, script_name: scriptName }) });
-        if (!response.ok) { const err = await response.json().catch(()=>({})); throw new Error(err.detail || `HTTP ${response.status}`); }
-        const data = await response.json();
+        const jobId = await submitJob('/api/run_scripts', { ips, script_name: scriptName, rollout });
+        const panel = openRunLog(`Скрипт "${scriptName}" (задание #${jobId})`);
         let successes = 0, errors = 0, errorMsgs = [];
-        (data.results || []).forEach(r => r.success ? successes++ : (errors++, errorMsgs.push(`${r.ip}: ${r.message||'Ошибка'}`)));
+        await streamJob(jobId, (event, r) => {
+            if (event === 'result') r.success ? successes++ : (errors++, errorMsgs.push(`${r.ip}: ${(r.message||'Ошибка').split('\n')[0]}`));
+            renderRunEvent(panel, event, r, successes + errors, ips.length);
+        });
         if (errors === 0) showToast(`Скрипт "${scriptName}" выполнен на ${successes} сервер(ах).`, 'success');
         else showToast(`Выполнено: ${successes}, ошибок: ${errors}. ${errorMsgs.join('; ')}`, successes > 0 ? 'warning' : 'error', 7000);
         if (successes > 0 || errors > 0) clearSelection();
@@ -579,19 +680,21 @@ async function rebootServer(ip) {
 
 async function bulkReboot() {
     if (selectedServers.size === 0) { showToast('Выберите серверы для перезагрузки.', 'error'); return; }
-    showModal('Массовая перезагрузка', `Перезагрузить ${selectedServers.size} выбранных серверов?`, 'reboot_bulk', Array.from(selectedServers), 'Перезагрузить все', 'danger');
+    showModal('Массовая перезагрузка', `Перезагрузить ${selectedServers.size} выбранных серверов?`, 'reboot_bulk', Array.from(selectedServers), 'Перезагрузить все', 'danger', rolloutFieldsHTML(selectedServers.size));
 }
 
-async function executeReboot(ips) {
+async function executeReboot(ips, rollout = null) {
     const btnInBar = document.getElementById('rebootSelectedButton');
     if(btnInBar) { btnInBar.classList.add('loading'); btnInBar.disabled = true; }
     try {
         showToast(`Перезагрузка ${ips.length} сервер(ах)...`, 'info', 5000);
-        const response = await fetch('/api/reboot_servers', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ ips }) });
-        if (!response.ok) { const err = await response.json().catch(()=>({})); throw new Error(err.detail || `HTTP ${response.status}`); }
-        const data = await response.json();
+        const jobId = await submitJob('/api/reboot_servers', { ips, rollout });
+        const panel = openRunLog(`Перезагрузка (задание #${jobId})`);
         let successes = 0, errors = 0, errorMsgs = [];
-        (data.results || []).forEach(r => r.success ? successes++ : (errors++, errorMsgs.push(`${r.ip}: ${r.message||'Ошибка'}`)));
+        await streamJob(jobId, (event, r) => {
+            if (event === 'result') r.success ? successes++ : (errors++, errorMsgs.push(`${r.ip}: ${(r.message||'Ошибка').split('\n')[0]}`));
+            renderRunEvent(panel, event, r, successes + errors, ips.length);
+        });
         if (errors === 0) showToast(`${successes} сервер(ов) успешно перезагружены.`, 'success');
         else showToast(`Перезагружено: ${successes}, ошибок: ${errors}. ${errorMsgs.join('; ')}`, successes > 0 ? 'warning' : 'error', 7000);
         if (successes > 0 || errors > 0) clearSelection();
@@ -634,7 +737,7 @@ function showRunScriptModal(ips, preSelectedScript = null) {
     let description = isMultiple ? `Запуск скрипта на ${ips.length} серверах.` : `Запуск скрипта на сервере ${ips[0]}.`;
     description += " Выберите скрипт из списка:";
     currentModalData = { ips, preSelectedScript };
-    let dynamicContentHTML = `<div class="form-group" style="margin-top: 1rem;"><label for="modalPromptScriptSelect" style="display:none;">Выберите скрипт</label><select id="modalPromptScriptSelect" class="form-select"><option value="">Загрузка скриптов...</option></select></div>`;
+    let dynamicContentHTML = `<div class="form-group" style="margin-top: 1rem;"><label for="modalPromptScriptSelect" style="display:none;">Выберите скрипт</label><select id="modalPromptScriptSelect" class="form-select"><option value="">Загрузка скриптов...</option></select></div>` + rolloutFieldsHTML(ips.length);
     showModal(title, description, 'run_script_modal', currentModalData, 'Запустить', 'primary', dynamicContentHTML);
     const modalScriptSelect = document.getElementById('modalPromptScriptSelect');
     if(modalScriptSelect) {
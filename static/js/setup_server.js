@@ -273,6 +273,81 @@ function setupIPTagsInput() {
     updateIPInputUI();
 }
 
+// --- Потоковый вывод выполнения (SSE) ---
+const RUN_LOG_MAX_LINES = 500;
+
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const chunk = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            let event = 'message';
+            let data = '';
+            chunk.split('\n').forEach(line => {
+                if (line.startsWith('event: ')) event = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+            });
+            if (data) onEvent(event, JSON.parse(data));
+        }
+    }
+}
+
+async function submitJob(url, body) {
+    const response = await fetch(url, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(body) });
+    if (!response.ok) { const err = await response.json().catch(()=>({})); throw new Error(err.detail || `HTTP ${response.status}`); }
+    return (await response.json()).job_id;
+}
+
+async function streamJob(jobId, onEvent) {
+    // Поток можно переоткрыть: сервер сначала отдаёт уже завершённые задачи из БД
+    const response = await fetch(`/api/jobs/${jobId}/stream`);
+    if (!response.ok) throw new Error(`HTTP ${response.status}`);
+    await readEventStream(response, onEvent);
+}
+
+function openRunLog(title) {
+    let panel = document.getElementById('runLogPanel');
+    if (!panel) {
+        panel = document.createElement('div');
+        panel.id = 'runLogPanel';
+        panel.className = 'run-log';
+        panel.innerHTML = `<div class="run-log-header"><span class="run-log-title"></span><span class="run-log-progress"></span><button type="button" class="run-log-close" title="Закрыть">×</button></div><div class="run-log-body"></div>`;
+        panel.querySelector('.run-log-close').addEventListener('click', () => panel.remove());
+        document.body.appendChild(panel);
+    }
+    panel.querySelector('.run-log-title').textContent = title;
+    panel.querySelector('.run-log-progress').textContent = '';
+    panel.querySelector('.run-log-body').textContent = '';
+    return panel;
+}
+
+function appendRunLog(panel, text, kind = '') {
+    const body = panel.querySelector('.run-log-body');
+    const stickToBottom = body.scrollTop + body.clientHeight >= body.scrollHeight - 4;
+    const line = document.createElement('div');
+    line.className = `run-log-line ${kind}`;
+    line.textContent = text;
+    body.appendChild(line);
+    // В DOM держим только последние строки, весь вывод в браузере не копится
+    while (body.childElementCount > RUN_LOG_MAX_LINES) body.firstElementChild.remove();
+    if (stickToBottom) body.scrollTop = body.scrollHeight;
+}
+
+function renderRunEvent(panel, event, data, finished, total) {
+    if (event === 'started') appendRunLog(panel, `[${data.ip}] ▶ запуск`, 'info');
+    else if (event === 'output') appendRunLog(panel, `[${data.ip}] ${data.line}`, data.stream === 'stderr' ? 'stderr' : '');
+    else if (event === 'retry') appendRunLog(panel, `[${data.ip}] ↻ повтор через ${data.retry_in} с: ${data.message || ''}`, 'stderr');
+    else if (event === 'result') appendRunLog(panel, `[${data.ip}] ${data.success ? '✔' : '✖'} ${data.message || ''}`, data.success ? 'success' : 'error');
+    panel.querySelector('.run-log-progress').textContent = `${finished}/${total}`;
+}
+
 async function handleSubmit(e) {
     e.preventDefault();
     console.log('setup_server.js: Form submitted');
@@ -300,23 +375,15 @@ async function handleSubmit(e) {
 
     try {
         console.log('setup_server.js: Sending request to /api/add_server with:', { ips: ipTags, inbound_tag: inbound });
-        const response = await fetch('/api/add_server', { 
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ ips: ipTags, inbound_tag: inbound })
+        const jobId = await submitJob('/api/add_server', { ips: ipTags, inbound_tag: inbound });
+        const panel = openRunLog(`Настройка: ${inbound} (задание #${jobId})`);
+        const results = [];
+        const total = ipTags.length;
+        await streamJob(jobId, (event, data) => {
+            if (event === 'result') results.push(data);
+            renderRunEvent(panel, event, data, results.length, total);
         });
-        if (!response.ok) {
-            let errorMessage = `HTTP error! status: ${response.status}`;
-            try {
-                const errorData = await response.json();
-                errorMessage = errorData.detail || errorMessage;
-            } catch { /* No JSON response */ }
-            console.error('setup_server.js: Error response:', errorMessage);
-            throw new Error(errorMessage);
-        }
-        const data = await response.json();
-        console.log('setup_server.js: Response from /api/add_server:', data);
-        const results = data.results || [];
+        console.log(`setup_server.js: Results of job ${jobId}:`, results);
         let successCount = 0;
         let errorCount = 0;
         let errorMessages = [];
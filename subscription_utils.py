@@ -1,72 +1,191 @@
+import asyncio
 import base64
+import copy
+import hashlib
+import os
 import uuid
-import aiohttp
 import json
+from datetime import datetime
 from urllib.parse import urlparse, parse_qs, unquote
 import logging
 import traceback
 import re
+from http_utils import http_clients
 
 logger = logging.getLogger(__name__)
 
-async def fetch_subscription_keys(subscription_url):
-    logger.debug(f"Fetching subscription from {subscription_url}")
-    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
+class SubscriptionCache:
+    """Последний удачный снимок подписки: валидаторы HTTP, хэш содержимого и разобранные ключи.
+
+    Новый снимок сначала откладывается в pending и становится текущим только
+    после commit, когда ключи и DNS синхронизированы. Если синхронизация упала,
+    следующее обновление снова увидит изменившийся хэш и повторит её.
+    """
+
+    def __init__(self):
+        self.path = os.getenv('SUBSCRIPTION_CACHE_PATH', 'subscription_cache.json')
+        self.etag = None
+        self.last_modified = None
+        self.content_hash = None
+        self.keys = []
+        self.fetched_at = None
+        self.pending = None
+        self.loaded = False
+
+    def load(self):
+        self.loaded = True
         try:
-            async with session.get(subscription_url) as response:
-                logger.info(f"Subscription response status: {response.status}")
-                if response.status != 200:
-                    logger.error(f"Subscription fetch failed: {response.status}")
-                    return []
-                base64_text = await response.text()
-                logger.debug(f"Raw subscription response: {base64_text[:100]}...")
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
         except Exception as e:
-            logger.error(f"Failed to fetch subscription: {str(e)}\n{traceback.format_exc()}")
-            return []
+            logger.error(f"Failed to load subscription cache {self.path}: {str(e)}")
+            return
+        self.etag = data.get('etag')
+        self.last_modified = data.get('last_modified')
+        self.content_hash = data.get('content_hash')
+        self.keys = data.get('keys') or []
+        self.fetched_at = data.get('fetched_at')
+        logger.info(f"Loaded {len(self.keys)} cached VLESS keys from {self.path} (fetched at {self.fetched_at})")
+
+    def _write(self, data):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    async def save(self):
+        data = {
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "content_hash": self.content_hash,
+            "keys": self.keys,
+            "fetched_at": self.fetched_at
+        }
         try:
-            text = base64.b64decode(base64_text).decode('utf-8')
-            logger.debug(f"Decoded subscription text: {text[:100]}...")
+            await asyncio.to_thread(self._write, data)
         except Exception as e:
-            logger.error(f"Failed to decode Base64: {str(e)}\n{traceback.format_exc()}")
-            return []
-        keys = []
-        for line in text.splitlines():
-            if line.startswith('vless://'):
+            logger.error(f"Failed to save subscription cache {self.path}: {str(e)}\n{traceback.format_exc()}")
+
+    async def commit(self, keys):
+        """Делает отложенный снимок текущим, если keys взяты из него."""
+        pending = self.pending
+        if pending is None or pending["keys"] is not keys:
+            return
+        self.pending = None
+        self.etag = pending["etag"]
+        self.last_modified = pending["last_modified"]
+        self.content_hash = pending["content_hash"]
+        self.keys = pending["keys"]
+        self.fetched_at = pending["fetched_at"]
+        await self.save()
+
+subscription_cache = SubscriptionCache()
+
+def parse_subscription_text(base64_text):
+    try:
+        text = base64.b64decode(base64_text).decode('utf-8')
+        logger.debug(f"Decoded subscription text: {text[:100]}...")
+    except Exception as e:
+        logger.error(f"Failed to decode Base64: {str(e)}\n{traceback.format_exc()}")
+        return []
+    keys = []
+    for line in text.splitlines():
+        if line.startswith('vless://'):
+            try:
+                parsed = urlparse(line)
+                query = parse_qs(parsed.query)
+                logger.debug(f"Parsed VLESS key: {line[:50]}...")
+                if not parsed.username or not parsed.netloc or not query.get('sni') or not query.get('pbk') or not query.get('sid'):
+                    logger.warning(f"Invalid VLESS key: {line[:50]}...")
+                    continue
                 try:
-                    parsed = urlparse(line)
-                    query = parse_qs(parsed.query)
-                    logger.debug(f"Parsed VLESS key: {line[:50]}...")
-                    if not parsed.username or not parsed.netloc or not query.get('sni') or not query.get('pbk') or not query.get('sid'):
-                        logger.warning(f"Invalid VLESS key: {line[:50]}...")
-                        continue
-                    try:
-                        uuid.UUID(parsed.username)
-                    except:
-                        logger.warning(f"Invalid UUID in key: {line[:50]}...")
-                        continue
-                    host_port = parsed.netloc.split(':')
-                    host = host_port[0]
-                    inbound_tag = unquote(parsed.fragment) if parsed.fragment else 'Unknown'
-                    host_parts = host.split('.')
-                    inbound_letter = host_parts[0].lower() if len(host_parts) >= 2 else ''
-                    if not inbound_letter or not re.match(r'^[a-z0-9]+$', inbound_letter):
-                        logger.warning(f"Invalid subdomain in host {host}, trying inbound_tag")
-                        letter_match = re.search(r'[a-zA-Z]', inbound_tag)
-                        inbound_letter = letter_match.group(0).lower() if letter_match else ''
-                    if not inbound_letter:
-                        logger.error(f"Failed to determine inbound_letter for {line[:50]}...")
-                        continue
-                    keys.append({
-                        'inbound_tag': inbound_tag,
-                        'serverName': query['sni'][0],
-                        'vless_key': line,
-                        'domain': host,
-                        'inbound_letter': inbound_letter
-                    })
-                except Exception as e:
-                    logger.warning(f"Failed to parse VLESS key: {str(e)}\n{traceback.format_exc()}")
-        logger.info(f"Parsed {len(keys)} VLESS keys")
-        return keys
+                    uuid.UUID(parsed.username)
+                except:
+                    logger.warning(f"Invalid UUID in key: {line[:50]}...")
+                    continue
+                host_port = parsed.netloc.split(':')
+                host = host_port[0]
+                inbound_tag = unquote(parsed.fragment) if parsed.fragment else 'Unknown'
+                host_parts = host.split('.')
+                inbound_letter = host_parts[0].lower() if len(host_parts) >= 2 else ''
+                if not inbound_letter or not re.match(r'^[a-z0-9]+$', inbound_letter):
+                    logger.warning(f"Invalid subdomain in host {host}, trying inbound_tag")
+                    letter_match = re.search(r'[a-zA-Z]', inbound_tag)
+                    inbound_letter = letter_match.group(0).lower() if letter_match else ''
+                if not inbound_letter:
+                    logger.error(f"Failed to determine inbound_letter for {line[:50]}...")
+                    continue
+                keys.append({
+                    'inbound_tag': inbound_tag,
+                    'serverName': query['sni'][0],
+                    'vless_key': line,
+                    'domain': host,
+                    'inbound_letter': inbound_letter
+                })
+            except Exception as e:
+                logger.warning(f"Failed to parse VLESS key: {str(e)}\n{traceback.format_exc()}")
+    logger.info(f"Parsed {len(keys)} VLESS keys")
+    return keys
+
+async def fetch_subscription(subscription_url, force=False):
+    """Условно скачивает подписку и возвращает (ключи, изменились ли они).
+
+    При 304, совпадении хэша или недоступности источника отдаются ключи
+    из последнего удачного снимка; force отключает условные заголовки.
+    Новые ключи сохраняются в кэш только после subscription_cache.commit(keys).
+    """
+    cache = subscription_cache
+    if not cache.loaded:
+        cache.load()
+    headers = {}
+    if not force:
+        if cache.etag:
+            headers['If-None-Match'] = cache.etag
+        if cache.last_modified:
+            headers['If-Modified-Since'] = cache.last_modified
+    logger.debug(f"Fetching subscription from {subscription_url}")
+    try:
+        async with http_clients.request('subscription', 'GET', subscription_url, headers=headers) as response:
+            logger.info(f"Subscription response status: {response.status}")
+            if response.status == 304:
+                logger.info("Subscription not modified, using cached keys")
+                return cache.keys, False
+            if response.status != 200:
+                logger.error(f"Subscription fetch failed: {response.status}, using {len(cache.keys)} cached keys")
+                return cache.keys, False
+            base64_text = await response.text()
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            logger.debug(f"Raw subscription response: {base64_text[:100]}...")
+    except Exception as e:
+        logger.error(f"Failed to fetch subscription: {str(e)}, using {len(cache.keys)} cached keys\n{traceback.format_exc()}")
+        return cache.keys, False
+    content_hash = hashlib.sha256(base64_text.encode('utf-8')).hexdigest()
+    if content_hash == cache.content_hash and not force:
+        logger.info("Subscription content unchanged, using cached keys")
+        if (etag, last_modified) != (cache.etag, cache.last_modified):
+            cache.etag, cache.last_modified = etag, last_modified
+            await cache.save()
+        return cache.keys, False
+    keys = parse_subscription_text(base64_text)
+    if not keys:
+        # Пустой или битый ответ не затирает последний удачный снимок
+        logger.error(f"Subscription returned no valid keys, using {len(cache.keys)} cached keys")
+        return cache.keys, False
+    cache.pending = {
+        "etag": etag,
+        "last_modified": last_modified,
+        "content_hash": content_hash,
+        "keys": keys,
+        "fetched_at": datetime.utcnow().isoformat()
+    }
+    return keys, True
+
+async def fetch_subscription_keys(subscription_url):
+    keys, _ = await fetch_subscription(subscription_url)
+    return keys
 
 def parse_vless_key(key):
     logger.debug(f"Parsing VLESS key: {key[:50]}...")
@@ -107,40 +226,93 @@ def parse_vless_key(key):
         logger.error(f"Failed to parse VLESS key: {str(e)}\n{traceback.format_exc()}")
         raise ValueError(f"Failed to parse VLESS key: {str(e)}")
 
-def create_outbound_json(ip, inbound_tag, vless_key):
-    logger.debug(f"Creating outbound JSON for IP {ip}, inbound_tag {inbound_tag}, vless_key {vless_key[:50]}...")
-    try:
-        key_data = parse_vless_key(vless_key)
-        config = {
-            "outbounds": [{
-                "protocol": "vless",
-                "settings": {
-                    "vnext": [{
-                        "address": ip,
-                        "port": 443,
-                        "users": [{
-                            "id": key_data["id"],
-                            "encryption": "none",
-                            "flow": "xtls-rprx-vision"
-                        }]
+def compile_outbound_template(inbound_tag, key_data):
+    """Собирает outbound без адреса: для каждого IP подставляется только address."""
+    return {
+        "outbounds": [{
+            "protocol": "vless",
+            "settings": {
+                "vnext": [{
+                    "address": None,
+                    "port": 443,
+                    "users": [{
+                        "id": key_data["id"],
+                        "encryption": "none",
+                        "flow": "xtls-rprx-vision"
                     }]
-                },
-                "streamSettings": {
-                    "network": "tcp",
-                    "security": "reality",
-                    "realitySettings": {
-                        "fingerprint": "chrome",
-                        "serverName": key_data["serverName"],
-                        "publicKey": key_data["publicKey"],
-                        "shortId": key_data["shortId"],
-                        "show": False
-                    }
-                },
-                "tag": inbound_tag.replace(" ", "_")
-            }]
+                }]
+            },
+            "streamSettings": {
+                "network": "tcp",
+                "security": "reality",
+                "realitySettings": {
+                    "fingerprint": "chrome",
+                    "serverName": key_data["serverName"],
+                    "publicKey": key_data["publicKey"],
+                    "shortId": key_data["shortId"],
+                    "show": False
+                }
+            },
+            "tag": inbound_tag.replace(" ", "_")
+        }]
+    }
+
+class OutboundCatalog:
+    """Разобранные VLESS-ключи и готовые шаблоны outbound по inbound_tag.
+
+    Запись пересобирается, только когда меняется хэш ключа.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.stats = {"hits": 0, "compiled": 0}
+
+    def _compile(self, inbound_tag, vless_key, key_hash):
+        key_data = parse_vless_key(vless_key)
+        entry = {
+            "hash": key_hash,
+            "key_data": key_data,
+            "template": compile_outbound_template(inbound_tag, key_data)
         }
-        logger.debug(f"Created outbound JSON for {ip}: {json.dumps(config, indent=2)}")
+        self.entries[inbound_tag] = entry
+        self.stats["compiled"] += 1
+        return entry
+
+    def get(self, inbound_tag, vless_key):
+        key_hash = hashlib.sha256(vless_key.encode('utf-8')).hexdigest()
+        entry = self.entries.get(inbound_tag)
+        if entry and entry["hash"] == key_hash:
+            self.stats["hits"] += 1
+            return entry
+        return self._compile(inbound_tag, vless_key, key_hash)
+
+    def sync(self, keys):
+        """Приводит каталог к набору ключей подписки, выбрасывая исчезнувшие теги."""
+        tags = set()
+        for key in keys:
+            tags.add(key['inbound_tag'])
+            try:
+                self.get(key['inbound_tag'], key['vless_key'])
+            except ValueError:
+                self.entries.pop(key['inbound_tag'], None)
+        for inbound_tag in set(self.entries) - tags:
+            del self.entries[inbound_tag]
+        logger.info(f"Outbound catalog synced: {len(self.entries)} templates")
+
+    def render(self, ip, inbound_tag, vless_key):
+        config = copy.deepcopy(self.get(inbound_tag, vless_key)["template"])
+        config["outbounds"][0]["settings"]["vnext"][0]["address"] = ip
         return config
+
+    def get_stats(self) -> dict:
+        return {"templates": len(self.entries), **self.stats}
+
+outbound_catalog = OutboundCatalog()
+
+def create_outbound_json(ip, inbound_tag, vless_key):
+    logger.debug(f"Creating outbound JSON for IP {ip}, inbound_tag {inbound_tag}")
+    try:
+        return outbound_catalog.render(ip, inbound_tag, vless_key)
     except Exception as e:
         logger.error(f"Failed to create outbound JSON for {ip}: {str(e)}\n{traceback.format_exc()}")
-        raise ValueError(f"Failed to create outbound JSON: {str(e)}")
\ No newline at end of file
+        raise ValueError(f"Failed to create outbound JSON: {str(e)}")
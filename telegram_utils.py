@@ -0,0 +1,156 @@
+import asyncio
+import html
+import logging
+import os
+import traceback
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramRetryAfter
+from ratelimit_utils import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+def get_minute_accusative_form(minutes: int) -> str:
+    if minutes % 10 == 1 and minutes % 100 != 11:
+        return "минуту"
+    elif minutes % 10 in [2, 3, 4] and minutes % 100 not in [12, 13, 14]:
+        return "минуты"
+    else:
+        return "минут"
+
+def format_alert_line(ip: str, status: str, duration_minutes: int) -> str:
+    minute_form = get_minute_accusative_form(duration_minutes)
+    if status == "offline":
+        return f'<code>{ip}</code> - была доступна {duration_minutes} {minute_form}'
+    return f'<code>{ip}</code> - была недоступна {duration_minutes} {minute_form}'
+
+def format_single_alert(ip: str, status: str, duration_minutes: int) -> str:
+    # HTML с <code> для копирования IP
+    minute_form = get_minute_accusative_form(duration_minutes)
+    if status == "offline":
+        return f'<b>[<code>{ip}</code>: 🔴 Офлайн]</b> - была доступна {duration_minutes} {minute_form}'
+    return f'<b>[<code>{ip}</code>: ✅ Онлайн]</b> - была недоступна {duration_minutes} {minute_form}'
+
+def build_digest_messages(alerts: list) -> list:
+    """Склеивает переходы за окно в сообщения, сгруппированные по статусу и локации."""
+    if len(alerts) == 1:
+        alert = alerts[0]
+        return [format_single_alert(alert["ip"], alert["status"], alert["duration_minutes"])]
+    groups = {}
+    for alert in alerts:
+        status = "offline" if alert["status"] == "offline" else "online"
+        groups.setdefault((status, alert.get("inbound_tag") or "Без локации"), []).append(alert)
+    lines = []
+    for (status, inbound_tag), group in sorted(groups.items(), key=lambda item: (item[0][0] != "offline", item[0][1])):
+        title = "🔴 Офлайн" if status == "offline" else "✅ Онлайн"
+        if lines:
+            lines.append("")
+        lines.append(f'<b>{title}: {html.escape(inbound_tag)}</b> ({len(group)})')
+        lines.extend(format_alert_line(alert["ip"], status, alert["duration_minutes"]) for alert in group)
+    messages = []
+    current = ""
+    for line in lines:
+        if current and len(current) + len(line) + 1 > TELEGRAM_MESSAGE_LIMIT:
+            messages.append(current)
+            current = ""
+        current = f"{current}\n{line}" if current else line
+    if current:
+        messages.append(current)
+    return messages
+
+class TelegramNotifier:
+    """Долгоживущий бот: копит переходы за окно и отправляет дайджесты с ограничением частоты."""
+
+    def __init__(self):
+        self.bot = None
+        self.chat_id = None
+        self.window = float(os.getenv('TELEGRAM_DIGEST_WINDOW', '5'))
+        # В групповой чат Telegram пропускает около 20 сообщений в минуту
+        self.bucket = TokenBucket(
+            rate=float(os.getenv('TELEGRAM_RATE_LIMIT', '0.33')),
+            capacity=float(os.getenv('TELEGRAM_BURST', '3'))
+        )
+        self.pending = {}
+        self._has_pending = asyncio.Event()
+        self._task = None
+        self._stopping = False
+        self.stats = {"alerts": 0, "messages_sent": 0, "messages_failed": 0, "retry_after": 0}
+
+    def start(self):
+        bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
+        self.chat_id = os.getenv('TELEGRAM_CHAT_ID')
+        if not bot_token or not self.chat_id:
+            logger.error("Missing TELEGRAM_BOT_TOKEN or TELEGRAM_CHAT_ID in .env, Telegram alerts disabled")
+            return
+        self.bot = Bot(token=bot_token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Telegram notifier started: digest window {self.window}s")
+
+    def enqueue(self, ip: str, status: str, duration_minutes: int, inbound_tag: str = None):
+        if self.bot is None:
+            return
+        # Повторы одного статуса IP в окне схлопываются в последний, а смена статуса
+        # (например, офлайн и возврат онлайн) сохраняется: в дайджесте будут оба перехода
+        alert = {"ip": ip, "status": status, "duration_minutes": duration_minutes, "inbound_tag": inbound_tag}
+        transitions = self.pending.setdefault(ip, [])
+        if transitions and transitions[-1]["status"] == status:
+            transitions[-1] = alert
+        else:
+            transitions.append(alert)
+        self.stats["alerts"] += 1
+        self._has_pending.set()
+
+    async def _run(self):
+        while not self._stopping:
+            await self._has_pending.wait()
+            if not self._stopping:
+                await asyncio.sleep(self.window)
+            await self._flush()
+
+    async def _flush(self):
+        self._has_pending.clear()
+        alerts = [alert for transitions in self.pending.values() for alert in transitions]
+        self.pending.clear()
+        if not alerts:
+            return
+        for message in build_digest_messages(alerts):
+            await self._send(message)
+        logger.info(f"Telegram digest sent for {len(alerts)} alerts")
+
+    async def _send(self, message: str, attempts: int = 3):
+        for attempt in range(1, attempts + 1):
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(self.chat_id, message)
+                self.stats["messages_sent"] += 1
+                logger.debug(f"Telegram message sent: {message[:200]}")
+                return
+            except TelegramRetryAfter as e:
+                self.stats["retry_after"] += 1
+                logger.warning(f"Telegram rate limit hit, retrying after {e.retry_after}s")
+                self.bucket.pause(e.retry_after)
+            except Exception as e:
+                logger.error(f"Error sending Telegram message (attempt {attempt}/{attempts}): {str(e)}\n{traceback.format_exc()}")
+                await asyncio.sleep(attempt * 2)
+        self.stats["messages_failed"] += 1
+
+    async def stop(self):
+        if self.bot is None:
+            return
+        self._stopping = True
+        self._has_pending.set()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self._flush()
+        await self.bot.session.close()
+        self.bot = None
+        logger.info("Telegram notifier stopped")
+
+    def get_stats(self) -> dict:
+        return {"pending": sum(len(transitions) for transitions in self.pending.values()), **self.stats}
+
+telegram_notifier = TelegramNotifier()